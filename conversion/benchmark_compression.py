@@ -0,0 +1,54 @@
+# Benchmark the block codecs on the PM25 data of firesmoke.idx, to pick the compression of the conversion.
+# Reports for zip, lz4 and zstd the compression ratio and the encode/decode throughput of one thread on the real
+# IDX blocks of a sample of timesteps. Dashboards decode every block they read, so a faster decode at a slightly
+# lower ratio usually makes reads faster. Only zip and lz4 can be stored in IDX files, zstd is reported for comparison
+# and needs the zstandard package, which isn't in wired_env.
+# ref: https://docs.python.org/3/library/logging.html
+import json
+import logging
+import os
+import numpy as np
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import LoadDataset
+
+from idx_compress import benchmark_codecs
+
+logger = logging.getLogger(__name__)
+
+# Set up logging
+# ref: https://realpython.com/python-logging/
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[
+        logging.FileHandler("/home/arleth/NSDF-WIRED/conversion/benchmark_compression.log"),
+        logging.StreamHandler()
+    ]
+)
+
+## Define paths
+# path of the idx file and data, the report is saved next to it
+idx_dir = "/opt/wired-data/firesmoke/idx_parallel"
+report_path = f"{idx_dir}/compression_benchmark.json"
+
+# number of timesteps to take blocks from, spread over the whole time range to cover all seasons
+num_samples = 48
+
+
+if __name__ == "__main__":
+    db = LoadDataset(f"{idx_dir}/firesmoke.idx")
+    timesteps = list(db.getTimesteps())
+    sample = sorted(set(np.linspace(0, len(timesteps) - 1, num_samples).astype(int).tolist()))
+
+    report = benchmark_codecs(db, sample)
+    for entry in report:
+        if 'error' in entry:
+            logger.info(f"{entry['codec']}: not available ({entry['error']})")
+            continue
+        logger.info(f"{entry['codec']}: ratio {entry['ratio']:.2f}, encode {entry['encode_MBps']:.0f} MB/s, "
+                    f"decode {entry['decode_MBps']:.0f} MB/s" + ("" if entry['stored'] else ", can't be stored in IDX"))
+
+    with open(report_path + ".part", mode="w") as f:
+        json.dump({'idx': f"{idx_dir}/firesmoke.idx", 'timesteps': sample, 'codecs': report}, f, indent=1)
+    os.replace(report_path + ".part", report_path)
+    logger.info(f"Report saved to {report_path}")
@@ -0,0 +1,133 @@
+### Persistent catalog of all UBC Firesmoke NetCDF files used for IDX conversion. ###
+# Conversion needs, per file, its lat/lon grid, its creation time (CDATE/CTIME) and the range of hours it covers
+# (first and last TFLAG). Instead of opening every file of the archive at the start of every conversion, we keep
+# this in a SQLite table keyed by path and mtime, and only scan files that are new or modified since the last run.
+
+## Import libs
+import concurrent.futures
+import os
+import sqlite3
+import sys
+import numpy as np
+import pandas as pd
+
+# header reader shared with the download scripts, in data_download/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_download'))
+from netcdf_header import read_header, decode_tflag
+
+# attributes and dimensions that identify the lat/lon grid a file is on
+GRID_COLUMNS = ['ROW', 'COL', 'XORIG', 'YORIG', 'XCELL', 'YCELL']
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    valid INTEGER NOT NULL,
+    error TEXT,
+    ROW INTEGER, COL INTEGER, XORIG REAL, YORIG REAL, XCELL REAL, YCELL REAL,
+    CDATE INTEGER, CTIME INTEGER,
+    NTSTEPS INTEGER,
+    TFLAG_0_DATE INTEGER, TFLAG_0_TIME INTEGER,
+    TFLAG_LAST_DATE INTEGER, TFLAG_LAST_TIME INTEGER
+)
+"""
+
+
+def scan_file(path):
+    """
+    Return the catalog row of the NetCDF file at path, as a dict
+    Files that can't be read, or lack TFLAG or the ROW/COL dimensions, get valid=0 and the reason in 'error'.
+    :param str path: path of the NetCDF file
+    """
+    row = {'path': path, 'mtime': os.path.getmtime(path), 'valid': 0, 'error': None}
+    try:
+        header = read_header(path)
+    except Exception as e:
+        # e.g. an html page saved in place of a missing forecast
+        row['error'] = f"{type(e).__name__}: {e}"
+        return row
+
+    attrs, sizes, tflag = header['attrs'], header['sizes'], header['tflag']
+    if len(tflag) == 0 or 'ROW' not in sizes or 'COL' not in sizes:
+        row['error'] = f"unexpected dimensions {sizes}"
+        return row
+    row.update({
+        'valid': 1,
+        'ROW': sizes['ROW'], 'COL': sizes['COL'],
+        'XORIG': float(attrs['XORIG']), 'YORIG': float(attrs['YORIG']),
+        'XCELL': float(attrs['XCELL']), 'YCELL': float(attrs['YCELL']),
+        'CDATE': int(attrs['CDATE']), 'CTIME': int(attrs['CTIME']),
+        'NTSTEPS': len(tflag),
+        'TFLAG_0_DATE': int(tflag[0][0]), 'TFLAG_0_TIME': int(tflag[0][1]),
+        'TFLAG_LAST_DATE': int(tflag[-1][0]), 'TFLAG_LAST_TIME': int(tflag[-1][1]),
+    })
+    return row
+
+
+def update_catalog(catalog_path, firesmoke_dir, max_workers=None):
+    """
+    Bring the catalog at catalog_path up to date with the files in firesmoke_dir, return the number of files scanned
+    Only files that are new, or whose mtime changed, are scanned. Files that no longer exist are dropped.
+    :param str catalog_path: path of the SQLite catalog, created if it doesn't exist
+    :param str firesmoke_dir: directory of all NetCDF files
+    :param int max_workers: number of processes scanning files, None for one per core
+    """
+    with sqlite3.connect(catalog_path) as conn:
+        conn.execute(CREATE_TABLE)
+        known = dict(conn.execute("SELECT path, mtime FROM files"))
+
+        # get list of NetCDF file paths, skipping unfinished downloads
+        paths = [f"{firesmoke_dir}/{file}" for file in sorted(os.listdir(firesmoke_dir)) if not file.endswith(".part")]
+        to_scan = [path for path in paths if known.get(path) != os.path.getmtime(path)]
+        removed = set(known) - set(paths)
+
+        # the netCDF/HDF5 libraries aren't thread safe, so scan in processes
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            rows = list(executor.map(scan_file, to_scan, chunksize=16))
+
+        columns = ['path', 'mtime', 'valid', 'error', *GRID_COLUMNS, 'CDATE', 'CTIME', 'NTSTEPS',
+                   'TFLAG_0_DATE', 'TFLAG_0_TIME', 'TFLAG_LAST_DATE', 'TFLAG_LAST_TIME']
+        conn.executemany(f"INSERT OR REPLACE INTO files ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                         [[row.get(c) for c in columns] for row in rows])
+        conn.executemany("DELETE FROM files WHERE path = ?", [[path] for path in removed])
+    return len(to_scan)
+
+
+def load_catalog(catalog_path, valid_only=True):
+    """
+    Return the catalog as a DataFrame sorted by creation time, with decoded timestamps
+    Besides the table's columns it has 'file' (file name), 'CDATETIME', 'tflag_0' and 'tflag_last' (datetime64).
+    :param str catalog_path: path of the SQLite catalog
+    :param bool valid_only: only return files that could be read
+    """
+    with sqlite3.connect(catalog_path) as conn:
+        df = pd.read_sql_query("SELECT * FROM files" + (" WHERE valid = 1" if valid_only else ""), conn)
+
+    df['file'] = df['path'].map(os.path.basename)
+    df['CDATETIME'] = decode_columns(df, 'CDATE', 'CTIME')
+    df['tflag_0'] = decode_columns(df, 'TFLAG_0_DATE', 'TFLAG_0_TIME')
+    df['tflag_last'] = decode_columns(df, 'TFLAG_LAST_DATE', 'TFLAG_LAST_TIME')
+    return df.sort_values(['CDATETIME', 'file']).reset_index(drop=True)
+
+
+def decode_columns(df, date_column, time_column):
+    """
+    Return the YYYYDDD and HHMMSS columns of df as one datetime64 array, NaT for invalid files
+    :param pd.DataFrame df: catalog table
+    :param str date_column: name of the YYYYDDD column
+    :param str time_column: name of the HHMMSS column
+    """
+    values = np.full(len(df), np.datetime64('NaT'), dtype='datetime64[s]')
+    valid = (df['valid'] == 1).to_numpy()
+    values[valid] = decode_tflag(np.stack([df[date_column][valid], df[time_column][valid]], axis=-1))
+    return values
+
+
+def grid_signatures(catalog_df):
+    """
+    Return the unique grids used by the files in catalog_df with the number of files on each, smallest grid first
+    :param pd.DataFrame catalog_df: catalog as returned by load_catalog
+    """
+    grids = catalog_df.groupby(GRID_COLUMNS).size().rename('files').reset_index()
+    grids['cells'] = grids['ROW'] * grids['COL']
+    return grids.sort_values('cells').reset_index(drop=True)
@@ -0,0 +1,172 @@
+### Daily and monthly aggregates of firesmoke.idx: mean and max PM25, and hours above air quality thresholds. ###
+# Seasonal maps and exceedance statistics used to be computed from the hourly frames every time, a scan over tens of
+# thousands of timesteps. Here the conversion keeps two more IDX files next to firesmoke.idx, firesmoke_daily.idx
+# and firesmoke_monthly.idx, with one timestep per day (or month) and the fields mean, max and hours_above_<t> for
+# every threshold t. They are updated incrementally: only the days whose hours changed are computed again, from the
+# hourly IDX, and the months holding them from the daily IDX. aggregates.json records the first day and month and
+# the hourly timesteps each day is made of. The OpenVisus xarray backend (backend_v3.py) exposes them as variables.
+
+## Import libs
+import json
+import logging
+import os
+import numpy as np
+
+from idx_compress import compress_idx, set_default_compression
+from idx_incremental import open_idx, clear_timesteps
+
+logger = logging.getLogger(__name__)
+
+# aggregate IDX files and their description, saved in the IDX directory; read by backend_v3.py
+AGGREGATES_META = "aggregates.json"
+AGGREGATE_IDX = {'daily': "firesmoke_daily.idx", 'monthly': "firesmoke_monthly.idx"}
+
+# hourly PM25 thresholds in ug/m^3 the hours above are counted for: the WHO 2021 24-hour guideline,
+# the 2020 Canadian Ambient Air Quality Standard and the US EPA 24-hour standard
+# ref: https://www.who.int/publications/i/item/9789240034228
+# ref: https://ccme.ca/en/air-quality-report
+AQ_THRESHOLDS = (15, 27, 35)
+
+
+def aggregate_fields(thresholds=AQ_THRESHOLDS):
+    """Return the (name, dtype) of the fields of an aggregate IDX"""
+    # counts fit in uint16, a month has at most 744 hours
+    return [('mean', 'float32'), ('max', 'float32')] + [(f"hours_above_{t:g}", 'uint16') for t in thresholds]
+
+
+def aggregate_frames(frames, thresholds=AQ_THRESHOLDS):
+    """
+    Return the aggregate fields of a sequence of hourly frames, as a dict of arrays, and the number of frames
+    Frames are accumulated one at a time, so frames can be a generator.
+    :param frames: iterable of (ROW, COL) arrays
+    :param list thresholds: values the hours above are counted for
+    """
+    total, peak, counts, hours = None, None, None, 0
+    for frame in frames:
+        if total is None:
+            total = np.zeros(frame.shape)
+            peak = np.full(frame.shape, -np.inf, dtype=np.float32)
+            counts = np.zeros((len(thresholds),) + frame.shape, dtype=np.uint16)
+        total += frame
+        np.maximum(peak, frame, out=peak)
+        for count, threshold in zip(counts, thresholds):
+            count += frame > threshold
+        hours += 1
+    if hours == 0:
+        return None, 0
+    fields = {'mean': (total / hours).astype(np.float32), 'max': peak}
+    fields.update((f"hours_above_{t:g}", count) for t, count in zip(thresholds, counts))
+    return fields, hours
+
+
+def combine_aggregates(aggregates, thresholds=AQ_THRESHOLDS):
+    """
+    Return the aggregate fields of a longer period from those of its parts, and its number of hours
+    :param list aggregates: (fields, hours) of every part with hours, as returned by aggregate_frames
+    :param list thresholds: values the hours above are counted for
+    """
+    hours = sum(h for _, h in aggregates)
+    if hours == 0:
+        return None, 0
+    # the mean of the period weighs the mean of every part by its hours
+    fields = {'mean': (sum(f['mean'].astype(np.float64) * h for f, h in aggregates) / hours).astype(np.float32),
+              'max': np.maximum.reduce([f['max'] for f, _ in aggregates])}
+    for t in thresholds:
+        name = f"hours_above_{t:g}"
+        fields[name] = np.sum([f[name] for f, _ in aggregates], axis=0, dtype=np.uint16)
+    return fields, hours
+
+
+def period_indices(idx_calls):
+    """
+    Return the index of the day and of the month of every idx call, and the first day and month
+    :param np.ndarray idx_calls: idx calls as returned by idx_schedule.build_idx_calls
+    """
+    days = idx_calls['time'].astype('datetime64[D]')
+    months = idx_calls['time'].astype('datetime64[M]')
+    return (days - days[0]).astype(int), (months - months[0]).astype(int), days[0], months[0]
+
+
+def _write_periods(db, periods, compression):
+    # rewrite the given periods of an aggregate IDX, periods maps each to its fields or None if it has no hours;
+    # compressed blocks can't be overwritten in place, so periods are cleared, written raw and compressed again
+    db = set_default_compression(db, '')
+    clear_timesteps(db, list(periods))
+    for p, fields in periods.items():
+        if fields is None:
+            continue
+        for name, data in fields.items():
+            db.write(data=data, field=db.getField(name), time=int(p))
+    if compression:
+        db = compress_idx(db, [p for p, fields in periods.items() if fields is not None], compression)
+    return db
+
+
+def _read_fields(db, period, thresholds):
+    return {name: db.read(time=int(period), field=name) for name, _ in aggregate_fields(thresholds)}
+
+
+def update_aggregates(idx_dir, db, idx_calls, valid, changed=(), thresholds=AQ_THRESHOLDS, compression='zip',
+                      field_name='PM25'):
+    """
+    Bring the daily and monthly aggregates of the IDX in idx_dir up to date, return the number of days updated
+    A day is computed again if the valid hourly timesteps it is made of differ from the last update, or if one of
+    them is in changed, and a month if one of its days was. The first update computes everything.
+    :param str idx_dir: directory of firesmoke.idx
+    :param PyDataset db: the hourly IDX
+    :param np.ndarray idx_calls: idx calls the IDX holds, call i is timestep i
+    :param list valid: timesteps holding data, e.g. written or compressed in the conversion journal
+    :param list changed: timesteps whose data changed since the last update
+    :param list thresholds: hourly values the hours above are counted for
+    :param str compression: codec of the aggregate IDX blocks, one of idx_compress.CODECS or '' for none
+    :param str field_name: field of the hourly IDX to aggregate
+    """
+    day_index, month_index, first_day, first_month = period_indices(idx_calls)
+    num_days, num_months = int(day_index[-1]) + 1, int(month_index[-1]) + 1
+    valid = np.zeros(len(idx_calls), dtype=bool) if len(valid) == 0 else np.isin(np.arange(len(idx_calls)), valid)
+    day_timesteps = [[] for _ in range(num_days)]
+    for t in np.flatnonzero(valid):
+        day_timesteps[day_index[t]].append(int(t))
+
+    meta_path = f"{idx_dir}/{AGGREGATES_META}"
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['thresholds'] != list(thresholds):
+            raise ValueError(f"Aggregates in {idx_dir} count hours above {meta['thresholds']}, not {list(thresholds)},"
+                             f" delete them to compute new ones")
+    # aggregates of a schedule starting on another day are all computed again
+    old_days = meta.get('daily', {}).get('timesteps', []) if meta.get('daily', {}).get('start') == str(first_day) else []
+    changed_days = set(day_index[list(changed)].tolist())
+    days = [d for d in range(num_days)
+            if d in changed_days or d >= len(old_days) or old_days[d] != day_timesteps[d]]
+    # days without any valid hour still belong to their month
+    month_of_day = ((first_day + np.arange(num_days)).astype('datetime64[M]') - first_month).astype(int)
+    months = sorted(set(month_of_day[days].tolist()))
+    logger.info(f"Updating the aggregates of {len(days)} days and {len(months)} months")
+
+    dims = [int(n) for n in db.getLogicSize()]
+    fields = aggregate_fields(thresholds)
+    daily_db = open_idx(f"{idx_dir}/{AGGREGATE_IDX['daily']}", dims, num_days, fields=fields)
+    updated = {}
+    for d in days:
+        updated[d], _ = aggregate_frames((db.read(time=t, field=field_name) for t in day_timesteps[d]), thresholds)
+    daily_db = _write_periods(daily_db, updated, compression)
+
+    day_hours = [len(timesteps) for timesteps in day_timesteps]
+    monthly_db = open_idx(f"{idx_dir}/{AGGREGATE_IDX['monthly']}", dims, num_months, fields=fields)
+    updated = {}
+    for m in months:
+        month_days = [d for d in np.flatnonzero(month_of_day == m) if day_hours[d] > 0]
+        updated[m], _ = combine_aggregates([(_read_fields(daily_db, d, thresholds), day_hours[d]) for d in month_days], thresholds)
+    _write_periods(monthly_db, updated, compression)
+
+    meta = {'field': field_name, 'thresholds': list(thresholds),
+            'daily': {'start': str(first_day), 'hours': day_hours, 'timesteps': day_timesteps},
+            'monthly': {'start': str(first_month),
+                        'hours': np.bincount(month_of_day, weights=day_hours, minlength=num_months).astype(int).tolist()}}
+    with open(meta_path + ".part", mode="w") as f:
+        json.dump(meta, f)
+    os.replace(meta_path + ".part", meta_path)
+    return len(days)
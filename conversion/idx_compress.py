@@ -0,0 +1,306 @@
+### Compress the timesteps of firesmoke.idx in parallel, while the conversion is still writing. ###
+# The conversion used to end with db.compressDataset(['zip']), which goes over the whole dataset after all writes,
+# and db.compressDataset(..., timestep=t) rewrites and reloads the .idx for every timestep (and compresses the whole
+# dataset again for any codec but zip). Every timestep of firesmoke.idx is in its own files, made of independent
+# blocks, so once a timestep is written its files can be compressed in a thread pool while the next ones are
+# written. zlib and lz4 release the GIL, so threads compress blocks in parallel.
+# ref: https://github.com/sci-visus/OpenVisus/blob/master/Libs/swig/convert.py (CompressModVisusDataset)
+
+## Import libs
+import concurrent.futures
+from collections import deque
+import logging
+import os
+import struct
+import time
+import zlib
+import lz4.block
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import LoadDataset
+
+logger = logging.getLogger(__name__)
+
+# codecs that can be stored in the blocks of an IDX file, and the block header flag OpenVisus reads them with;
+# OpenVisus has no block flag for zstd, it is only benchmarked
+CODECS = {'zip': 0x03, 'lz4': 0x07}
+BENCHMARK_CODECS = ('zip', 'lz4', 'zstd')
+COMPRESSION_MASK = 0x0f
+
+# the file header and every block header are 10 big endian uint32
+HEADER_SIZE = 10 * 4
+
+
+def encode_block(data, compression):
+    """
+    Return the bytes of a block compressed with compression
+    :param bytes data: uncompressed block
+    :param str compression: one of BENCHMARK_CODECS
+    """
+    if compression == 'zip':
+        return zlib.compress(data, level=-1)
+    if compression == 'lz4':
+        # OpenVisus stores plain lz4 blocks, without the uncompressed size in front
+        return lz4.block.compress(data, store_size=False)
+    if compression == 'zstd':
+        # not part of wired_env, only needed to benchmark zstd
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unknown compression {compression}, expected one of {BENCHMARK_CODECS}")
+
+
+def decode_block(block, compression, block_size):
+    """
+    Return the uncompressed bytes of a block
+    :param bytes block: block as stored
+    :param str compression: '' for uncompressed blocks, or one of BENCHMARK_CODECS
+    :param int block_size: size of the uncompressed block in bytes
+    """
+    if compression == '':
+        return block
+    if compression == 'zip':
+        return zlib.decompress(block)
+    if compression == 'lz4':
+        return lz4.block.decompress(block, uncompressed_size=block_size)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(block, max_output_size=block_size)
+    raise ValueError(f"Unknown compression {compression}, expected one of {BENCHMARK_CODECS}")
+
+
+def block_sizes(db):
+    """
+    Return the uncompressed size in bytes of every block of a data file of the IDX, in file order
+    A file holds blocksperfile blocks of each field, field after field.
+    :param PyDataset db: the IDX
+    """
+    idx = db.db.idxfile
+    return [field.dtype.getByteSize(2 ** idx.bitsperblock) for field in idx.fields for _ in range(idx.blocksperfile)]
+
+
+def read_blocks(filename, sizes):
+    """
+    Return the block headers of an IDX data file and its blocks, uncompressed, None for blocks that aren't stored
+    :param str filename: path of the data file
+    :param list sizes: uncompressed size of every block, as returned by block_sizes
+    """
+    with open(filename, mode="rb") as f:
+        mem = f.read()
+    header_size = HEADER_SIZE * (1 + len(sizes))
+    headers = [struct.unpack('>IIIIIIIIII', mem[cur:cur + HEADER_SIZE]) for cur in range(HEADER_SIZE, header_size, HEADER_SIZE)]
+    codes = {0: '', **{code: name for name, code in CODECS.items()}}
+
+    blocks = []
+    for header, block_size in zip(headers, sizes):
+        offset, size, flags = header[2] + (header[3] << 32), header[4], header[5]
+        if size == 0:
+            # the block was never written, which is fine
+            blocks.append(None)
+            continue
+        if flags & COMPRESSION_MASK not in codes:
+            raise ValueError(f"Block at {offset} of {filename} has unsupported compression flags {flags:#x}")
+        block = decode_block(mem[offset:offset + size], codes[flags & COMPRESSION_MASK], block_size)
+        if len(block) != block_size:
+            raise ValueError(f"Block at {offset} of {filename} has {len(block)} bytes, expected {block_size}")
+        blocks.append(block)
+    return headers, blocks
+
+
+def compress_file(filename, sizes, compression='zip'):
+    """
+    Rewrite an IDX data file with all its blocks compressed with compression, return its (raw, compressed) size
+    Blocks are decoded first whatever they are stored with, so compressing a file twice or with another codec is fine.
+    The file is replaced at once, readers never see it half written.
+    :param str filename: path of the data file
+    :param list sizes: uncompressed size of every block, as returned by block_sizes
+    :param str compression: one of CODECS
+    """
+    if compression not in CODECS:
+        raise ValueError(f"Can't store {compression} blocks in IDX files, expected one of {list(CODECS)}")
+    headers, blocks = read_blocks(filename, sizes)
+    compressed = [b'' if block is None else encode_block(block, compression) for block in blocks]
+
+    # blocks follow the headers, in block order
+    offset = HEADER_SIZE * (1 + len(sizes))
+    out = [struct.pack('>IIIIIIIIII', *[0] * 10)]
+    for header, block in zip(headers, compressed):
+        flags = (header[5] & ~COMPRESSION_MASK) | CODECS[compression] if block else header[5]
+        out.append(struct.pack('>IIIIIIIIII', 0, 0, offset & 0xffffffff, offset >> 32, len(block), flags, 0, 0, 0, 0))
+        offset += len(block)
+    out.extend(compressed)
+
+    tmp_path = filename + ".part"
+    with open(tmp_path, mode="wb") as f:
+        f.write(b''.join(out))
+    os.replace(tmp_path, filename)
+    return sum(len(block) for block in blocks if block is not None), offset
+
+
+def compress_timestep(filenames, sizes, compression='zip'):
+    """
+    Compress the data files of one timestep, return their total (raw, compressed) size
+    :param list filenames: data files of the timestep, as returned by db.db.getFilenames
+    :param list sizes: uncompressed size of every block, as returned by block_sizes
+    :param str compression: one of CODECS
+    """
+    raw_size, compressed_size = 0, 0
+    for filename in filenames:
+        if os.path.isfile(filename):
+            raw, compressed = compress_file(filename, sizes, compression)
+            raw_size += raw
+            compressed_size += compressed
+    return raw_size, compressed_size
+
+
+def set_default_compression(db, compression):
+    """
+    Set the compression the IDX header advertises for all fields, return the reloaded IDX
+    OpenVisus compresses blocks as it writes them with this compression, so it is left empty while
+    the conversion writes and set to the codec once the timesteps are compressed.
+    :param PyDataset db: the IDX
+    :param str compression: '' or one of CODECS
+    """
+    idx = db.db.idxfile
+    fields = list(idx.fields)
+    if all(field.default_compression == compression for field in fields):
+        return db
+    # same as the end of db.compressDataset
+    idx.fields.clear()
+    for field in fields:
+        field.default_compression = compression
+        idx.fields.push_back(field)
+    url = db.getUrl()
+    idx.save(url)
+    return LoadDataset(url)
+
+
+class CompressionStage:
+    """
+    Compress written timesteps of an IDX in a thread pool, while more timesteps are being written
+    submit() hands a timestep over as soon as it is written, completed() returns the timesteps compressed since it
+    was last called. At most max_pending timesteps wait to be compressed at once, submit() blocks on the oldest
+    one when there are more, so uncompressed timesteps don't pile up on disk when writing is faster.
+    """
+
+    def __init__(self, db, compression='zip', max_workers=None, max_pending=None):
+        """
+        :param PyDataset db: the IDX
+        :param str compression: one of CODECS
+        :param int max_workers: number of compressing threads, None for one per core
+        :param int max_pending: number of timesteps submitted and not yet compressed at once, None for 4 per thread
+        """
+        if compression not in CODECS:
+            raise ValueError(f"Can't store {compression} blocks in IDX files, expected one of {list(CODECS)}")
+        self.db = db
+        self.compression = compression
+        self.sizes = block_sizes(db)
+        max_workers = max_workers or os.cpu_count()
+        self.max_pending = max_pending or 4 * max_workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # (timestep, future) in submission order, and timesteps that finished but weren't returned by completed() yet
+        self.pending = deque()
+        self.done = []
+        self.raw_size, self.compressed_size = 0, 0
+
+    def submit(self, timestep):
+        """Start compressing the data files of timestep, which must not be written to anymore"""
+        # file names are resolved here, OpenVisus objects stay in the writing thread
+        filenames = list(self.db.db.getFilenames(int(timestep), ''))
+        self.pending.append((int(timestep), self.executor.submit(compress_timestep, filenames, self.sizes,
+                                                                 self.compression)))
+        while len(self.pending) > self.max_pending:
+            self._collect(self.pending.popleft())
+
+    def _collect(self, item):
+        timestep, future = item
+        try:
+            raw_size, compressed_size = future.result()
+            self.raw_size += raw_size
+            self.compressed_size += compressed_size
+            self.done.append((timestep, None))
+        except Exception as e:
+            logger.error(f"Failed to compress timestep {timestep}: {type(e).__name__}: {e}")
+            self.done.append((timestep, f"{type(e).__name__}: {e}"))
+
+    def completed(self, wait=False):
+        """
+        Return [(timestep, error)] for the timesteps compressed since the last call, error is None if it succeeded
+        :param bool wait: wait for all submitted timesteps
+        """
+        while self.pending and (wait or self.pending[0][1].done()):
+            self._collect(self.pending.popleft())
+        done, self.done = self.done, []
+        return done
+
+    def close(self):
+        """Wait for all submitted timesteps, return the ones not returned by completed() yet and stop the threads"""
+        done = self.completed(wait=True)
+        self.executor.shutdown(wait=True)
+        if self.raw_size:
+            logger.info(f"Compressed {self.raw_size / 2**20:.1f} MB to {self.compressed_size / 2**20:.1f} MB "
+                        f"with {self.compression}")
+        return done
+
+
+def compress_idx(db, timesteps, compression='zip', max_workers=None):
+    """
+    Compress the given timesteps of an IDX in parallel, return the reloaded IDX
+    Faster replacement of db.compressDataset([compression]) once everything is written.
+    :param PyDataset db: the IDX
+    :param list timesteps: timesteps to compress
+    :param str compression: one of CODECS
+    :param int max_workers: number of compressing threads, None for one per core
+    """
+    stage = CompressionStage(db, compression, max_workers)
+    for t in timesteps:
+        stage.submit(t)
+    failed = [t for t, error in stage.close() if error is not None]
+    if failed:
+        logger.error(f"{len(failed)} timesteps could not be compressed: {failed}")
+    return set_default_compression(db, compression)
+
+
+def benchmark_codecs(db, timesteps, codecs=BENCHMARK_CODECS, repeat=3):
+    """
+    Return the compression ratio and encode/decode throughput of each codec on the blocks of the given timesteps
+    Blocks are taken from the IDX as stored and decoded first, so the benchmark runs on the real PM25 blocks.
+    Each entry has codec, stored (whether IDX files can hold it), ratio (raw / compressed size) and encode_MBps
+    and decode_MBps (MB of raw data per second on one thread, best of repeat), or error if the codec isn't available.
+    :param PyDataset db: the IDX
+    :param list timesteps: timesteps to take blocks from
+    :param list codecs: codecs to benchmark, from BENCHMARK_CODECS
+    :param int repeat: number of times each codec is timed
+    """
+    sizes = block_sizes(db)
+    blocks = []
+    for t in timesteps:
+        for filename in db.db.getFilenames(int(t), ''):
+            if os.path.isfile(filename):
+                blocks.extend((block, size) for block, size in zip(read_blocks(filename, sizes)[1], sizes)
+                              if block is not None)
+    raw_size = sum(size for _, size in blocks)
+    if raw_size == 0:
+        raise ValueError(f"No data in timesteps {list(timesteps)} of {db.getUrl()}")
+
+    report = []
+    for codec in codecs:
+        entry = {'codec': codec, 'stored': codec in CODECS, 'blocks': len(blocks), 'raw_MB': raw_size / 2**20}
+        try:
+            encode_times, decode_times = [], []
+            for _ in range(repeat):
+                t1 = time.perf_counter()
+                compressed = [encode_block(block, codec) for block, _ in blocks]
+                encode_times.append(time.perf_counter() - t1)
+                t1 = time.perf_counter()
+                for block, (_, size) in zip(compressed, blocks):
+                    decode_block(block, codec, size)
+                decode_times.append(time.perf_counter() - t1)
+        except ImportError as e:
+            entry['error'] = f"{type(e).__name__}: {e}"
+            report.append(entry)
+            continue
+        compressed_size = sum(len(block) for block in compressed)
+        entry.update(compressed_MB=compressed_size / 2**20, ratio=raw_size / compressed_size,
+                     encode_MBps=raw_size / 2**20 / min(encode_times),
+                     decode_MBps=raw_size / 2**20 / min(decode_times))
+        report.append(entry)
+    return report
@@ -0,0 +1,111 @@
+### Keep firesmoke.idx up to date by only writing the timesteps whose idx call changed. ###
+# The v5 notebooks create firesmoke.idx from scratch and write every timestep, although each new download only adds
+# or replaces a handful of hours. Here we keep the idx_calls that are in the IDX next to it (idx_calls_written.npy),
+# diff a freshly built schedule against them, extend the IDX time range and rewrite/recompress only what changed.
+# Limitation: timesteps are positions in the schedule, not fixed hours. Hours no file covers are left out of it (see
+# idx_schedule.build_idx_calls), so when a file that covers an earlier gap shows up, every later call moves up by
+# the hours it fills and all the timesteps after the gap are rewritten. Only files adding hours at the end, or
+# replacing the forecast of covered hours, are converted in O(new hours). Keying timesteps on the hours since the
+# start would avoid that, but changes the layout of the existing IDX and of the metadata NetCDF.
+
+## Import libs
+import logging
+import os
+import numpy as np
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import CreateIdx, DatasetTimesteps, Field, LoadDataset
+
+from idx_schedule import IDX_CALL_DTYPE, load_idx_calls, save_idx_calls
+
+logger = logging.getLogger(__name__)
+
+# idx calls that are in the IDX, saved in the IDX directory
+WRITTEN_CALLS = "idx_calls_written.npy"
+
+# time template used by the v5 conversion, one directory per timestep
+TIME_TEMPLATE = '%00000000d/'
+
+
+def load_written_calls(idx_dir):
+    """
+    Return the idx calls written to the IDX in idx_dir, an empty array if there is none yet
+    :param str idx_dir: directory of firesmoke.idx
+    """
+    path = f"{idx_dir}/{WRITTEN_CALLS}"
+    if not os.path.exists(path):
+        return np.empty(0, dtype=IDX_CALL_DTYPE)
+    return load_idx_calls(path)
+
+
+def save_written_calls(idx_dir, idx_calls, failed=()):
+    """
+    Record idx_calls as written to the IDX in idx_dir
+    Timesteps in failed are recorded without a file, so the next update writes them again.
+    :param str idx_dir: directory of firesmoke.idx
+    :param np.ndarray idx_calls: idx calls as returned by idx_schedule.build_idx_calls
+    :param list failed: timesteps that could not be written
+    """
+    written = idx_calls.copy()
+    written['file'][list(failed)] = ''
+    # write to a temporary file first so an interrupted update never leaves a truncated record
+    path = f"{idx_dir}/{WRITTEN_CALLS}"
+    save_idx_calls(path + ".part.npy", written)
+    os.replace(path + ".part.npy", path)
+
+
+def diff_idx_calls(old_calls, new_calls):
+    """
+    Return the timesteps of new_calls that are not in old_calls, as a sorted int array
+    A timestep is written again if its file, hour or TSTEP changed, or if it is past the end of old_calls. Since
+    timesteps are positions in the schedule, hours added before the end shift, and rewrite, all the calls after them.
+    :param np.ndarray old_calls: idx calls in the IDX, e.g. load_written_calls(idx_dir)
+    :param np.ndarray new_calls: idx calls we want the IDX to hold
+    """
+    n = min(len(old_calls), len(new_calls))
+    changed = ((old_calls['file'][:n] != new_calls['file'][:n]) |
+               (old_calls['time'][:n] != new_calls['time'][:n]) |
+               (old_calls['tstep'][:n] != new_calls['tstep'][:n]))
+    return np.concatenate([np.flatnonzero(changed), np.arange(n, len(new_calls))])
+
+
+def open_idx(idx_url, dims, num_timesteps, field_name='PM25', fields=None):
+    """
+    Return the IDX at idx_url with its time range set to [0, num_timesteps - 1], created if it doesn't exist
+    :param str idx_url: path of firesmoke.idx
+    :param list dims: [COL, ROW] of the grid all data is resampled to
+    :param int num_timesteps: number of timesteps the IDX should hold
+    :param str field_name: name of the float32 field holding the data
+    :param list fields: (name, dtype) of every field, None for the single float32 field_name
+    """
+    if not os.path.exists(idx_url):
+        logger.info(f"Creating {idx_url} with {num_timesteps} timesteps")
+        fields = [(field_name, 'float32')] if fields is None else fields
+        return CreateIdx(url=idx_url, fields=[Field(name, dtype) for name, dtype in fields], dims=[int(d) for d in dims],
+                         time=[0, num_timesteps - 1, TIME_TEMPLATE])
+
+    db = LoadDataset(idx_url)
+    timesteps = list(db.getTimesteps())
+    if len(timesteps) != num_timesteps:
+        logger.info(f"Changing time range of {idx_url} from {len(timesteps)} to {num_timesteps} timesteps")
+        # drop the data of timesteps that fall out of the range
+        clear_timesteps(db, timesteps[num_timesteps:])
+        # the time range is only a line of the .idx header, the data of each timestep is in its own directory
+        idx = db.db.idxfile
+        idx.timesteps = DatasetTimesteps(0, num_timesteps - 1, 1.0)
+        idx.save(idx_url)
+        db = LoadDataset(idx_url)
+    return db
+
+
+def clear_timesteps(db, timesteps):
+    """
+    Remove the data files of the given timesteps, so they can be written again from scratch
+    Blocks of a compressed file can't be overwritten in place, so timesteps we rewrite are removed first.
+    :param PyDataset db: the IDX
+    :param list timesteps: timesteps to clear
+    """
+    for t in timesteps:
+        for filename in db.db.getFilenames(int(t), ''):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
@@ -0,0 +1,205 @@
+### Restartable conversion of idx_calls to firesmoke.idx, journaling the state of every timestep. ###
+# A multi-hour conversion used to lose everything on a crash, OOM or preemption, and skipped frames were only
+# printed. Here the state of every IDX timestep (scheduled, resampled, written, compressed or skipped) is appended
+# to a journal next to the IDX as it changes. Running the conversion again picks up where the journal left off:
+# timesteps already written with the same idx call are not read again. Skipped frames are reported in a JSON file.
+
+## Import libs
+from collections import Counter
+import json
+import logging
+import os
+import numpy as np
+
+from idx_aggregates import update_aggregates
+from idx_compress import CompressionStage, set_default_compression
+from idx_incremental import open_idx, clear_timesteps
+from idx_pipeline import stream_frames
+from idx_time_major import TIME_MAJOR, TIME_MAJOR_META, TimeMajorWriter
+
+logger = logging.getLogger(__name__)
+
+# journal and report, saved in the IDX directory
+JOURNAL = "conversion_journal.jsonl"
+SKIPPED_REPORT = "skipped_frames.json"
+
+
+class ConversionJournal:
+    """
+    Persistent state of every IDX timestep of a conversion, keyed by timestep
+    Each entry holds the timestep, the idx call it is written from (file, time, tstep), its status and the error
+    that made it skipped. Updates are appended as JSON lines and flushed, so a crash mid-write loses at most the
+    last update, and the file is compacted every time it is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn last line from an interrupted run
+                        continue
+                    self.entries[entry['timestep']] = entry
+        self._compact()
+        self.file = open(path, mode="a")
+
+    def _compact(self):
+        # keep only the latest entry of each timestep
+        tmp_path = self.path + ".part"
+        with open(tmp_path, mode="w") as f:
+            for timestep in sorted(self.entries):
+                f.write(json.dumps(self.entries[timestep]) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def get(self, timestep):
+        return self.entries.get(timestep)
+
+    def update(self, timestep, **fields):
+        entry = {**self.entries.get(timestep, {'timestep': timestep}), **fields}
+        self.entries[timestep] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        return entry
+
+    def schedule(self, timestep, call):
+        """Record that timestep will be written from call, forgetting any earlier state"""
+        self.entries.pop(timestep, None)
+        return self.update(timestep, file=str(call['file']), time=str(call['time']), tstep=int(call['tstep']),
+                           status='scheduled', error=None)
+
+    def has(self, timestep, call, statuses):
+        """Return True if timestep is recorded as written from call with one of statuses"""
+        entry = self.entries.get(timestep)
+        return (entry is not None and entry['status'] in statuses and entry['file'] == str(call['file'])
+                and entry['time'] == str(call['time']) and entry['tstep'] == int(call['tstep']))
+
+    def counts(self):
+        """Return a dict of the number of timesteps per status"""
+        return dict(Counter(entry['status'] for entry in self.entries.values()))
+
+    def skipped(self):
+        """Return the entries of skipped timesteps, by timestep"""
+        return [self.entries[t] for t in sorted(self.entries) if self.entries[t]['status'] == 'skipped']
+
+    def close(self):
+        self.file.close()
+
+
+def run_conversion(idx_calls, idx_dir, firesmoke_dir, max_grid, resample_op, thresh, timesteps=None,
+                   compression='zip', compress_workers=None, time_major=False, aggregates=False, **stream_kwargs):
+    """
+    Write idx_calls to idx_dir/firesmoke.idx, resuming from the journal of an interrupted run, return the journal
+    Timesteps the journal has as written or compressed from the same idx call are not read again, everything else
+    in timesteps is cleared, read, resampled, written and compressed. Timesteps are compressed in a thread pool as
+    soon as they are written, while the next ones are being written. Failed frames are left empty, marked skipped
+    and listed in idx_dir/skipped_frames.json; they are tried again on the next run.
+    :param np.ndarray idx_calls: idx calls as returned by idx_schedule.build_idx_calls, call i is written to timestep i
+    :param str idx_dir: directory of firesmoke.idx, created if it doesn't exist
+    :param str firesmoke_dir: directory of the NetCDF files
+    :param dict max_grid: grid all data is resampled to
+    :param scipy.sparse.csr_matrix resample_op: operator resampling the smaller grid to max_grid
+    :param float thresh: resampled values smaller than this are set to 0
+    :param list timesteps: timesteps to write, None for all of idx_calls
+    :param str compression: codec of the IDX blocks, one of idx_compress.CODECS (see idx_compress.benchmark_codecs)
+    :param int compress_workers: number of compressing threads, None for one per core
+    :param bool time_major: also keep the time-major sidecar idx_dir/time_major up to date (see idx_time_major),
+                            timesteps written by earlier runs without it are copied from the IDX; without it, the
+                            timesteps an existing sidecar has are still marked missing when they are rewritten
+    :param bool aggregates: also update the daily and monthly aggregates of the days written (see idx_aggregates)
+    :param stream_kwargs: passed on to idx_pipeline.stream_frames (max_workers, frames_per_task, max_in_flight)
+    """
+    os.makedirs(idx_dir, exist_ok=True)
+    journal = ConversionJournal(f"{idx_dir}/{JOURNAL}")
+    if timesteps is None:
+        timesteps = range(len(idx_calls))
+
+    # only read what the journal doesn't have written already, a timestep that was being written
+    # when the last run stopped may be partially written, so it is cleared first
+    to_write = [int(t) for t in timesteps if not journal.has(int(t), idx_calls[t], ('written', 'compressed'))]
+    logger.info(f"{len(timesteps) - len(to_write)} of {len(timesteps)} timesteps already written, {len(to_write)} to write")
+
+    sidecar_path = f"{idx_dir}/{TIME_MAJOR}"
+    sidecar = None
+    if time_major or os.path.exists(f"{sidecar_path}/{TIME_MAJOR_META}"):
+        sidecar = TimeMajorWriter(sidecar_path, (max_grid['ROW'], max_grid['COL']))
+        # the sidecar's copies of the timesteps cleared here, or dropped from the time range, are stale even when
+        # this run doesn't update the sidecar; readers fall back to the IDX for them until they are written again
+        sidecar.invalidate(to_write + list(range(len(idx_calls), len(sidecar.filled))))
+        if not time_major:
+            sidecar = None
+
+    db = open_idx(f"{idx_dir}/firesmoke.idx", [max_grid['COL'], max_grid['ROW']], len(idx_calls))
+    # write raw blocks, OpenVisus would otherwise compress them in the writing thread
+    db = set_default_compression(db, '')
+    field = db.getField('PM25')
+    clear_timesteps(db, to_write)
+    for t in to_write:
+        journal.schedule(t, idx_calls[t])
+
+    stage = CompressionStage(db, compression, max_workers=compress_workers)
+
+    def record_compressed(done):
+        # compression failures leave the timestep written uncompressed, it is compressed again on the next run
+        for t, error in done:
+            if error is None:
+                journal.update(t, status='compressed')
+            else:
+                journal.update(t, error=error)
+
+    # frames come back in timestep order, a bounded number at a time
+    for i, data, error in stream_frames(idx_calls[to_write], firesmoke_dir, max_grid, resample_op, thresh,
+                                        **stream_kwargs):
+        t = to_write[i]
+        if data is None:
+            journal.update(t, status='skipped', error=error)
+            if sidecar is not None:
+                # the IDX timestep was cleared, it reads as 0
+                sidecar.write(t, np.zeros(sidecar.shape, dtype=sidecar.dtype))
+            continue
+        journal.update(t, status='resampled')
+        db.write(data=data, field=field, time=t)
+        journal.update(t, status='written')
+        if sidecar is not None:
+            sidecar.write(t, data)
+        # the timestep's files are complete, compress them while the next frames are written
+        stage.submit(t)
+        record_compressed(stage.completed())
+        if (i + 1) % 1000 == 0:
+            logger.info(f"Wrote {i + 1} of {len(to_write)} timesteps")
+
+    # also compress what an interrupted run wrote but didn't compress
+    submitted = set(to_write)
+    for t in timesteps:
+        t = int(t)
+        if t not in submitted and journal.has(t, idx_calls[t], ('written',)):
+            stage.submit(t)
+            record_compressed(stage.completed())
+    record_compressed(stage.close())
+    db = set_default_compression(db, compression)
+
+    if sidecar is not None:
+        # timesteps written before the sidecar was enabled, or by a run interrupted before it saved them
+        written = [t for t, entry in journal.entries.items()
+                   if t < len(idx_calls) and entry['status'] in ('written', 'compressed', 'skipped')]
+        sidecar.backfill(db, written)
+        sidecar.close()
+
+    if aggregates:
+        # days whose hours changed, or that gained or lost hours, are aggregated again
+        valid = [t for t, entry in journal.entries.items()
+                 if t < len(idx_calls) and entry['status'] in ('written', 'compressed')]
+        update_aggregates(idx_dir, db, idx_calls, valid, changed=to_write, compression=compression)
+
+    # machine readable list of the frames that are missing from the IDX
+    skipped = [entry for entry in journal.skipped() if entry['timestep'] < len(idx_calls)]
+    with open(f"{idx_dir}/{SKIPPED_REPORT}.part", mode="w") as f:
+        json.dump(skipped, f, indent=1)
+    os.replace(f"{idx_dir}/{SKIPPED_REPORT}.part", f"{idx_dir}/{SKIPPED_REPORT}")
+
+    logger.info(f"Conversion done: {journal.counts()}, skipped frames in {idx_dir}/{SKIPPED_REPORT}")
+    journal.close()
+    return journal
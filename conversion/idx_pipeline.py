@@ -0,0 +1,125 @@
+### Read and resample the frames of idx_calls in worker processes, handing them to the IDX writer in order. ###
+# The parallel v5 conversion resampled frames in a thread pool (GIL bound) and kept every frame in a results list
+# until all were done, holding the whole archive in RAM before writing it. Here frames are read and resampled in
+# processes, which place them in a ring of shared memory slots, and stream_frames yields them in timestep order as
+# soon as the next one is ready. At most max_in_flight frames exist at once, however long the archive is.
+# Consecutive hours mostly come from the same file, so each task reads all the frames of one file it needs at once.
+
+## Import libs
+import concurrent.futures
+import logging
+import os
+from multiprocessing import shared_memory
+import numpy as np
+import xarray as xr
+
+from idx_schedule import group_by_file
+from regrid import regrid
+
+logger = logging.getLogger(__name__)
+
+# state of a worker process, set once by _init_worker instead of being sent with every call
+_worker = {}
+
+
+def read_frames(path, tstep_indices, max_grid, resample_op, thresh):
+    """
+    Return PM25 at the given TSTEPs of the NetCDF file at path, resampled to max_grid if it is on another grid
+    The file is opened once and only the requested TSTEPs are read, as an array of shape (len(tstep_indices), ROW, COL).
+    :param str path: path of the NetCDF file
+    :param list tstep_indices: indices of the TSTEPs to read
+    :param dict max_grid: grid all data is resampled to
+    :param scipy.sparse.csr_matrix resample_op: operator resampling the smaller grid to max_grid
+    :param float thresh: resampled values smaller than this are set to 0
+    """
+    with xr.open_dataset(path) as ds:
+        # PM25 is (TSTEP, LAY, ROW, COL) with a single LAY, only read the TSTEPs we write
+        file_vals = np.ascontiguousarray(ds['PM25'][list(tstep_indices), 0].values)
+        resamp = ds.XORIG != max_grid['XORIG']
+    if not resamp:
+        return file_vals
+    # all frames of the file in one sparse mat-mat
+    file_vals_resamp = regrid(resample_op, file_vals, max_grid)
+    file_vals_resamp[file_vals_resamp < thresh] = 0
+    return file_vals_resamp
+
+
+def _init_worker(shm_name, shape, firesmoke_dir, max_grid, resample_op, thresh):
+    """
+    Attach a worker process to the shared frame slots and keep the conversion parameters
+    """
+    # workers share the parent's resource tracker, the parent unlinks the block once the conversion is done
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker.update(shm=shm, slots=np.ndarray(shape, dtype=np.float32, buffer=shm.buf), firesmoke_dir=firesmoke_dir,
+                   max_grid=max_grid, resample_op=resample_op, thresh=thresh)
+
+
+def _convert_calls(file_name, tstep_indices, slots):
+    """
+    Read and resample frames of one file into their shared memory slots, return None or the error that prevented it
+    """
+    try:
+        _worker['slots'][slots] = read_frames(f"{_worker['firesmoke_dir']}/{file_name}", tstep_indices,
+                                              _worker['max_grid'], _worker['resample_op'], _worker['thresh'])
+        return None
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def stream_frames(idx_calls, firesmoke_dir, max_grid, resample_op, thresh, max_workers=None, frames_per_task=6,
+                  max_in_flight=None):
+    """
+    Yield (i, frame, error) for every idx call in order, frame is None and error says why if the call failed
+    Consecutive calls reading from the same file are handled by one task, which opens the file once.
+    The frame is a view into shared memory that is reused once the next frame is requested,
+    so write (or copy) it before moving on.
+    :param np.ndarray idx_calls: idx calls as returned by idx_schedule.build_idx_calls
+    :param str firesmoke_dir: directory of the NetCDF files
+    :param dict max_grid: grid all data is resampled to
+    :param scipy.sparse.csr_matrix resample_op: operator resampling the smaller grid to max_grid
+    :param float thresh: resampled values smaller than this are set to 0
+    :param int max_workers: number of worker processes, None for one per core
+    :param int frames_per_task: most frames of the same file read by one task, forecasts are 6 hours apart
+    :param int max_in_flight: number of frames being read or waiting to be written at once,
+                              None for 2 tasks per worker, at least frames_per_task
+    """
+    max_workers = max_workers or os.cpu_count()
+    num_slots = max(max_in_flight or 2 * max_workers * frames_per_task, frames_per_task)
+    shape = (num_slots, int(max_grid['ROW']), int(max_grid['COL']))
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+    slots = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    # every worker gets the slots and the parameters shared by all calls once, when it starts
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker,
+        initargs=(shm.name, shape, firesmoke_dir, max_grid, resample_op, thresh))
+
+    runs = group_by_file(idx_calls, frames_per_task)
+    # the future of the task reading each call
+    futures = {}
+    next_run = 0
+
+    def submit_runs(last_yielded):
+        # call i uses slot i % num_slots, which is free once call i - num_slots was yielded and written
+        nonlocal next_run
+        while next_run < len(runs) and runs[next_run][1] - 1 <= last_yielded + num_slots:
+            start, stop = runs[next_run]
+            future = executor.submit(_convert_calls, str(idx_calls['file'][start]), idx_calls['tstep'][start:stop].tolist(),
+                                     [i % num_slots for i in range(start, stop)])
+            futures.update((i, future) for i in range(start, stop))
+            next_run += 1
+
+    try:
+        submit_runs(-1)
+        for i in range(len(idx_calls)):
+            error = futures.pop(i).result()
+            if error is None:
+                yield i, slots[i % num_slots], None
+            else:
+                logger.error(f"Failed to read {idx_calls[i]['file']} TFLAG[{idx_calls[i]['tstep']}]: {error}")
+                yield i, None, error
+            submit_runs(i)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        del slots
+        shm.close()
+        shm.unlink()
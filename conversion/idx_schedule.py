@@ -0,0 +1,106 @@
+### Build the sequence of idx calls: which NetCDF file and TSTEP represents each hour of the IDX file. ###
+# For every hour we use the most recently created forecast (CDATETIME) that covers it, looking at files created
+# up to `search_days` days before or after the hour's date. Rather than searching the file table hour by hour,
+# we turn every file into the interval of hours it may represent and resolve all hours in one vectorized pass.
+
+## Import libs
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# one idx call: the file to open, the hour it represents and the index of that hour in the file's TFLAG/TSTEP axis
+# call['file'], call['time'], call['tstep'] (or call[0], call[1], call[2] like the lists we used to pickle)
+IDX_CALL_DTYPE = np.dtype([('file', 'U32'), ('time', 'datetime64[s]'), ('tstep', 'i2')])
+
+ONE_HOUR = np.timedelta64(1, 'h')
+ONE_DAY = np.timedelta64(1, 'D')
+
+
+def build_idx_calls(catalog_df, start_date, end_date, search_days=4):
+    """
+    Return the idx calls for every hour from start_date 00:00 to end_date 23:00, as a structured array of IDX_CALL_DTYPE
+    Hours no file covers are left out, so the i'th call is written to timestep i of the IDX file. Timesteps are thus
+    positions in the schedule, not fixed hours: covering a missing hour later shifts every call after it.
+    :param pd.DataFrame catalog_df: catalog as returned by firesmoke_catalog.load_catalog (sorted by CDATETIME)
+    :param datetime start_date: first day of the sequence
+    :param datetime end_date: last day of the sequence
+    :param int search_days: files created at most this many days before or after an hour's date may represent it
+    """
+    hours = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + ONE_DAY, ONE_HOUR).astype('datetime64[s]')
+    start = hours[0]
+
+    # interval of hours each file may represent: the hours it has TFLAGs for,
+    # restricted to dates at most search_days away from the date the file was created
+    cdate = catalog_df['CDATETIME'].to_numpy().astype('datetime64[D]')
+    tflag_0 = catalog_df['tflag_0'].to_numpy().astype('datetime64[s]')
+    tflag_last = catalog_df['tflag_last'].to_numpy().astype('datetime64[s]')
+    lo = np.maximum(tflag_0, (cdate - search_days * ONE_DAY).astype('datetime64[s]'))
+    hi = np.minimum(tflag_last, (cdate + (search_days + 1) * ONE_DAY).astype('datetime64[s]') - np.timedelta64(1, 's'))
+
+    # as indices into hours, rounding inwards
+    lo_idx = np.clip(-((start - lo) // ONE_HOUR), 0, len(hours))
+    hi_idx = np.clip((hi - start) // ONE_HOUR, -1, len(hours) - 1)
+    lengths = np.maximum(hi_idx - lo_idx + 1, 0)
+
+    # expand every file into the (file, hour) pairs it covers, and keep the most recent file of each hour;
+    # rows are sorted by CDATETIME, so the most recent file is the one with the largest row index
+    file_idx = np.repeat(np.arange(len(catalog_df)), lengths)
+    hour_idx = np.repeat(lo_idx, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    best = np.full(len(hours), -1)
+    np.maximum.at(best, hour_idx, file_idx)
+
+    found = best >= 0
+    logger.info(f"{found.sum()} of {len(hours)} hours from {hours[0]} to {hours[-1]} covered, {len(hours) - found.sum()} missing")
+
+    idx_calls = np.empty(found.sum(), dtype=IDX_CALL_DTYPE)
+    idx_calls['file'] = catalog_df['file'].to_numpy()[best[found]]
+    idx_calls['time'] = hours[found]
+    # the number of hours between the file's 0th TFLAG and the hour is the TSTEP index
+    idx_calls['tstep'] = (hours[found] - tflag_0[best[found]]) // ONE_HOUR
+    return idx_calls
+
+
+def missing_hours(idx_calls, start_date, end_date):
+    """
+    Return the hours from start_date 00:00 to end_date 23:00 that have no idx call, as datetime64
+    :param np.ndarray idx_calls: idx calls as returned by build_idx_calls
+    :param datetime start_date: first day of the sequence
+    :param datetime end_date: last day of the sequence
+    """
+    hours = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + ONE_DAY, ONE_HOUR).astype('datetime64[s]')
+    return np.setdiff1d(hours, idx_calls['time'])
+
+
+def group_by_file(idx_calls, max_size=None):
+    """
+    Return the runs of consecutive idx calls that read from the same file, as a list of (start, stop) index pairs
+    Consecutive hours almost always come from the same file, so readers can open each file once per run.
+    :param np.ndarray idx_calls: idx calls as returned by build_idx_calls
+    :param int max_size: split runs longer than this, None to not split
+    """
+    # a new run starts wherever the file differs from the previous call's
+    starts = np.flatnonzero(np.r_[True, idx_calls['file'][1:] != idx_calls['file'][:-1]]) if len(idx_calls) else np.empty(0, int)
+    stops = np.r_[starts[1:], len(idx_calls)]
+    runs = []
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        step = max_size or stop - start
+        runs.extend((s, min(s + step, stop)) for s in range(start, stop, step))
+    return runs
+
+
+def save_idx_calls(path, idx_calls):
+    """
+    Save idx calls to a .npy file
+    :param str path: path of the .npy file
+    :param np.ndarray idx_calls: idx calls as returned by build_idx_calls
+    """
+    np.save(path, idx_calls)
+
+
+def load_idx_calls(path):
+    """
+    Return the idx calls saved at path with save_idx_calls
+    :param str path: path of the .npy file
+    """
+    return np.load(path)
@@ -0,0 +1,134 @@
+### Time-major copy of firesmoke.idx, for reading the history of one location without a query per timestep. ###
+# IDX files are laid out frame by frame: every timestep is in its own files, so the PM25 history of one city over
+# two years means one query, and a block decode, for each of ~17500 timesteps. The sidecar written here stores the
+# same values time-major, one (ROW, COL, chunk) .npy per chunk of consecutive timesteps, so that history is one
+# contiguous read per chunk. The OpenVisus xarray backend (data_quality/metadata_creation/backend_v3.py) reads it
+# when it finds it next to the IDX. It isn't compressed and takes ~1.6 MB per timestep, so it is optional.
+
+## Import libs
+import json
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# directory of the sidecar in the IDX directory, its description and which timesteps it has; read by backend_v3.py
+TIME_MAJOR = "time_major"
+TIME_MAJOR_META = "time_major.json"
+TIME_MAJOR_FILLED = "filled.npy"
+
+# timesteps per chunk file, a day of hourly timesteps
+TIME_MAJOR_CHUNK = 24
+
+
+def _save_npy(path, array):
+    # write to a temporary file and rename it, so readers never see a partial file
+    with open(path + ".part", mode="wb") as f:
+        np.save(f, array)
+    os.replace(path + ".part", path)
+
+
+class TimeMajorWriter:
+    """
+    Writer of the time-major sidecar of an IDX, frames can be written in any order
+    Frames of the same chunk are kept until a frame of another chunk is written (or flush is called), then the chunk
+    file is rewritten with them, so frames written in timestep order write every chunk once. The timesteps the
+    sidecar has are recorded in filled.npy after their chunk is saved, readers fall back to the IDX for the others.
+    """
+
+    def __init__(self, path, shape, field_name='PM25', chunk=TIME_MAJOR_CHUNK, dtype=np.float32):
+        """
+        :param str path: directory of the sidecar, created if it doesn't exist
+        :param tuple shape: (ROW, COL) shape of the frames
+        :param str field_name: IDX field the sidecar is a copy of
+        :param int chunk: timesteps per chunk file, only used when the sidecar is created
+        :param dtype: dtype of the frames
+        """
+        self.path = path
+        meta = {'field': field_name, 'shape': [int(n) for n in shape], 'chunk': int(chunk),
+                'dtype': np.dtype(dtype).name}
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(f"{path}/{TIME_MAJOR_META}"):
+            with open(f"{path}/{TIME_MAJOR_META}") as f:
+                existing = json.load(f)
+            if existing['field'] != meta['field'] or existing['shape'] != meta['shape'] or existing['dtype'] != meta['dtype']:
+                raise ValueError(f"{path} holds {existing}, not {meta}, delete it to write a new sidecar")
+            meta = existing
+        else:
+            with open(f"{path}/{TIME_MAJOR_META}.part", mode="w") as f:
+                json.dump(meta, f)
+            os.replace(f"{path}/{TIME_MAJOR_META}.part", f"{path}/{TIME_MAJOR_META}")
+        self.shape = tuple(meta['shape'])
+        self.chunk = meta['chunk']
+        self.dtype = np.dtype(meta['dtype'])
+        filled_path = f"{path}/{TIME_MAJOR_FILLED}"
+        self.filled = np.load(filled_path) if os.path.exists(filled_path) else np.zeros(0, dtype=bool)
+        # chunk -> {timestep: frame} of the frames not saved yet
+        self.pending = {}
+
+    def write(self, timestep, frame):
+        """Write frame as timestep, copying it, so it can be reused right away"""
+        chunk = timestep // self.chunk
+        if self.pending and chunk not in self.pending:
+            self.flush()
+        self.pending.setdefault(chunk, {})[int(timestep)] = np.array(frame, dtype=self.dtype)
+
+    def flush(self):
+        """Save the chunks of the frames written since the last flush"""
+        if not self.pending:
+            return
+        for chunk, frames in self.pending.items():
+            chunk_path = f"{self.path}/{chunk:06d}.npy"
+            if os.path.exists(chunk_path):
+                data = np.load(chunk_path)
+            else:
+                data = np.zeros(self.shape + (self.chunk,), dtype=self.dtype)
+            for timestep, frame in frames.items():
+                data[:, :, timestep % self.chunk] = frame
+            _save_npy(chunk_path, data)
+
+        written = [t for frames in self.pending.values() for t in frames]
+        if max(written) >= len(self.filled):
+            self.filled = np.concatenate([self.filled, np.zeros(max(written) + 1 - len(self.filled), dtype=bool)])
+        self.filled[written] = True
+        _save_npy(f"{self.path}/{TIME_MAJOR_FILLED}", self.filled)
+        self.pending = {}
+
+    def missing(self, timesteps):
+        """Return the timesteps the sidecar doesn't have, nor has pending"""
+        pending = {t for frames in self.pending.values() for t in frames}
+        return [int(t) for t in timesteps
+                if int(t) not in pending and (int(t) >= len(self.filled) or not self.filled[int(t)])]
+
+    def invalidate(self, timesteps):
+        """
+        Mark timesteps as missing from the sidecar, e.g. before their IDX timesteps are cleared or rewritten
+        Readers then read them from the IDX until they are written to the sidecar again.
+        """
+        timesteps = [int(t) for t in timesteps]
+        for frames in self.pending.values():
+            for t in timesteps:
+                frames.pop(t, None)
+        self.pending = {chunk: frames for chunk, frames in self.pending.items() if frames}
+        timesteps = [t for t in timesteps if t < len(self.filled)]
+        if timesteps and self.filled[timesteps].any():
+            self.filled[timesteps] = False
+            _save_npy(f"{self.path}/{TIME_MAJOR_FILLED}", self.filled)
+
+    def backfill(self, db, timesteps, field_name='PM25'):
+        """
+        Copy the timesteps the sidecar doesn't have from the IDX, e.g. to build the sidecar of an existing IDX
+        :param PyDataset db: the IDX
+        :param list timesteps: timesteps the sidecar should have
+        :param str field_name: field to read
+        """
+        missing = self.missing(timesteps)
+        if missing:
+            logger.info(f"Copying {len(missing)} timesteps from the IDX to {self.path}")
+        for t in sorted(missing):
+            self.write(t, db.read(time=t, field=field_name))
+        self.flush()
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,178 @@
+### Precomputed sparse regridding operators between the regular lat/lon grids of the UBC Firesmoke files. ###
+# Resampling used to call scipy's griddata(..., method='cubic') on every small grid frame, which triangulates the
+# whole 381x1041 grid every time. Both grids are fixed and regular, so the interpolation weights only depend on the
+# (source grid, target grid) pair: we compute them once per axis, combine them into a sparse matrix and cache it on
+# disk. Resampling a frame is then one sparse mat-vec, and many frames at once one sparse mat-mat.
+
+## Import libs
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+import scipy.sparse
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('bilinear', 'cubic', 'conservative')
+
+# coordinates closer than this fraction of a cell are treated as the same point
+SNAP = 1e-6
+
+
+def grid_axes(grid):
+    """
+    Return the (lon, lat) cell coordinates of grid, as two 1D arrays
+    :param dict grid: grid with keys COL, ROW, XORIG, YORIG, XCELL, YCELL, e.g. a row of firesmoke_catalog.grid_signatures
+    """
+    lon = np.linspace(grid['XORIG'], grid['XORIG'] + grid['XCELL'] * (grid['COL'] - 1), int(grid['COL']))
+    lat = np.linspace(grid['YORIG'], grid['YORIG'] + grid['YCELL'] * (grid['ROW'] - 1), int(grid['ROW']))
+    return lon, lat
+
+
+def bilinear_weights(src, dst):
+    """
+    Return the sparse (len(dst), len(src)) matrix linearly interpolating values at regularly spaced src to dst
+    Points of dst outside of src get no weights, i.e. resample to 0 like griddata's fill_value=0.
+    :param np.ndarray src: regularly spaced source coordinates
+    :param np.ndarray dst: target coordinates
+    """
+    step = src[1] - src[0]
+    pos = (dst - src[0]) / step
+    # snap to source points, so points shared by both grids are copied exactly
+    pos = np.where(np.abs(pos - np.round(pos)) < SNAP, np.round(pos), pos)
+    inside = (pos >= 0) & (pos <= len(src) - 1)
+    rows = np.flatnonzero(inside)
+    i = np.minimum(np.floor(pos[inside]).astype(int), len(src) - 2)
+    frac = pos[inside] - i
+    return _sparse(len(dst), len(src), np.concatenate([rows, rows]), np.concatenate([i, i + 1]),
+                   np.concatenate([1 - frac, frac]))
+
+
+def cubic_weights(src, dst, a=-0.5):
+    """
+    Return the sparse (len(dst), len(src)) matrix interpolating values at regularly spaced src to dst with cubic convolution
+    Uses the Keys kernel (4 neighbours), repeating edge values at the border of src. Points of dst outside of src
+    get no weights.
+    ref: https://en.wikipedia.org/wiki/Bicubic_interpolation#Bicubic_convolution_algorithm
+    :param np.ndarray src: regularly spaced source coordinates
+    :param np.ndarray dst: target coordinates
+    :param float a: Keys kernel parameter, -0.5 reproduces quadratics
+    """
+    step = src[1] - src[0]
+    pos = (dst - src[0]) / step
+    pos = np.where(np.abs(pos - np.round(pos)) < SNAP, np.round(pos), pos)
+    inside = (pos >= 0) & (pos <= len(src) - 1)
+    rows = np.flatnonzero(inside)
+    i = np.floor(pos[inside]).astype(int)
+    frac = pos[inside] - i
+
+    all_rows, all_cols, all_weights = [], [], []
+    for offset in (-1, 0, 1, 2):
+        x = np.abs(frac - offset)
+        weights = np.where(x <= 1, (a + 2) * x ** 3 - (a + 3) * x ** 2 + 1,
+                           np.where(x < 2, a * x ** 3 - 5 * a * x ** 2 + 8 * a * x - 4 * a, 0))
+        all_rows.append(rows)
+        all_cols.append(np.clip(i + offset, 0, len(src) - 1))
+        all_weights.append(weights)
+    return _sparse(len(dst), len(src), np.concatenate(all_rows), np.concatenate(all_cols), np.concatenate(all_weights))
+
+
+def conservative_weights(src, dst):
+    """
+    Return the sparse (len(dst), len(src)) matrix averaging the src cells each dst cell overlaps, weighted by overlap
+    Cells are centered on the coordinates. Parts of a dst cell outside of src count as 0.
+    :param np.ndarray src: regularly spaced source coordinates
+    :param np.ndarray dst: regularly spaced target coordinates
+    """
+    src_step, dst_step = src[1] - src[0], dst[1] - dst[0]
+    src_lo, src_hi = src - src_step / 2, src + src_step / 2
+    dst_lo, dst_hi = dst - dst_step / 2, dst + dst_step / 2
+
+    # for every dst cell, the range of src cells that may overlap it
+    first = np.clip(np.floor((dst_lo - src_lo[0]) / src_step).astype(int), 0, len(src))
+    last = np.clip(np.ceil((dst_hi - src_lo[0]) / src_step).astype(int), 0, len(src))
+    counts = last - first
+    rows = np.repeat(np.arange(len(dst)), counts)
+    cols = np.repeat(first, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+
+    overlap = np.minimum(dst_hi[rows], src_hi[cols]) - np.maximum(dst_lo[rows], src_lo[cols])
+    weights = np.clip(overlap / dst_step, 0, 1)
+    weights = np.where(np.abs(weights - np.round(weights)) < SNAP, np.round(weights), weights)
+    return _sparse(len(dst), len(src), rows, cols, weights)
+
+
+def _sparse(num_rows, num_cols, rows, cols, weights):
+    """
+    Return a CSR matrix from COO entries, summing duplicates and dropping zero weights
+    """
+    keep = weights != 0
+    return scipy.sparse.csr_matrix((weights[keep], (rows[keep], cols[keep])), shape=(num_rows, num_cols))
+
+
+AXIS_WEIGHTS = {'bilinear': bilinear_weights, 'cubic': cubic_weights, 'conservative': conservative_weights}
+
+
+def build_operator(src_grid, dst_grid, method='bilinear'):
+    """
+    Return the sparse (dst cells, src cells) matrix resampling row major frames on src_grid to dst_grid
+    The grids are regular, so the operator is the Kronecker product of the lat and lon operators.
+    :param dict src_grid: grid of the data, with keys COL, ROW, XORIG, YORIG, XCELL, YCELL
+    :param dict dst_grid: grid to resample to
+    :param str method: one of 'bilinear', 'cubic' or 'conservative'
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown regridding method {method}, expected one of {METHODS}")
+    src_lon, src_lat = grid_axes(src_grid)
+    dst_lon, dst_lat = grid_axes(dst_grid)
+    weights = AXIS_WEIGHTS[method]
+    # frames are (ROW, COL) flattened row major, so cell (r, c) is r * COL + c
+    return scipy.sparse.kron(weights(src_lat, dst_lat), weights(src_lon, dst_lon), format='csr').astype(np.float32)
+
+
+def operator_key(src_grid, dst_grid, method):
+    """
+    Return a short hash identifying the operator for the given grids and method, used as its cache file name
+    """
+    keys = ['COL', 'ROW', 'XORIG', 'YORIG', 'XCELL', 'YCELL']
+    description = json.dumps([method, [float(src_grid[k]) for k in keys], [float(dst_grid[k]) for k in keys]])
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+def regrid_operator(src_grid, dst_grid, method='bilinear', cache_dir=None):
+    """
+    Return the operator resampling src_grid to dst_grid, loading it from cache_dir or building and caching it there
+    :param dict src_grid: grid of the data, with keys COL, ROW, XORIG, YORIG, XCELL, YCELL
+    :param dict dst_grid: grid to resample to
+    :param str method: one of 'bilinear', 'cubic' or 'conservative'
+    :param str cache_dir: directory of cached operators, None to not cache
+    """
+    path = None
+    if cache_dir is not None:
+        path = f"{cache_dir}/regrid_{method}_{operator_key(src_grid, dst_grid, method)}.npz"
+        if os.path.exists(path):
+            return scipy.sparse.load_npz(path)
+
+    operator = build_operator(src_grid, dst_grid, method)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # save under a temporary name first, so concurrent conversions never load half an operator
+        tmp_path = f"{path}.{os.getpid()}.part.npz"
+        scipy.sparse.save_npz(tmp_path, operator)
+        os.replace(tmp_path, path)
+        logger.info(f"Cached {method} regridding operator at {path}")
+    return operator
+
+
+def regrid(operator, data, dst_grid):
+    """
+    Return data resampled with operator, as float32 frames on dst_grid
+    :param scipy.sparse.csr_matrix operator: operator as returned by regrid_operator
+    :param np.ndarray data: one frame of shape (ROW, COL), or a stack of frames of shape (N, ROW, COL)
+    :param dict dst_grid: grid the operator resamples to
+    """
+    frames = np.asarray(data, dtype=np.float32)
+    flat = frames.reshape(-1, operator.shape[1])
+    # one sparse mat-mat for all frames
+    resampled = np.ascontiguousarray((operator @ flat.T).T)
+    return resampled.reshape(frames.shape[:-2] + (int(dst_grid['ROW']), int(dst_grid['COL'])))
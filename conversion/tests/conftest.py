@@ -0,0 +1,5 @@
+# the conversion modules are flat scripts importing each other by name, as when run from conversion/
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,97 @@
+import os
+import sys
+
+import netCDF4
+import numpy as np
+import xarray as xr
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import LoadDataset
+
+from idx_job import run_conversion
+from idx_time_major import TIME_MAJOR
+from test_idx_job import GRID, fake_frames, frame_of, make_idx_calls
+
+# the xarray backend reading the IDX lives in data_quality/metadata_creation
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data_quality', 'metadata_creation'))
+import backend_v3
+from backend_v3 import OpenVisusBackendArray, OpenVisusBackendEntrypoint, TimeMajorReader
+
+
+def backend_array(idx_dir, num_timesteps, time_major=None):
+    db = LoadDataset(f"{idx_dir}/firesmoke.idx")
+    return OpenVisusBackendArray(db, (num_timesteps, GRID['ROW'], GRID['COL'], db.getMaxResolution() + 1),
+                                 np.float32, None, None, 'PM25', time_major=time_major)
+
+
+def write_metadata(path, idx_dir):
+    # the tiny NetCDF the backend is opened with, pointing to the IDX
+    with netCDF4.Dataset(path, mode="w") as nc:
+        nc.createDimension('ROW', GRID['ROW'])
+        nc.createDimension('COL', GRID['COL'])
+        nc.createVariable('PM25', 'f4', ('ROW', 'COL'))
+        nc.idx_url = f"{idx_dir}/firesmoke.idx"
+
+
+def read_frame(array, timestep):
+    # full resolution frame of timestep, one frame at a time is read through the cache of tiles
+    return array._raw_indexing_method((timestep, slice(None), slice(None), array.db.getMaxResolution()))
+
+
+def cache_keys():
+    with backend_v3.cache.lock:
+        return list(backend_v3.cache.entries)
+
+
+def test_cached_tiles_of_rewritten_timesteps_are_dropped(tmp_path, fake_frames):
+    idx_dir = str(tmp_path / "idx")
+    idx_calls = make_idx_calls(4)
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1)
+    array = backend_array(idx_dir, 4)
+    for t in range(4):
+        np.testing.assert_array_equal(read_frame(array, t), frame_of(idx_calls[t]))
+    source = array.last_source
+    assert any(key[0] == source for key in cache_keys())
+
+    # a newer forecast covers timestep 2, the long-lived array reads it without being opened again
+    idx_calls['file'][2] = 'newer.nc'
+    idx_calls['tstep'][2] = 102
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1)
+    np.testing.assert_array_equal(read_frame(array, 2), frame_of(idx_calls[2], version=1))
+    np.testing.assert_array_equal(read_frame(array, 1), frame_of(idx_calls[1]))
+    assert array.last_source != source
+    assert not any(key[0] == source for key in cache_keys())
+
+
+def test_sidecar_of_timesteps_rewritten_without_it_is_not_read(tmp_path, fake_frames):
+    idx_dir = str(tmp_path / "idx")
+    idx_calls = make_idx_calls(4)
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1, time_major=True)
+    sidecar = TimeMajorReader(f"{idx_dir}/{TIME_MAJOR}")
+    out = np.empty((4, GRID['ROW'], GRID['COL']), dtype=np.float32)
+    assert sidecar.read('PM25', range(4), (0, 0, GRID['COL'], GRID['ROW']), out)
+
+    # a later run without the sidecar rewrites timestep 2, the sidecar no longer answers for it
+    idx_calls['file'][2] = 'newer.nc'
+    idx_calls['tstep'][2] = 102
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1, time_major=False)
+    assert not sidecar.read('PM25', range(4), (0, 0, GRID['COL'], GRID['ROW']), out)
+    assert sidecar.read('PM25', [0, 1, 3], (0, 0, GRID['COL'], GRID['ROW']), out[:3])
+
+    # the series of a small box falls back to the IDX, and reads the new frame
+    array = backend_array(idx_dir, 4, time_major=sidecar)
+    series = array._raw_indexing_method((slice(0, 4), slice(2, 4), slice(5, 6), array.db.getMaxResolution()))
+    np.testing.assert_array_equal(series, [frame_of(call, version=int(call['tstep']) // 100)[2:4, 5:6]
+                                           for call in idx_calls])
+
+
+def test_resolution_0_reads_the_full_grid(tmp_path, fake_frames):
+    idx_dir = str(tmp_path / "idx")
+    idx_calls = make_idx_calls(3)
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1)
+    write_metadata(str(tmp_path / "firesmoke_metadata.nc"), idx_dir)
+
+    # data_resolution = 0 is the highest resolution, as in the demos and the dashboard
+    pm25 = xr.open_dataset(str(tmp_path / "firesmoke_metadata.nc"), engine=OpenVisusBackendEntrypoint)['PM25']
+    for frame in (pm25.loc[1, :, :, 0], pm25[1, :, :, 0]):
+        assert frame.shape == (GRID['ROW'], GRID['COL'])
+        np.testing.assert_array_equal(frame.values, frame_of(idx_calls[1]))
@@ -0,0 +1,52 @@
+import os
+
+import netCDF4
+import numpy as np
+
+from firesmoke_catalog import grid_signatures, load_catalog, update_catalog
+
+
+def write_dispersion(path, cdate, ctime, tflags, cols=1081):
+    # minimal dispersion.nc: grid attributes, creation time and a (TSTEP, VAR, DATE-TIME) TFLAG
+    with netCDF4.Dataset(path, mode="w") as nc:
+        nc.createDimension('TSTEP', len(tflags))
+        nc.createDimension('VAR', 1)
+        nc.createDimension('DATE-TIME', 2)
+        nc.createDimension('ROW', 381)
+        nc.createDimension('COL', cols)
+        nc.setncatts({'XORIG': -160.0, 'YORIG': 32.0, 'XCELL': 0.1, 'YCELL': 0.1, 'CDATE': cdate, 'CTIME': ctime})
+        tflag = nc.createVariable('TFLAG', 'i4', ('TSTEP', 'VAR', 'DATE-TIME'))
+        tflag[:] = np.asarray(tflags, dtype=np.int32)[:, None, :]
+
+
+def test_update_catalog_scans_only_new_and_modified_files(tmp_path):
+    data_dir, catalog = tmp_path / "data", str(tmp_path / "catalog.sqlite")
+    data_dir.mkdir()
+    write_dispersion(data_dir / "dispersion_2024061_000000.nc", 2024061, 0, [[2024061, 10000], [2024061, 20000]])
+    write_dispersion(data_dir / "dispersion_2024060_120000.nc", 2024060, 120000, [[2024060, 130000]], cols=1041)
+    # an html page saved in place of a missing forecast
+    (data_dir / "dispersion_2024062_000000.nc").write_text("<html>not found</html>")
+    (data_dir / "dispersion_2024063_000000.nc.part").write_bytes(b"unfinished")
+
+    assert update_catalog(catalog, str(data_dir), max_workers=1) == 3
+    assert update_catalog(catalog, str(data_dir), max_workers=1) == 0
+
+    df = load_catalog(catalog)
+    assert df['file'].tolist() == ["dispersion_2024060_120000.nc", "dispersion_2024061_000000.nc"]
+    assert str(df['CDATETIME'][0]) == "2024-02-29 12:00:00"
+    assert str(df['tflag_0'][1]) == "2024-03-01 01:00:00"
+    assert str(df['tflag_last'][1]) == "2024-03-01 02:00:00"
+    assert df['NTSTEPS'].tolist() == [1, 2]
+    assert len(load_catalog(catalog, valid_only=False)) == 3
+
+    grids = grid_signatures(df)
+    assert grids['COL'].tolist() == [1041, 1081] and grids['files'].tolist() == [1, 1]
+
+    # a modified file is scanned again, a removed one is dropped
+    path = data_dir / "dispersion_2024061_000000.nc"
+    write_dispersion(path, 2024061, 0, [[2024061, 10000]])
+    os.utime(path, (1, 1))
+    os.remove(data_dir / "dispersion_2024060_120000.nc")
+    assert update_catalog(catalog, str(data_dir), max_workers=1) == 1
+    df = load_catalog(catalog)
+    assert df['file'].tolist() == ["dispersion_2024061_000000.nc"] and df['NTSTEPS'].tolist() == [1]
@@ -0,0 +1,97 @@
+import json
+
+import numpy as np
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import LoadDataset
+
+from idx_aggregates import (AGGREGATE_IDX, AGGREGATES_META, aggregate_fields, aggregate_frames, combine_aggregates,
+                            period_indices, update_aggregates)
+from idx_incremental import open_idx
+from idx_schedule import IDX_CALL_DTYPE
+
+SHAPE = (8, 16)
+
+
+def synthetic_day(seed=0, hours=24):
+    # hourly frames with a plume that peaks in the afternoon
+    rng = np.random.default_rng(seed)
+    return [(rng.gamma(0.5, 10, SHAPE) * (1 + np.sin(np.pi * h / 24))).astype(np.float32) for h in range(hours)]
+
+
+def check_fields(fields, frames, thresholds):
+    stack = np.stack(frames)
+    np.testing.assert_allclose(fields['mean'], stack.mean(axis=0), rtol=1e-5)
+    np.testing.assert_array_equal(fields['max'], stack.max(axis=0))
+    for t in thresholds:
+        np.testing.assert_array_equal(fields[f"hours_above_{t:g}"], (stack > t).sum(axis=0))
+
+
+def test_aggregate_frames_over_a_day():
+    frames = synthetic_day()
+    fields, hours = aggregate_frames(iter(frames), thresholds=(15, 27.5))
+    assert hours == 24
+    assert sorted(fields) == sorted(name for name, _ in aggregate_fields((15, 27.5)))
+    assert fields['mean'].dtype == np.float32 and fields['hours_above_27.5'].dtype == np.uint16
+    check_fields(fields, frames, (15, 27.5))
+    assert aggregate_frames([]) == (None, 0)
+
+
+def test_combine_aggregates_weights_by_hours():
+    # a full day and a day with only 6 hours combine to the aggregates of all 30 hours
+    day_1, day_2 = synthetic_day(1), synthetic_day(2, hours=6)
+    combined, hours = combine_aggregates([aggregate_frames(day_1), aggregate_frames(day_2)])
+    assert hours == 30
+    check_fields(combined, day_1 + day_2, (15, 27, 35))
+    assert combine_aggregates([]) == (None, 0)
+
+
+def test_period_indices():
+    idx_calls = np.empty(4, dtype=IDX_CALL_DTYPE)
+    idx_calls['time'] = np.array(['2024-01-31T22', '2024-01-31T23', '2024-02-01T00', '2024-02-03T05'], dtype='datetime64[s]')
+    days, months, first_day, first_month = period_indices(idx_calls)
+    assert days.tolist() == [0, 0, 1, 3] and months.tolist() == [0, 0, 1, 1]
+    assert str(first_day) == '2024-01-31' and str(first_month) == '2024-01'
+
+
+def make_hourly_idx(idx_dir, frames):
+    # hourly IDX from 2024-01-31 00:00, one timestep per frame
+    idx_calls = np.empty(len(frames), dtype=IDX_CALL_DTYPE)
+    idx_calls['time'] = np.datetime64('2024-01-31T00', 's') + np.arange(len(frames)) * np.timedelta64(1, 'h')
+    db = open_idx(f"{idx_dir}/firesmoke.idx", [SHAPE[1], SHAPE[0]], len(frames))
+    for t, frame in enumerate(frames):
+        db.write(data=frame, field=db.getField('PM25'), time=t)
+    return db, idx_calls
+
+
+def read_aggregate(idx_dir, period, index, field):
+    return LoadDataset(f"{idx_dir}/{AGGREGATE_IDX[period]}").read(time=index, field=field)
+
+
+def test_update_aggregates_extends_incrementally(tmp_path):
+    idx_dir = str(tmp_path)
+    frames = synthetic_day(3) + synthetic_day(4)
+    db, idx_calls = make_hourly_idx(idx_dir, frames[:30])
+    # hour 5 wasn't converted, it is left out of its day
+    valid = [t for t in range(30) if t != 5]
+    assert update_aggregates(idx_dir, db, idx_calls, valid, compression='') == 2
+    check_fields({name: read_aggregate(idx_dir, 'daily', 0, name) for name, _ in aggregate_fields()},
+                 [frames[t] for t in range(24) if t != 5], (15, 27, 35))
+
+    # nothing changed, nothing is aggregated again
+    assert update_aggregates(idx_dir, db, idx_calls, valid, compression='') == 0
+
+    # the next run adds the rest of February 1st and converts hour 5: both days are updated, and the month of each
+    db, idx_calls = make_hourly_idx(idx_dir, frames)
+    assert update_aggregates(idx_dir, db, idx_calls, list(range(48)), changed=[5] + list(range(30, 48)),
+                             compression='zip') == 2
+    for day in range(2):
+        check_fields({name: read_aggregate(idx_dir, 'daily', day, name) for name, _ in aggregate_fields()},
+                     frames[24 * day:24 * (day + 1)], (15, 27, 35))
+        check_fields({name: read_aggregate(idx_dir, 'monthly', day, name) for name, _ in aggregate_fields()},
+                     frames[24 * day:24 * (day + 1)], (15, 27, 35))
+
+    with open(f"{idx_dir}/{AGGREGATES_META}") as f:
+        meta = json.load(f)
+    assert meta['daily']['start'] == '2024-01-31' and meta['daily']['hours'] == [24, 24]
+    assert meta['monthly']['start'] == '2024-01' and meta['monthly']['hours'] == [24, 24]
+    assert meta['daily']['timesteps'][1] == list(range(24, 48))
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+from idx_compress import (CODECS, COMPRESSION_MASK, block_sizes, compress_file, compress_idx, decode_block,
+                          encode_block, read_blocks, set_default_compression)
+from idx_incremental import open_idx
+
+
+def sample_block(size=2**16 * 4, seed=0):
+    # PM25-like float32 block: mostly zeros, with a plume of random values
+    rng = np.random.default_rng(seed)
+    values = np.zeros(size // 4, dtype=np.float32)
+    values[1000:5000] = rng.gamma(0.5, 10, 4000)
+    return values.tobytes()
+
+
+@pytest.mark.parametrize("compression", list(CODECS))
+def test_encode_decode_round_trip(compression):
+    block = sample_block()
+    encoded = encode_block(block, compression)
+    assert len(encoded) < len(block)
+    assert decode_block(encoded, compression, len(block)) == block
+    assert decode_block(block, '', len(block)) is block
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        encode_block(b"abc", 'snappy')
+    with pytest.raises(ValueError):
+        decode_block(b"abc", 'snappy', 3)
+
+
+@pytest.fixture
+def small_idx(tmp_path):
+    # a tiny IDX with two written timesteps, stored raw; frames are zero but for a plume, like PM25
+    db = set_default_compression(open_idx(str(tmp_path / "firesmoke.idx"), [64, 32], 3), '')
+    frames = [np.zeros((32, 64), dtype=np.float32) for _ in range(2)]
+    for t, frame in enumerate(frames):
+        frame[8:20, 10 + t:40 + t] = np.random.default_rng(t).gamma(0.5, 10, (12, 30))
+    for t, frame in enumerate(frames):
+        db.write(data=frame, field=db.getField('PM25'), time=t)
+    return db, frames
+
+
+def data_files(db, timestep):
+    return [f for f in db.db.getFilenames(timestep, '') if os.path.isfile(f)]
+
+
+@pytest.mark.parametrize("first, second", [('zip', 'lz4'), ('lz4', 'zip'), ('zip', 'zip')])
+def test_compress_file_sets_header_flags_and_keeps_blocks(small_idx, first, second):
+    db, _ = small_idx
+    sizes = block_sizes(db)
+    filename = data_files(db, 0)[0]
+    _, raw_blocks = read_blocks(filename, sizes)
+
+    # compressing again, or with another codec, decodes the blocks first
+    for compression in (first, second):
+        compress_file(filename, sizes, compression)
+        headers, blocks = read_blocks(filename, sizes)
+        assert blocks == raw_blocks
+        for header, block in zip(headers, blocks):
+            if block is not None:
+                assert header[5] & COMPRESSION_MASK == CODECS[compression]
+            else:
+                assert header[4] == 0
+
+
+@pytest.mark.parametrize("compression", list(CODECS))
+def test_compressed_idx_reads_the_same(small_idx, compression):
+    db, frames = small_idx
+    raw_size = sum(os.path.getsize(f) for t in range(2) for f in data_files(db, t))
+    db = compress_idx(db, [0, 1], compression, max_workers=2)
+    assert all(field.default_compression == compression for field in db.db.idxfile.fields)
+    assert sum(os.path.getsize(f) for t in range(2) for f in data_files(db, t)) < raw_size
+    for t, frame in enumerate(frames):
+        np.testing.assert_array_equal(db.read(time=t, field='PM25'), frame)
+
@@ -0,0 +1,114 @@
+import json
+
+import numpy as np
+import pytest
+# ref: https://github.com/sci-visus/OpenVisus
+from OpenVisus import LoadDataset
+
+import idx_job
+from idx_job import JOURNAL, SKIPPED_REPORT, ConversionJournal, run_conversion
+from idx_schedule import IDX_CALL_DTYPE
+
+GRID = {'COL': 16, 'ROW': 8}
+
+
+def make_idx_calls(num_hours, start='2024-03-01T00'):
+    idx_calls = np.empty(num_hours, dtype=IDX_CALL_DTYPE)
+    idx_calls['time'] = np.datetime64(start, 's') + np.arange(num_hours) * np.timedelta64(1, 'h')
+    idx_calls['file'] = [f"dispersion_{t // 24}.nc" for t in range(num_hours)]
+    idx_calls['tstep'] = np.arange(num_hours) % 24
+    return idx_calls
+
+
+def frame_of(call, version=0):
+    # a frame that depends on the idx call, so the IDX shows which call each timestep was written from
+    hour = (call['time'] - np.datetime64('2024-03-01T00', 's')) // np.timedelta64(1, 'h')
+    return np.full((GRID['ROW'], GRID['COL']), hour + 1000 * version, dtype=np.float32) + np.arange(GRID['COL'], dtype=np.float32)
+
+
+@pytest.fixture
+def fake_frames(monkeypatch):
+    # stands in for reading and resampling the NetCDF files, records the calls it is asked for
+    requested = []
+
+    def stream_frames(idx_calls, firesmoke_dir, max_grid, resample_op, thresh, **kwargs):
+        requested.append(idx_calls.copy())
+        for i, call in enumerate(idx_calls):
+            if call['file'] == 'bad.nc':
+                yield i, None, "OSError: unreadable"
+            else:
+                yield i, frame_of(call, version=int(call['tstep']) // 100), None
+
+    monkeypatch.setattr(idx_job, 'stream_frames', stream_frames)
+    return requested
+
+
+def test_journal_compaction_with_torn_last_line(tmp_path):
+    path = tmp_path / JOURNAL
+    lines = [{'timestep': 1, 'status': 'scheduled'}, {'timestep': 0, 'status': 'written'},
+             {'timestep': 1, 'status': 'compressed'}]
+    path.write_text("".join(json.dumps(line) + "\n" for line in lines) + '{"timestep": 2, "sta')
+
+    journal = ConversionJournal(str(path))
+    assert journal.get(0)['status'] == 'written'
+    assert journal.get(1)['status'] == 'compressed'
+    assert journal.get(2) is None
+    # one line per timestep, in timestep order, and updates are appended after them
+    assert [json.loads(line)['timestep'] for line in path.read_text().splitlines()] == [0, 1]
+    journal.update(2, status='skipped', error='OSError')
+    journal.close()
+
+    journal = ConversionJournal(str(path))
+    assert journal.counts() == {'written': 1, 'compressed': 1, 'skipped': 1}
+    assert [entry['timestep'] for entry in journal.skipped()] == [2]
+    journal.close()
+
+
+def test_schedule_and_has(tmp_path):
+    journal = ConversionJournal(str(tmp_path / JOURNAL))
+    call = make_idx_calls(1)[0]
+    journal.schedule(0, call)
+    assert not journal.has(0, call, ('written', 'compressed'))
+    journal.update(0, status='written')
+    assert journal.has(0, call, ('written', 'compressed'))
+    other = call.copy()
+    other['tstep'] += 1
+    assert not journal.has(0, other, ('written', 'compressed'))
+    journal.close()
+
+
+def test_resume_is_a_noop(tmp_path, fake_frames):
+    idx_dir = str(tmp_path / "idx")
+    idx_calls = make_idx_calls(6)
+    idx_calls['file'][3] = 'bad.nc'
+
+    journal = run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1, compression='zip')
+    assert journal.counts() == {'compressed': 5, 'skipped': 1}
+    with open(f"{idx_dir}/{SKIPPED_REPORT}") as f:
+        assert [entry['timestep'] for entry in json.load(f)] == [3]
+
+    # the second run only asks for the skipped frame again, and leaves the IDX as it was
+    journal = run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1, compression='zip')
+    assert [len(calls) for calls in fake_frames] == [6, 1]
+    assert journal.counts() == {'compressed': 5, 'skipped': 1}
+
+    db = LoadDataset(f"{idx_dir}/firesmoke.idx")
+    for t in (0, 1, 2, 4, 5):
+        np.testing.assert_array_equal(db.read(time=t, field='PM25'), frame_of(idx_calls[t]))
+    assert not db.read(time=3, field='PM25').any()
+
+
+def test_changed_call_is_rewritten(tmp_path, fake_frames):
+    idx_dir = str(tmp_path / "idx")
+    idx_calls = make_idx_calls(4)
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1)
+
+    # a newer forecast covers timestep 2, its frames read as version 1
+    idx_calls['file'][2] = 'newer.nc'
+    idx_calls['tstep'][2] = 102
+    run_conversion(idx_calls, idx_dir, None, GRID, None, 0, compress_workers=1)
+    assert [len(calls) for calls in fake_frames] == [4, 1]
+
+    db = LoadDataset(f"{idx_dir}/firesmoke.idx")
+    np.testing.assert_array_equal(db.read(time=2, field='PM25'), frame_of(idx_calls[2], version=1))
+    np.testing.assert_array_equal(db.read(time=1, field='PM25'), frame_of(idx_calls[1]))
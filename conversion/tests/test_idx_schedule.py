@@ -0,0 +1,74 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from idx_schedule import build_idx_calls, group_by_file, missing_hours
+
+
+def reference_idx_calls(available_dates_df, start_date, end_date):
+    # hour by hour search of the v5 notebooks, that build_idx_calls replaces
+    idx_calls = []
+    current_date = start_date
+    current_hour = datetime.datetime(current_date.year, current_date.month, current_date.day)
+    while current_date <= end_date:
+        while current_hour < current_date + datetime.timedelta(days=1):
+            found = 0
+            most_recent_row = None
+            dt_mask = ((available_dates_df['CDATETIME'].dt.date >= (current_hour - datetime.timedelta(days=4)).date()) &
+                       (available_dates_df['CDATETIME'].dt.date <= (current_hour + datetime.timedelta(days=4)).date()))
+            if available_dates_df[dt_mask].shape[0] > 0:
+                curr_row = len(available_dates_df[dt_mask]) - 1
+                while curr_row >= 0 and found == 0:
+                    most_recent_row = available_dates_df[dt_mask].iloc[curr_row]
+                    if most_recent_row['tflag_0'] <= current_hour <= most_recent_row['tflag_last']:
+                        found = 1
+                    else:
+                        curr_row -= 1
+            if found:
+                tstep_idx = int((current_hour - most_recent_row['tflag_0']).total_seconds() / 3600)
+                idx_calls.append([most_recent_row['file'], current_hour, tstep_idx])
+            current_hour += datetime.timedelta(hours=1)
+        current_date += datetime.timedelta(days=1)
+    return idx_calls
+
+
+def synthetic_catalog(seed=0, num_files=60):
+    # forecasts created every 6 hours with gaps, each covering 24 to 60 hours from about its creation time
+    rng = np.random.default_rng(seed)
+    created = pd.Timestamp('2024-03-01') + pd.to_timedelta(np.sort(rng.choice(200, num_files, replace=False)) * 6, unit='h')
+    tflag_0 = created + pd.to_timedelta(rng.integers(-2, 4, num_files), unit='h')
+    tflag_last = tflag_0 + pd.to_timedelta(rng.integers(24, 61, num_files), unit='h')
+    df = pd.DataFrame({'file': [f"dispersion_{t:%Y%m%d_%H%M%S}.nc" for t in created],
+                       'CDATETIME': created, 'tflag_0': tflag_0, 'tflag_last': tflag_last})
+    return df.sort_values(['CDATETIME', 'file']).reset_index(drop=True)
+
+
+def test_build_idx_calls_matches_reference_loop():
+    df = synthetic_catalog()
+    start_date, end_date = datetime.datetime(2024, 2, 27), datetime.datetime(2024, 3, 20)
+    idx_calls = build_idx_calls(df, start_date, end_date)
+    reference = reference_idx_calls(df, start_date, end_date)
+
+    assert len(idx_calls) == len(reference)
+    assert idx_calls['file'].tolist() == [call[0] for call in reference]
+    assert idx_calls['time'].tolist() == [call[1] for call in reference]
+    assert idx_calls['tstep'].tolist() == [call[2] for call in reference]
+
+
+def test_missing_hours_are_the_hours_without_a_call():
+    df = synthetic_catalog(seed=1, num_files=20)
+    start_date, end_date = datetime.datetime(2024, 3, 1), datetime.datetime(2024, 3, 10)
+    idx_calls = build_idx_calls(df, start_date, end_date)
+    missing = missing_hours(idx_calls, start_date, end_date)
+
+    assert len(missing) + len(idx_calls) == 10 * 24
+    assert len(np.intersect1d(missing, idx_calls['time'])) == 0
+
+
+def test_group_by_file_splits_runs():
+    idx_calls = np.zeros(7, dtype=[('file', 'U8')])
+    idx_calls['file'] = ['a', 'a', 'a', 'b', 'b', 'a', 'c']
+    assert group_by_file(idx_calls) == [(0, 3), (3, 5), (5, 6), (6, 7)]
+    assert group_by_file(idx_calls, max_size=2) == [(0, 2), (2, 3), (3, 5), (5, 6), (6, 7)]
+    assert group_by_file(idx_calls[:0]) == []
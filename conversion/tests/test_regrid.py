@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from scipy.interpolate import griddata
+
+from regrid import METHODS, grid_axes, regrid, regrid_operator
+
+# a piece of the firesmoke grids: like 1041x381 in 1081x381, the small grid's cells are the east end of the big grid's
+SMALL_GRID = {'COL': 20, 'ROW': 12, 'XORIG': -159.6, 'YORIG': 32.0, 'XCELL': 0.1, 'YCELL': 0.1}
+BIG_GRID = {'COL': 24, 'ROW': 12, 'XORIG': -160.0, 'YORIG': 32.0, 'XCELL': 0.1, 'YCELL': 0.1}
+
+
+def griddata_regrid(data, src_grid, dst_grid, method):
+    # per frame resampling of the v5 notebooks, that the operators replace
+    src_lon, src_lat = grid_axes(src_grid)
+    dst_lon, dst_lat = grid_axes(dst_grid)
+    points = np.stack(np.meshgrid(src_lon, src_lat), axis=-1).reshape(-1, 2)
+    xi = np.stack(np.meshgrid(dst_lon, dst_lat), axis=-1).reshape(-1, 2)
+    return griddata(points, data.ravel(), xi, method=method, fill_value=0).reshape(int(dst_grid['ROW']), int(dst_grid['COL']))
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_operators_match_griddata_on_coincident_grid(method):
+    data = np.random.default_rng(0).gamma(0.5, 10, (12, 20)).astype(np.float32)
+    expected = griddata_regrid(data, SMALL_GRID, BIG_GRID, 'cubic')
+    resampled = regrid(regrid_operator(SMALL_GRID, BIG_GRID, method), data, BIG_GRID)
+
+    assert resampled.shape == (12, 24) and resampled.dtype == np.float32
+    np.testing.assert_allclose(resampled, expected, rtol=1e-6, atol=1e-6)
+    # shared cells are copied, cells outside of the small grid are 0
+    np.testing.assert_array_equal(resampled[:, 4:], data)
+    assert not resampled[:, :4].any()
+
+
+def test_bilinear_matches_griddata_between_cells():
+    # half a cell off in both directions, on a linear field both interpolations are exact
+    dst_grid = {'COL': 18, 'ROW': 10, 'XORIG': -159.55, 'YORIG': 32.05, 'XCELL': 0.1, 'YCELL': 0.1}
+    lon, lat = grid_axes(SMALL_GRID)
+    data = (3 * lon[None, :] - 2 * lat[:, None] + 500).astype(np.float32)
+    expected = griddata_regrid(data, SMALL_GRID, dst_grid, 'linear')
+    resampled = regrid(regrid_operator(SMALL_GRID, dst_grid, 'bilinear'), data, dst_grid)
+    np.testing.assert_allclose(resampled, expected, rtol=1e-5)
+
+
+def test_stacks_of_frames_and_cached_operator(tmp_path):
+    frames = np.random.default_rng(1).random((3, 12, 20), dtype=np.float32)
+    operator = regrid_operator(SMALL_GRID, BIG_GRID, 'cubic', cache_dir=str(tmp_path))
+    cached = regrid_operator(SMALL_GRID, BIG_GRID, 'cubic', cache_dir=str(tmp_path))
+    assert len(list(tmp_path.glob("regrid_cubic_*.npz"))) == 1
+    assert (operator != cached).nnz == 0
+
+    resampled = regrid(cached, frames, BIG_GRID)
+    assert resampled.shape == (3, 12, 24)
+    for frame, expected in zip(resampled, frames):
+        np.testing.assert_array_equal(frame, regrid(operator, expected, BIG_GRID))
+
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        regrid_operator(SMALL_GRID, BIG_GRID, 'nearest')
@@ -0,0 +1,90 @@
+# Incrementally bring firesmoke.idx up to date with the NetCDF files in firesmoke_dir, meant to run as a cron job.
+# Same schedule and resampling as firesmoke_to_idx_v5_parallel.ipynb, but only the timesteps whose idx call is new
+# or changed since the last run are written and compressed, so a run costs O(new hours) instead of the whole archive.
+# Timesteps are positions in the schedule, which leaves out the hours no file covers: a late file covering an earlier
+# gap shifts every later hour, and the run then rewrites every timestep after the gap (see idx_incremental.py).
+# ref: https://docs.python.org/3/library/logging.html
+import datetime
+import logging
+import numpy as np
+
+from firesmoke_catalog import update_catalog, load_catalog, grid_signatures
+from idx_schedule import build_idx_calls
+from regrid import regrid_operator
+from idx_incremental import load_written_calls, save_written_calls, diff_idx_calls
+from idx_job import run_conversion
+
+logger = logging.getLogger(__name__)
+
+# Set up logging
+# ref: https://realpython.com/python-logging/
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[
+        logging.FileHandler("/home/arleth/NSDF-WIRED/conversion/update_idx.log"),
+        logging.StreamHandler()
+    ]
+)
+
+## Define paths
+# path to all original netCDF files from UBC
+firesmoke_dir = "/opt/wired-data/firesmoke/final_union_set"
+
+# path to save idx file and data
+idx_dir = "/opt/wired-data/firesmoke/idx_parallel"
+
+# path to the catalog of all netCDF files, only files added since the last run are scanned
+catalog_path = "/opt/wired-data/firesmoke/firesmoke_catalog.sqlite"
+
+# path to cache the regridding operators in, they only depend on the pair of grids
+regrid_cache_dir = "/opt/wired-data/firesmoke/regrid_cache"
+
+# first day of the IDX, the last day is today
+start_date = datetime.datetime.strptime("2021059", "%Y%j")
+end_date = datetime.datetime.utcnow()
+
+# threshold to use to change small-enough resampled values to 0
+thresh = 1e-15
+
+# also keep the time-major sidecar (idx_dir/time_major) up to date, for fast per-location histories;
+# it takes ~1.6 MB per timestep, see idx_time_major.py
+time_major = False
+
+# also update the daily and monthly aggregates (firesmoke_daily.idx, firesmoke_monthly.idx) of the days written,
+# see idx_aggregates.py
+aggregates = True
+
+
+# workers are started from here, only run the update in the main process
+if __name__ == "__main__":
+    ## Build the schedule from the catalog, scanning only files added since the last run
+    logger.info(f'Scanned {update_catalog(catalog_path, firesmoke_dir)} new files')
+    catalog_df = load_catalog(catalog_path)
+    all_unique_grids = grid_signatures(catalog_df).to_dict('records')
+    max_grid, min_grid = all_unique_grids[-1], all_unique_grids[0]
+    resample_op = regrid_operator(min_grid, max_grid, method='cubic', cache_dir=regrid_cache_dir)
+
+    idx_calls = build_idx_calls(catalog_df, start_date, end_date)
+
+    ## Diff it against what is in the IDX
+    written_calls = load_written_calls(idx_dir)
+    to_write = diff_idx_calls(written_calls, idx_calls)
+    logger.info(f"{len(to_write)} of {len(idx_calls)} timesteps to write")
+    # hours added before the end shift every later timestep, which are then all rewritten
+    rewritten = to_write[to_write < len(written_calls)]
+    shifted = rewritten[written_calls['time'][rewritten] != idx_calls['time'][rewritten]]
+    if len(shifted):
+        logger.warning(f"Hours were added before the end of the IDX, {len(shifted)} timesteps from {shifted[0]} "
+                       f"moved to another hour and are rewritten")
+
+    ## Write and compress the new and changed timesteps
+    # frames are read and resampled in worker processes and come back in order, a bounded number at a time;
+    # the state of every timestep is journaled, so an interrupted run resumes where it stopped
+    journal = run_conversion(idx_calls, idx_dir, firesmoke_dir, max_grid, resample_op, thresh, timesteps=to_write,
+                             time_major=time_major, aggregates=aggregates)
+    failed = [entry['timestep'] for entry in journal.skipped() if entry['timestep'] < len(idx_calls)]
+
+    # only record the schedule once the IDX holds it, failed timesteps are retried on the next run
+    save_written_calls(idx_dir, idx_calls, failed)
+    logger.info(f"Done, {len(to_write) - len(failed)} timesteps written, {len(failed)} failed")
@@ -1,8 +1,21 @@
-# ref: https://realpython.com/python-download-file-from-url/
-import requests
-import pandas as pd
+# ref: https://docs.python.org/3/library/logging.html
+import logging
+import os
+import sys
 from datetime import datetime
 
+# the shared download engine lives one directory up, in data_download/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from download_engine import build_queries, download_all
+
+# Set up logging
+# ref: https://realpython.com/python-logging/
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+
 # get metadata of datasets, had to be obtained manually
 ids = ["BSC18CA12-01", "BSC00CA12-01", "BSC06CA12-01", "BSC12CA12-01"]
 start_dates = ["20210304", "20210304", "20210304", "20210303"]
@@ -10,37 +23,14 @@ start_dates = ["20210304", "20210304", "20210304", "20210303"]
 # ref: https://www.programiz.com/python-programming/datetime/strftime
 # got data for up to 06-26-2024
 today = datetime.now().strftime('%Y%m%d')
+end_dates = [today] * len(ids)
 init_times = ["02", "08", "14", "20"]
+parent_dir = "/usr/sci/scratch_nvme/arleth/basura_total/"
+# records the state of every download, so an interrupted run can be resumed by rerunning this script
+# (kept in parent_dir, so the script can be rerun from any directory)
+manifest_path = "get_data_v1_manifest.jsonl"
 
-# try downloading all files starting the day after dataset's corresponding end date
-for i in zip(start_dates, ids, init_times):
-    start_date = i[0]
-    forecast_id = i[1]
-    init_time = i[2]
-    print("Get data for " + forecast_id + " from dates " + start_date + " to " + today + "; init_time is " + init_time)
-    
-    # generate dates of interest, which is all available data for each dataset
-    # ref: https://stackoverflow.com/questions/59882714/python-generating-a-list-of-dates-between-two-dates
-    dates = pd.date_range(start=start_date, end=today)
-    dates = dates.strftime('%Y%m%d').tolist()
-
-    # download datasets in specified dates
-    for date in dates:
-        # build URL string to download from and directory & filename to download to
-        url = "https://firesmoke.ca/forecasts/" + forecast_id + "/" + date + init_time + "/dispersion.nc"
-        directory = "/usr/sci/scratch_nvme/arleth/basura_total/" + forecast_id + "/dispersion_" + date + ".nc"
-        
-        # request from download URL
-        response = requests.get(url, stream=True)
-        # get response header
-        header = response.headers
-        # download file if we see 'save as' content type
-        # ref: https://stackoverflow.com/questions/20508788/do-i-need-content-type-application-octet-stream-for-file-download
-        if 'Content-Type' in header and header['Content-Type'] == 'application/octet-stream':
-            with open(directory, mode="wb") as file:
-                file.write(response.content)
-                print(f"Downloaded file {directory}")
-        else: #otherwise inspect header's Content-Type
-            print(header['Content-Type'])
-        print(url)
-        print('------')
+# try downloading all files from each dataset's start date up to today
+queries = build_queries(ids, start_dates, end_dates, init_times, parent_dir)
+# rerunning skips files the manifest has as complete and only fetches what's missing
+download_all(queries, manifest_path=manifest_path)
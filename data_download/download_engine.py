@@ -0,0 +1,454 @@
+### Shared download engine for the UBC Firesmoke NetCDF files hosted on firesmoke.ca. ###
+# The download scripts in this directory only describe *what* to download (forecast IDs, dates,
+# init times, target directories); this module does the downloading with one pooled asyncio
+# session and a bounded number of concurrent requests per host.
+
+## Import libs
+# ref: https://docs.aiohttp.org/en/stable/client_quickstart.html
+import aiohttp
+import asyncio
+import hashlib
+import json
+# ref: https://docs.python.org/3/library/logging.html
+import logging
+import os
+import pandas as pd
+import random
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# root of all forecasts on firesmoke.ca
+FIRESMOKE_URL = "https://firesmoke.ca/forecasts"
+
+# default number of requests we allow in flight to a single host at once
+MAX_PER_HOST = 8
+
+# size of the chunks we stream responses to disk with, so memory per download stays flat
+CHUNK_SIZE = 1024 * 1024
+
+# suffix of the temporary file a download is streamed to before it is renamed into place
+PART_SUFFIX = ".part"
+
+# how often we try a download that fails with a transient error, and the first backoff delay in seconds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2
+
+# HTTP statuses that are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# seconds before a file the server didn't have ('missing' in the manifest) is asked for again
+MISSING_MAX_AGE = 7 * 24 * 3600
+
+
+def forecast_url(forecast_id, date, init_time):
+    """
+    Return the URL of the dispersion.nc file for a forecast ID, date and init time
+    :param str forecast_id: forecast ID, e.g. "BSC00CA12-01"
+    :param str date: date in format YYYYMMDD
+    :param str init_time: two digit init time of the forecast, e.g. "08"
+    """
+    return f"{FIRESMOKE_URL}/{forecast_id}/{date}{init_time}/dispersion.nc"
+
+
+def build_queries(ids, start_dates, end_dates, init_times, parent_dir):
+    """
+    Return a list of [url, path] queries for every date of every forecast ID
+    :param list ids: forecast IDs to download
+    :param list start_dates: first date (YYYYMMDD) to download for each forecast ID
+    :param list end_dates: last date (YYYYMMDD) to download for each forecast ID
+    :param list init_times: init time for each forecast ID
+    :param str parent_dir: files are saved to f"{parent_dir}{forecast_id}/dispersion_{date}.nc"
+    """
+    queries = []
+    for start_date, end_date, forecast_id, init_time in zip(start_dates, end_dates, ids, init_times):
+        # generate dates of interest, which is all available data for each dataset
+        # ref: https://stackoverflow.com/questions/59882714/python-generating-a-list-of-dates-between-two-dates
+        dates = pd.date_range(start=start_date, end=end_date)
+        dates = dates.strftime('%Y%m%d').tolist()
+
+        for date in dates:
+            url = forecast_url(forecast_id, date, init_time)
+            directory = f"{parent_dir}{forecast_id}/dispersion_{date}.nc"
+            queries.append([url, directory])
+    return queries
+
+
+class RetryableError(Exception):
+    """Raised for transient failures (server errors, truncated bodies) worth retrying"""
+
+
+class DownloadManifest:
+    """
+    Persistent record of every download, keyed by URL
+    Each entry holds the URL, path, size, ETag/Last-Modified, sha256 checksum and status
+    ("partial", "complete", "missing" or "failed"). Updates are appended as JSON lines so a crash
+    mid-write loses at most the last update, and the file is compacted every time it is loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn last line from an interrupted run
+                        continue
+                    self.entries[entry['url']] = entry
+        self._compact()
+        self.file = open(path, mode="a")
+
+    def _compact(self):
+        # keep only the latest entry of each URL
+        tmp_path = self.path + PART_SUFFIX
+        with open(tmp_path, mode="w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def location(manifest_path, queries):
+        """
+        Return where the manifest of queries is kept: manifest_path itself if it is absolute, otherwise
+        manifest_path in the directory all queries download to, so rerunning from any directory resumes
+        :param str manifest_path: path of the manifest, e.g. "get_data_v1_manifest.jsonl"
+        :param list queries: list of [url, path] pairs
+        """
+        if os.path.isabs(manifest_path) or not queries:
+            return os.path.abspath(manifest_path)
+        output_dir = os.path.commonpath([os.path.dirname(os.path.abspath(directory)) for _, directory in queries])
+        return os.path.join(output_dir, manifest_path)
+
+    def get(self, url):
+        return self.entries.get(url)
+
+    def update(self, url, **fields):
+        entry = {**self.entries.get(url, {'url': url}), **fields}
+        self.entries[url] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        return entry
+
+    def counts(self):
+        """Return a dict of the number of entries per status"""
+        return dict(Counter(entry.get('status') for entry in self.entries.values()))
+
+    def close(self):
+        self.file.close()
+
+
+def file_checksum(path):
+    """
+    Return the sha256 hex digest of the file at path
+    :param str path: path of the file to hash
+    """
+    checksum = hashlib.sha256()
+    with open(path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def is_complete(entry, directory):
+    """
+    Return True if the manifest entry says directory was fully downloaded and the file on disk agrees
+    :param dict entry: manifest entry of the query, or None
+    :param str directory: path the query downloads to
+    """
+    return (entry is not None and entry.get('status') == 'complete' and os.path.exists(directory)
+            and os.path.getsize(directory) == entry.get('size'))
+
+
+def total_size(response):
+    """
+    Return the full size of the file behind response, or None if the server didn't tell us
+    :param aiohttp.ClientResponse response: a 200 or 206 response
+    """
+    if response.status == 206:
+        # Content-Range: bytes start-end/total
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    return response.content_length
+
+
+async def stream_to_file(response, directory, offset=0):
+    """
+    Stream the body of response to directory in CHUNK_SIZE chunks, return (size, sha256) of the full file
+    The body is written to directory + PART_SUFFIX, flushed to disk and only then renamed to directory,
+    so directory either doesn't exist or holds a complete file, even if we crash mid-download.
+    :param aiohttp.ClientResponse response: response whose body to save
+    :param str directory: path of the file to save to
+    :param int offset: number of bytes already in the .part file that the body continues from (0 to start over)
+    """
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    part_path = directory + PART_SUFFIX
+    checksum = hashlib.sha256()
+    size = 0
+    if offset:
+        # the checksum covers the bytes we downloaded in a previous run too
+        with open(part_path, mode="rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                checksum.update(chunk)
+                size += len(chunk)
+    with open(part_path, mode="ab" if offset else "wb") as file:
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            file.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+        # make sure the bytes are on disk before the file shows up under its final name
+        file.flush()
+        os.fsync(file.fileno())
+
+    expected = total_size(response)
+    if expected is not None and size != expected:
+        # keep the .part file, the next attempt resumes from it
+        raise RetryableError(f"got {size} of {expected} bytes")
+    # ref: https://docs.python.org/3/library/os.html#os.replace
+    os.replace(part_path, directory)
+    return size, checksum.hexdigest()
+
+
+async def adopt_existing(session, url, directory, manifest):
+    """
+    Record a file downloaded before we kept a manifest as complete if its size matches the server's
+    Return True if it was adopted, i.e. it doesn't need to be downloaded again.
+    :param aiohttp.ClientSession session: the shared session to use
+    :param str url: URL the file was downloaded from
+    :param str directory: path of the existing file
+    :param DownloadManifest manifest: manifest to record the file in
+    """
+    async with session.head(url) as response:
+        if response.status != 200 or response.content_length != os.path.getsize(directory):
+            return False
+        checksum = await asyncio.to_thread(file_checksum, directory)
+        manifest.update(url, path=directory, size=response.content_length,
+                        etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'),
+                        sha256=checksum, status='complete')
+        return True
+
+
+async def fetch(session, url, directory, manifest):
+    """
+    Make one attempt at downloading url to directory, resuming from a previous .part file if possible
+    Return True if a NetCDF file was saved, False if the server has none; raise on transient errors.
+    :param aiohttp.ClientSession session: the shared session (and connection pool) to use
+    :param str url: URL to download from
+    :param str directory: path of the file to save to
+    :param DownloadManifest manifest: manifest to record progress in, or None
+    """
+    entry = manifest.get(url) if manifest else None
+    if manifest and entry is None and os.path.exists(directory):
+        if await adopt_existing(session, url, directory, manifest):
+            logger.info(f"Already have: {url} -> {directory}")
+            return True
+
+    # ask only for the missing bytes if we have a .part file and a validator to make sure it didn't change
+    headers = {}
+    part_path = directory + PART_SUFFIX
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = entry and (entry.get('etag') or entry.get('last_modified'))
+    if offset and validator:
+        # ref: https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/If-Range
+        headers = {'Range': f'bytes={offset}-', 'If-Range': validator}
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 416:
+            # the .part file doesn't fit the file on the server anymore, start over
+            os.remove(part_path)
+            raise RetryableError("requested range not satisfiable")
+        if response.status in RETRY_STATUSES:
+            raise RetryableError(f"HTTP {response.status}")
+
+        # get response header
+        header = response.headers
+        # download file if we see 'save as' content type
+        # ref: https://stackoverflow.com/questions/20508788/do-i-need-content-type-application-octet-stream-for-file-download
+        if header.get('Content-Type') != 'application/octet-stream':
+            #otherwise inspect header's Content-Type
+            logger.error(f"Failed: {url} -> {directory} | Header Content-Type: {header.get('Content-Type')}")
+            if manifest:
+                manifest.update(url, path=directory, status='missing', checked=time.time())
+            return False
+
+        # the server ignores Range (and answers 200) if the file changed since our .part was written
+        offset = offset if response.status == 206 else 0
+        if manifest:
+            manifest.update(url, path=directory, size=total_size(response), etag=header.get('ETag'),
+                            last_modified=header.get('Last-Modified'), status='partial')
+        size, checksum = await stream_to_file(response, directory, offset)
+        if manifest:
+            manifest.update(url, size=size, sha256=checksum, status='complete', error=None)
+        logger.info(f"Success: {url} -> {directory}" + (f" (resumed at byte {offset})" if offset else ""))
+        return True
+
+
+def is_known_missing(entry, missing_max_age=MISSING_MAX_AGE):
+    """
+    Return True if the manifest entry says the server had no file less than missing_max_age seconds ago
+    :param dict entry: manifest entry of the query, or None
+    :param float missing_max_age: seconds after which a missing file is asked for again
+    """
+    return (entry is not None and entry.get('status') == 'missing'
+            and time.time() - entry.get('checked', 0) < missing_max_age)
+
+
+async def download_query(session, semaphores, url, directory, manifest=None, missing_max_age=MISSING_MAX_AGE):
+    """
+    Download a single url to directory, return True if a NetCDF file was saved
+    Files the manifest has as complete are skipped, as are files the server recently didn't have,
+    transient errors are retried with exponential backoff.
+    :param aiohttp.ClientSession session: the shared session (and connection pool) to use
+    :param dict semaphores: maps host name to the asyncio.Semaphore bounding requests to that host
+    :param str url: URL to download from
+    :param str directory: path of the file to save to
+    :param DownloadManifest manifest: manifest to record progress in, or None
+    :param float missing_max_age: seconds after which a file the server didn't have is asked for again
+    """
+    if manifest and is_complete(manifest.get(url), directory):
+        return True
+    if manifest and is_known_missing(manifest.get(url), missing_max_age):
+        return False
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            async with semaphores[urlsplit(url).netloc]:
+                return await fetch(session, url, directory, manifest)
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+            logger.warning(f"Attempt {attempt + 1}/{MAX_ATTEMPTS} failed: {url} -> {directory} | {type(e).__name__}: {e}")
+            if manifest:
+                manifest.update(url, path=directory, status='failed', error=f"{type(e).__name__}: {e}")
+            # back off exponentially, with jitter so retries of many files don't arrive together
+            # (the semaphore is released while we wait)
+            if attempt + 1 < MAX_ATTEMPTS:
+                await asyncio.sleep(BACKOFF_BASE * 2 ** attempt * (1 + random.random()))
+
+    logger.error(f"Failed: {url} -> {directory} | giving up after {MAX_ATTEMPTS} attempts")
+    return False
+
+
+async def download_all_async(queries, max_per_host=MAX_PER_HOST, manifest=None, missing_max_age=MISSING_MAX_AGE):
+    """
+    Download all queries concurrently over one pooled session, return list of booleans (one per query)
+    :param list queries: list of [url, path] pairs
+    :param int max_per_host: maximum number of requests in flight to a single host
+    :param DownloadManifest manifest: manifest to skip complete files and record progress in, or None
+    :param float missing_max_age: seconds after which a file the server didn't have is asked for again
+    """
+    # one semaphore per host, so a slow host can't starve the others
+    semaphores = {urlsplit(url).netloc: asyncio.Semaphore(max_per_host) for url, _ in queries}
+
+    # keep-alive connections are reused across all requests to the same host
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=max_per_host)
+    # dispersion.nc files are large, only bound how long we wait between reads
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*[download_query(session, semaphores, url, directory, manifest, missing_max_age)
+                                      for url, directory in queries])
+
+
+def download_all(queries, max_per_host=MAX_PER_HOST, manifest_path=None, missing_max_age=MISSING_MAX_AGE):
+    """
+    Blocking wrapper of download_all_async, for use in download scripts
+    :param list queries: list of [url, path] pairs
+    :param int max_per_host: maximum number of requests in flight to a single host
+    :param str manifest_path: path of the download manifest, rerunning with the same manifest
+                              skips complete files and resumes partial ones (None to not keep one);
+                              a relative path is kept in the directory the queries download to
+    :param float missing_max_age: seconds after which a file the server didn't have is asked for again
+    """
+    if manifest_path:
+        manifest_path = DownloadManifest.location(manifest_path, queries)
+    manifest = DownloadManifest(manifest_path) if manifest_path else None
+    logger.info(f"Downloading {len(queries)} files, at most {max_per_host} at a time per host")
+    try:
+        results = asyncio.run(download_all_async(queries, max_per_host, manifest, missing_max_age))
+    finally:
+        if manifest:
+            manifest.close()
+    logger.info(f"Done: {sum(results)} of {len(queries)} files available")
+    if manifest:
+        logger.info(f"Manifest {manifest_path}: {manifest.counts()}")
+    return results
+
+
+def load_validators(path):
+    """
+    Return the validators (ETag and Last-Modified) cached at path, or an empty dict if there are none
+    :param str path: path of the JSON file the validators are cached in
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_validators(path, validators):
+    """
+    Atomically cache validators (as returned by download_if_modified) at path
+    :param str path: path of the JSON file to cache the validators in
+    :param dict validators: dict with 'etag' and 'last_modified' keys
+    """
+    tmp_path = path + PART_SUFFIX
+    with open(tmp_path, mode="w") as f:
+        json.dump(validators, f)
+    os.replace(tmp_path, path)
+
+
+async def fetch_if_modified(session, url, directory, validators):
+    """
+    Download url to directory only if it changed since validators were cached, see download_if_modified
+    :param aiohttp.ClientSession session: the session to use
+    :param str url: URL to download from
+    :param str directory: path of the file to save to
+    :param dict validators: cached validators of the last download of url
+    """
+    # ref: https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+
+    async with session.get(url, headers=headers) as response:
+        new_validators = {'etag': response.headers.get('ETag'),
+                          'last_modified': response.headers.get('Last-Modified')}
+        # a server that ignores conditional headers still tells us the validators of the body it is about to send,
+        # in that case we close the connection before reading the body
+        unchanged = (response.status == 200 and any(new_validators.values()) and new_validators == {
+            'etag': validators.get('etag'), 'last_modified': validators.get('last_modified')})
+        if response.status == 304 or unchanged:
+            logger.info(f"Not modified: {url} | ETag: {new_validators['etag']}, Last-Modified: {new_validators['last_modified']}")
+            return None
+        if response.status != 200 or response.headers.get('Content-Type') != 'application/octet-stream':
+            logger.error(f"Failed: {url} -> {directory} | HTTP {response.status}, Header Content-Type: {response.headers.get('Content-Type')}")
+            return None
+        await stream_to_file(response, directory)
+        logger.info(f"Success: {url} -> {directory}")
+        return new_validators
+
+
+def download_if_modified(url, directory, validators):
+    """
+    Download url to directory with a conditional GET (If-None-Match/If-Modified-Since)
+    Return the new validators if a new file was saved, None if url is unchanged (no body is transferred)
+    or the download failed. The caller decides when to cache the returned validators with save_validators,
+    e.g. only once the new file is safely stored.
+    :param str url: URL to download from
+    :param str directory: path of the file to save to
+    :param dict validators: cached validators of the last download of url, see load_validators
+    """
+    async def run():
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            return await fetch_if_modified(session, url, directory, validators)
+
+    try:
+        return asyncio.run(run())
+    except (aiohttp.ClientError, asyncio.TimeoutError, RetryableError) as e:
+        logger.error(f"Failed: {url} -> {directory} | {type(e).__name__}: {e}")
+        return None
@@ -1,12 +1,15 @@
-# ref: https://realpython.com/python-download-file-from-url/
-import requests
 # ref: https://docs.python.org/3/library/logging.html
 import logging
 import os
-import pandas as pd
-import xarray as xr
-from datetime import datetime, timedelta
-import os
+import sys
+
+# the shared download engine lives one directory up, in data_download/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from download_engine import download_if_modified, load_validators, save_validators
+from netcdf_header import read_header, cdatetime, dispersion_name
+# stores the file under its dispersion_{CDATE}_{CTIME}.nc name without re-encoding it
+from ingest import ingest_file
+
 logger = logging.getLogger(__name__)
 
 # Set up logging
@@ -39,44 +42,42 @@ def get_latest_file():
         print('file_names[-1] in get_latest_file() failed')
     return ret_name
 
-## Download from URL
-# request from download URL
-response = requests.get(url, stream=True)
+# validators (ETag/Last-Modified) of the last forecast we stored, so we only download when the forecast changed
+validators_path = f"{tmp_dir}/validators.json"
 
-# get response header
-header = response.headers
-# download file if we see 'save as' content type
-# ref: https://stackoverflow.com/questions/20508788/do-i-need-content-type-application-octet-stream-for-file-download
-if 'Content-Type' in header and header['Content-Type'] == 'application/octet-stream':
-    with open(f'{tmp_dir}/dispersion.nc', mode="wb") as file:
-        file.write(response.content)
-        logging.info(f"Success: {url} -> {tmp_dir}")
-else: #otherwise inspect header's Content-Type
-    logging.error(f"Failed: {url} -> {tmp_dir} | Header Content-Type: {header['Content-Type']}")
+## Download from URL
+# conditional GET: when the current forecast is the one we already have the server sends no body and we stop here,
+# otherwise it is streamed in chunks to a temporary file that is only renamed to dispersion.nc once complete
+validators = download_if_modified(url, f'{tmp_dir}/dispersion.nc', load_validators(validators_path))
+if validators is None:
+    sys.exit(0)
 
 ## Verify we have a new file
-# if get_latest_file fails i.e. we have nothing in our final_dir, save the netcdf
-ds = xr.open_dataset(f'{tmp_dir}/dispersion.nc')
-ds_CDATE = ds.CDATE
-ds_CTIME = ds.CTIME
+# only the headers are read to compare creation timestamps; a new file is linked (or copied) to a temporary name
+# in final_dir and renamed into place, so final_dir never holds a partial file
+header = read_header(f'{tmp_dir}/dispersion.nc', tflag=False)
+ds_name = dispersion_name(header['attrs'])
+# check if we have already downloaded it
+# by comparing creation timestamps to the most recently downloaded dispersion.nc in final_dir
+# only reading that header is guarded: if final_dir is empty or its latest file can't be read, we save the netcdf
 try:
-    # open the NetCDF and check if we have already downloaded it 
-    # by comparing creation timestamps to the most recently downloaded dispersion.nc in final_dir
-    ds_last = xr.open_dataset(f'{final_dir}/{get_latest_file()}')
-    ds_last_CDATE = ds_last.CDATE
-    ds_last_CTIME = ds_last.CTIME
+    header_last = read_header(f'{final_dir}/{get_latest_file()}', tflag=False)
+except (IndexError, OSError) as e:
+    logging.error(f"Exception {e}")
+    header_last = None
 
-    # Convert to datetime objects, ensure it's zero-padded to be 6 digits
-    dt_downloaded = datetime.strptime(f"{ds_CDATE}{ds_CTIME:06}", "%Y%j%H%M%S")
-    dt_last = datetime.strptime(f"{ds_last_CDATE}{ds_last_CTIME:06}", "%Y%j%H%M%S")
+# Convert to datetime objects
+dt_downloaded = cdatetime(header['attrs'])
+dt_last = None if header_last is None else cdatetime(header_last['attrs'])
 
-    # If dt_last is younger save the dispersion.nc file as 'dispersion_{ds_CDATE}{ds_CTIME}.nc' in final_dir
-    if dt_last < dt_downloaded:
-        ds.to_netcdf(f"{final_dir}/dispersion_{ds_CDATE}_{ds_CTIME:06}.nc")
-        logging.info(f"Saved to {final_dir} as dispersion_{ds_CDATE}_{ds_CTIME:06}.nc")
-    else:
-        logging.info(f"Already have file saved in {final_dir} as dispersion_{ds_CDATE}_{ds_CTIME}.nc")
-except IndexError as e:
-    ds.to_netcdf(f"{final_dir}/dispersion_{ds_CDATE}_{ds_CTIME:06}.nc")
-    logging.error(f"Exception {e}")
-    logging.info(f"Saved to {final_dir} as dispersion_{ds_CDATE}_{ds_CTIME:06}.nc")
\ No newline at end of file
+# If dt_last is younger save the dispersion.nc file as 'dispersion_{ds_CDATE}{ds_CTIME}.nc' in final_dir
+# errors storing it (disk full, permissions) are not caught, the run fails and the validators aren't saved
+if dt_last is None or dt_last < dt_downloaded:
+    _, _, method = ingest_file(f'{tmp_dir}/dispersion.nc', final_dir)
+    logging.info(f"Saved to {final_dir} as {ds_name} ({method})")
+else:
+    logging.info(f"Already have file saved in {final_dir} as {ds_name}")
+
+# only remember the forecast as downloaded once it is stored in final_dir, if storing it fails we exit above with an
+# error and the next run downloads it again
+save_validators(validators_path, validators)
@@ -0,0 +1,81 @@
+### Store UBC Firesmoke NetCDF files under their dispersion_{CDATE}_{CTIME}.nc name without rewriting them. ###
+# Renaming used to be xr.open_dataset(file).to_netcdf(target), which decodes and re-encodes every file.
+# The name only depends on the header, so here we read the header and hard-link, reflink or byte-copy
+# the original file, which is much faster and keeps the files byte-identical to what UBC published.
+
+## Import libs
+import errno
+import os
+import shutil
+# reads CDATE/CTIME from the file header without decoding the dataset
+from netcdf_header import read_header, dispersion_name
+
+# ioctl request to clone a file's extents on copy-on-write file systems (btrfs, xfs), from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """
+    Make dst a copy-on-write clone of src, raise OSError if the file system doesn't support it
+    :param str src: path of the file to clone
+    :param str dst: path of the clone
+    """
+    # ref: https://man7.org/linux/man-pages/man2/ioctl_ficlone.2.html
+    import fcntl
+    with open(src, mode="rb") as src_file, open(dst, mode="wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst):
+    """
+    Make dst hold the same bytes as src as cheaply as possible, return which method was used
+    Tries a hard link first, then a reflink, then a plain byte copy (which the kernel does with
+    copy_file_range/sendfile). dst only ever shows up complete: the file is made under a temporary name
+    unique to this process and renamed to dst, replacing any file already there, so concurrent
+    workers storing files under the same name never fail with EEXIST.
+    :param str src: path of the original file
+    :param str dst: path to store the file under
+    """
+    tmp_path = f"{dst}.{os.getpid()}.part"
+    if os.path.exists(tmp_path):
+        # left over by a crashed run of a process with the same pid
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+        method = "link"
+    except OSError as e:
+        # EXDEV: different file system, EPERM/EMLINK: links not allowed here
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+        try:
+            reflink(src, tmp_path)
+            method = "reflink"
+        except (OSError, ImportError):
+            shutil.copyfile(src, tmp_path)
+            method = "copy"
+    # ref: https://docs.python.org/3/library/os.html#os.replace
+    os.replace(tmp_path, dst)
+    if os.path.lexists(tmp_path):
+        # rename does nothing if dst already is a link to the same file
+        os.remove(tmp_path)
+    return method
+
+
+def ingest_file(path, target_dir):
+    """
+    Store the NetCDF file at path in target_dir as dispersion_{CDATE}_{CTIME}.nc
+    Return a tuple (path, target path, method), where method is "link", "reflink", "copy" or "exists"
+    if a file of the same size is already stored under that name. A different file under that name is
+    replaced atomically.
+    :param str path: path of the downloaded NetCDF file
+    :param str target_dir: directory to store it in
+    """
+    target_path = f"{target_dir}/{dispersion_name(read_header(path, tflag=False)['attrs'])}"
+    if os.path.exists(target_path) and os.path.getsize(target_path) == os.path.getsize(path):
+        return path, target_path, "exists"
+    return path, target_path, link_or_copy(path, target_path)
@@ -0,0 +1,46 @@
+### Cached loader of firesmoke_metadata.nc, the tiny NetCDF the IDX is opened from with xarray. ###
+# Every dashboard session and notebook used to open it with xr.open_dataset, then build the lat/lon coordinates
+# and decode the TFLAGs one datetime at a time. Here the coordinated dataset is built once per version of the file
+# and engine, and later calls return a shallow copy of it. Any xarray engine can be used, e.g. openvisuspy's
+# OpenVisusBackendEntrypoint or the one in data_quality/metadata_creation/backend_v3.py.
+
+## Import libs
+import os
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+# decodes all TFLAGs at once
+from netcdf_header import decode_tflag
+
+# firesmoke datasets with their coordinates, by metadata file (real path, modification time, size) and open arguments
+skeletons = {}
+skeletons_lock = threading.Lock()
+
+
+def load_firesmoke_ds(path, engine, **kwargs):
+    """
+    Return the firesmoke metadata NetCDF at path opened with engine, with lat, lon and time coordinates
+    ROW and COL are replaced by lat and lon, computed from XORIG, XCELL, NCOLS, ..., and time holds the TFLAGs of
+    the first variable as datetime64. The dataset is built once per version of the file (real path, modification time
+    and size, so a rewritten file is opened again), engine and kwargs; later calls return a shallow copy of it:
+    coordinates and attributes can be changed, the data is shared and lazy. The data variables are the same objects for
+    every caller, so their values must not be modified in place, take ds.copy(deep=True) first.
+    :param str path: path of firesmoke_metadata.nc
+    :param engine: xarray backend to open it with, e.g. openvisuspy's OpenVisusBackendEntrypoint
+    :param kwargs: passed on to xr.open_dataset, e.g. chunks={} or resolution
+    """
+    stat = os.stat(path)
+    key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size, f"{engine.__module__}.{engine.__qualname__}",
+           repr(sorted(kwargs.items())))
+    with skeletons_lock:
+        ds = skeletons.get(key)
+    if ds is None:
+        ds = xr.open_dataset(path, engine=engine, **kwargs)
+        longitude = np.linspace(ds.XORIG, ds.XORIG + ds.XCELL * (ds.NCOLS - 1), ds.NCOLS)
+        latitude = np.linspace(ds.YORIG, ds.YORIG + ds.YCELL * (ds.NROWS - 1), ds.NROWS)
+        ds = ds.assign_coords(lat=('ROW', latitude), lon=('COL', longitude)).swap_dims({'COL': 'lon', 'ROW': 'lat'})
+        ds = ds.assign_coords(time=('time', pd.DatetimeIndex(decode_tflag(ds['TFLAG'].values[:, 0]))))
+        with skeletons_lock:
+            ds = skeletons.setdefault(key, ds)
+    return ds.copy(deep=False)
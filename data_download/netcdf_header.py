@@ -0,0 +1,64 @@
+### Lightweight metadata reader for the UBC Firesmoke NetCDF files. ###
+# Most of our scripts open a whole dispersion.nc with xarray only to look at CDATE/CTIME, TFLAG or the
+# dimension sizes. xarray decodes every variable and builds pandas indexes to do so; here we read the
+# header (global attributes and dimensions) and the TFLAG variable straight from netCDF/HDF5 instead.
+
+## Import libs
+# ref: https://unidata.github.io/netcdf4-python/
+import netCDF4
+import numpy as np
+from datetime import datetime
+
+
+def read_header(path, tflag=True):
+    """
+    Return the global attributes, dimension sizes and TFLAG of a NetCDF file, without decoding any data variable
+    :param str path: path of the NetCDF file
+    :param bool tflag: whether to also read the TFLAG variable
+    :return: dict with keys 'attrs' (dict of global attributes), 'sizes' (dict of dimension name to length)
+             and 'tflag' (int32 array of shape (TSTEP, 2) holding [YYYYDDD, HHMMSS] per timestep, or None)
+    """
+    with netCDF4.Dataset(path, mode="r") as nc:
+        attrs = {name: nc.getncattr(name) for name in nc.ncattrs()}
+        sizes = {name: len(dim) for name, dim in nc.dimensions.items()}
+        tflags = None
+        if tflag:
+            var = nc.variables['TFLAG']
+            # raw values, no masking or scaling
+            var.set_auto_maskandscale(False)
+            # TFLAG is (TSTEP, VAR, DATE-TIME) and the same for every VAR, only read the first one
+            tflags = np.asarray(var[:, 0, :])
+    return {'attrs': attrs, 'sizes': sizes, 'tflag': tflags}
+
+
+def cdatetime(attrs):
+    """
+    Return the creation date and time (CDATE, CTIME) of a file as a datetime object
+    :param dict attrs: global attributes of the file, e.g. read_header(path)['attrs']
+    """
+    # ensure CTIME is zero-padded to be 6 digits
+    return datetime.strptime(f"{attrs['CDATE']}{attrs['CTIME']:06}", "%Y%j%H%M%S")
+
+
+def dispersion_name(attrs):
+    """
+    Return the file name we store a file under, dispersion_{CDATE}_{CTIME}.nc
+    :param dict attrs: global attributes of the file, e.g. read_header(path)['attrs']
+    """
+    return f"dispersion_{attrs['CDATE']}_{attrs['CTIME']:06}.nc"
+
+
+def decode_tflag(tflag):
+    """
+    Return TFLAG values as numpy datetime64[s], for any number of TFLAGs at once
+    :param array tflag: int array of shape (..., 2), the last axis holding [YYYYDDD, HHMMSS]
+    """
+    tflag = np.asarray(tflag, dtype=np.int64)
+    date = tflag[..., 0]
+    time = tflag[..., 1]
+    # year and day of year from YYYYDDD, datetime64[Y] counts years since 1970
+    days = (date // 1000 - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    days = days + (date % 1000 - 1).astype('timedelta64[D]')
+    # hours, minutes and seconds from HHMMSS
+    seconds = time // 10000 * 3600 + (time % 10000) // 100 * 60 + time % 100
+    return days.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
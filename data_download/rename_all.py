@@ -1,8 +1,12 @@
 ### Here we rename all downloaded UBC Firesmoke NetCDF files to be `dispersion_{CDATE}_{CTIME}.nc`. ###
+# Files are hard-linked (or reflinked/copied) under their new name, not decoded and rewritten,
+# so the renamed files are byte-identical to the downloaded ones.
 
 ## Import libs
-import xarray as xr
+import concurrent.futures
 import os
+# reads the header and links/copies the file under its new name
+from ingest import ingest_file
 # ref: https://docs.python.org/3/library/logging.html
 import logging
 
@@ -33,23 +37,26 @@ subdirs = [
 # to store all renamed files
 tmp_dir = f'{parent_dir}/tmp'
 
-for subdir in subdirs:
-    curr_dir = f'{parent_dir}/{subdir}'
-    # get list of files in curr_dir
-    file_names = sorted(os.listdir(curr_dir))
-
-    # ensure subdir exists in tmp_dir
-    target_subdir = f"{tmp_dir}/{subdir}"
-    os.makedirs(target_subdir, exist_ok=True)
-
-    # save each file in curr_dir
-    for file_name in file_names:
-        file = f'{curr_dir}/{file_name}'
-        ds = xr.open_dataset(file)
-        ds_CDATE = ds.CDATE
-        ds_CTIME = ds.CTIME
-
-        # save to tmp_dir/subdir
-        target_path = f"{target_subdir}/dispersion_{ds_CDATE}_{ds_CTIME:06}.nc"
-        ds.to_netcdf(target_path)
-        logging.info(f"Saved {file} to {target_subdir} as dispersion_{ds_CDATE}_{ds_CTIME:06}.nc")
\ No newline at end of file
+if __name__ == "__main__":
+    # [file, target_subdir] for every file in every subdir
+    jobs = []
+    for subdir in subdirs:
+        curr_dir = f'{parent_dir}/{subdir}'
+
+        # ensure subdir exists in tmp_dir
+        target_subdir = f"{tmp_dir}/{subdir}"
+        os.makedirs(target_subdir, exist_ok=True)
+
+        # get list of files in curr_dir, skipping unfinished downloads
+        file_names = sorted(f for f in os.listdir(curr_dir) if not f.endswith(".part"))
+        jobs.extend([f'{curr_dir}/{file_name}', target_subdir] for file_name in file_names)
+
+    # reading headers and linking is I/O bound per file, so spread files over a process pool
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        future_to_file = {executor.submit(ingest_file, file, target_subdir): file for file, target_subdir in jobs}
+        for future in concurrent.futures.as_completed(future_to_file):
+            try:
+                file, target_path, method = future.result()
+                logging.info(f"Saved {file} as {target_path} ({method})")
+            except Exception as e:
+                logging.error(f"Failed to rename {future_to_file[future]}: {e}")
@@ -1,5 +1,13 @@
 # Ensure that we have copied all files in stop_gaps and union_set into final_union_set
+# Files are compared by name *and* content: we keep a persistent index of size + content hash per file,
+# so only new or modified files are hashed again on the next run.
+import concurrent.futures
+import hashlib
+import json
 import os
+from collections import defaultdict
+# links (or copies) a file into final_union_set without rewriting it
+from ingest import link_or_copy
 
 parent_dir = "/opt/wired-data/firesmoke"
 
@@ -17,37 +25,159 @@ subdirs = [
 # directory to store union of all files in dirs above
 final_union_set_dir = f"{parent_dir}/final_union_set"
 
-# get list of files currently in final_union_set_dir
-final_union_set_files = sorted(os.listdir(final_union_set_dir))
+# persistent index of {path: {size, mtime, hash}}
+index_path = f"{parent_dir}/union_index.json"
+
+# set to True to copy files missing from final_union_set into it
+copy_missing = False
+
+# number of files hashed/copied at once
+max_workers = 16
+
+# read files in chunks of this size when hashing
+chunk_size = 1024 * 1024
+
+
+def content_hash(path):
+    """
+    Return a fast hash (blake2b) of the file's content
+    :param str path: path of the file to hash
+    """
+    # hashlib releases the GIL while hashing, so this parallelizes well over threads
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, mode="rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_index(path):
+    """
+    Return the persistent index at path, or an empty one
+    :param str path: path of the JSON index
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_index(path, index):
+    """
+    Atomically save index to path
+    :param str path: path of the JSON index
+    :param dict index: the index to save
+    """
+    with open(path + ".part", mode="w") as f:
+        json.dump(index, f)
+    os.replace(path + ".part", path)
+
+
+def update_index(index, dirs):
+    """
+    Add every file in dirs to index, only hashing files that are new or changed since they were indexed
+    Return a dict of {dir: {file name: index entry}} for the files currently in dirs.
+    :param dict index: the persistent index, updated in place
+    :param list dirs: directories to index
+    """
+    listing = {d: {} for d in dirs}
+    to_hash = []
+    for d in dirs:
+        for file in os.listdir(d):
+            if file.endswith(".part"):
+                continue
+            path = f"{d}/{file}"
+            stat = os.stat(path)
+            entry = index.get(path)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None}
+                to_hash.append(path)
+            index[path] = entry
+            listing[d][file] = entry
+
+    print(f"Hashing {len(to_hash)} new or modified files")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for path, digest in zip(to_hash, executor.map(content_hash, to_hash)):
+            index[path]['hash'] = digest
+
+    # forget files that no longer exist in the directories we index
+    for path in [p for p in index if os.path.dirname(p) in listing and os.path.basename(p) not in listing[os.path.dirname(p)]]:
+        del index[path]
+    return listing
+
+
+# build the index once, then every lookup below is a dict/set lookup
+index = load_index(index_path)
+dirs = [f"{parent_dir}/{subdir}" for subdir in subdirs] + [final_union_set_dir]
+listing = update_index(index, dirs)
+save_index(index_path, index)
+
+final_union_set_files = listing[final_union_set_dir]
+final_union_set_hashes = {entry['hash'] for entry in final_union_set_files.values()}
 
 # to store any files not in final_union_set dir but is in subdir
-missing_files = {
-    subdir: [] for subdir in subdirs
-}
+missing_files = {subdir: [] for subdir in subdirs}
+# files with the same name in subdir and final_union_set, but different content
+differing_files = {subdir: [] for subdir in subdirs}
+# files whose name is missing from final_union_set, but whose content is there under another name
+renamed_files = {subdir: [] for subdir in subdirs}
 
-# populate missing_files dict
+# populate the dicts above
 for subdir in subdirs:
-    files = sorted(os.listdir(f"{parent_dir}/{subdir}"))
-    for file in files:
+    for file, entry in sorted(listing[f"{parent_dir}/{subdir}"].items()):
         if file not in final_union_set_files:
-            missing_files[subdir].append(file)
+            if entry['hash'] in final_union_set_hashes:
+                renamed_files[subdir].append(file)
+            else:
+                missing_files[subdir].append(file)
+        elif final_union_set_files[file]['hash'] != entry['hash']:
+            differing_files[subdir].append(file)
+
+# files with identical content, across all directories
+paths_by_hash = defaultdict(list)
+for d in dirs:
+    for file, entry in listing[d].items():
+        paths_by_hash[entry['hash']].append(f"{d}/{file}")
+# a file copied from a subdir into final_union_set is expected to have one twin, report the names that disagree
+duplicate_content = {digest: paths for digest, paths in paths_by_hash.items()
+                     if len({os.path.basename(p) for p in paths}) > 1}
 
 # print results
-for subdir, files in missing_files.items():
-    print(f"Number of missing files: {len(files)}")
-    print(f"{subdir}: {files}")
+for subdir in subdirs:
+    print(f"Number of missing files: {len(missing_files[subdir])}")
+    print(f"{subdir}: {missing_files[subdir]}")
+    print(f"Number of files differing from final_union_set: {len(differing_files[subdir])}")
+    print(f"{subdir}: {differing_files[subdir]}")
+    print(f"Number of files in final_union_set under another name: {len(renamed_files[subdir])}")
+    print(f"{subdir}: {renamed_files[subdir]}")
     print("---")
+print(f"Number of sets of files with duplicate content under different names: {len(duplicate_content)}")
+for digest, paths in duplicate_content.items():
+    print(f"{digest}: {sorted(paths)}")
+print("---")
+
+# copy files not in final_union_set, into final_union_set
+# files whose content is already in final_union_set are skipped, as are name clashes with different content
+if copy_missing:
+    copies = {}
+    copied_names = set()
+    for subdir, files in missing_files.items():
+        for file in files:
+            digest = listing[f"{parent_dir}/{subdir}"][file]['hash']
+            # the same content may be missing from several subdirs, only copy it once
+            if digest in copies:
+                continue
+            if file in copied_names:
+                print(f"Skipping {parent_dir}/{subdir}/{file}; a different file of the same name is being copied.")
+                continue
+            copies[digest] = (f"{parent_dir}/{subdir}/{file}", f"{final_union_set_dir}/{file}")
+            copied_names.add(file)
 
-# # copy files not in final_union_set, into final_union_set
-# for subdir, files in missing_files.items():
-#     for file in files:
-#         curr_dir_file = f"{parent_dir}/{subdir}/{file}"
-#         save_dir_file = f"{final_union_set_dir}/{file}"
-#         # copy file to final_union_set_dir
-#         if not os.path.exists(save_dir_file):
-#             with open(curr_dir_file, "rb") as curr_file:
-#                 with open(save_dir_file, "wb") as save_file:
-#                     save_file.write(curr_file.read())
-#             print(f"Copied {curr_dir_file} -> {save_dir_file}")
-#         else:
-#             print(f"Skipping {curr_dir_file}; {save_dir_file} already exists.")
\ No newline at end of file
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_copy = {executor.submit(link_or_copy, src, dst): (src, dst) for src, dst in copies.values()}
+        for future in concurrent.futures.as_completed(future_to_copy):
+            src, dst = future_to_copy[future]
+            try:
+                print(f"Copied {src} -> {dst} ({future.result()})")
+            except OSError as e:
+                print(f"Failed to copy {src} -> {dst}: {e}")
@@ -1,15 +1,632 @@
 import xarray as xr
 import numpy  as np
 import pandas as pd
+from collections import OrderedDict
 import concurrent.futures
+import json
+import random
+import threading
+import time
 
 import os
+import sys
 
 # !pip install OpenVisusNoGui
 import OpenVisus as ov
 
+# cached loader of the metadata NetCDF, shared with the dashboard and notebooks, in data_download/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data_download'))
+import metadata_loader
+
 # see https://xarray.pydata.org/en/stable/internals/how-to-add-new-backend.html
 
+# size of the preferred dask chunks, every chunk is a range of whole timesteps (whole IDX files, so IDX blocks
+# are never split between chunks), rounded down to whole days of hourly timesteps
+# ref: https://docs.xarray.dev/en/stable/internals/how-to-add-new-backend.html#preferred-chunk-sizes
+CHUNK_BYTES = 128 * 1024**2
+HOURS_PER_DAY = 24
+
+# number of threads reading from IDX, shared by all datasets of the process
+READ_WORKERS = int(os.environ.get("OPENVISUS_READ_WORKERS", 20))
+
+# RAM budget of the cache of tiles read from IDX, shared by all datasets of the process, 0 disables it
+CACHE_BYTES = int(os.environ.get("OPENVISUS_CACHE_BYTES", 512 * 1024**2))
+
+# files the conversion updates next to the IDX whenever it rewrites data, see dataset_version
+VERSION_FILES = ("conversion_journal.jsonl", "idx_calls_written.npy", "aggregates.json")
+
+# time-major sidecar written next to the IDX by conversion/idx_time_major.py, see TimeMajorReader
+TIME_MAJOR = "time_major"
+TIME_MAJOR_META = "time_major.json"
+TIME_MAJOR_FILLED = "filled.npy"
+
+# daily and monthly aggregates written next to the IDX by conversion/idx_aggregates.py, see aggregate_variables
+AGGREGATES_META = "aggregates.json"
+AGGREGATE_IDX = {'daily': "firesmoke_daily.idx", 'monthly': "firesmoke_monthly.idx"}
+AGGREGATE_DIMS = {'daily': ('day', 'D'), 'monthly': ('month', 'M')}
+
+
+def begin_query(db, fieldname, timestep, res, box):
+    """
+    Return a started OpenVisus query reading box at resolution res, the same query db.read runs
+    :param PyDataset db: the IDX
+    :param str fieldname: field to read
+    :param int timestep: timestep to read
+    :param int res: resolution to read at, or a list of increasing resolutions for a progressive query
+    :param tuple box: (x1, y1, x2, y2) logic box to read
+    """
+    x1, y1, x2, y2 = box
+    query=db.db.createBoxQuery(ov.BoxNi(ov.PointNi([x1, y1]), ov.PointNi([x2, y2])), db.getField(fieldname), timestep, ord('r'))
+    query.enableFilters()
+    # a progressive query is executed once per resolution, see read_progressive
+    for r in (res if isinstance(res, (list, tuple)) else [res]):
+        query.end_resolutions.push_back(int(r))
+    db.db.beginBoxQuery(query)
+    if not query.isRunning():
+        raise Exception("begin query failed {0}".format(query.errormsg))
+    return query
+
+
+def read_blocks(db, fieldname, timestep, res, box, blocks, out):
+    """
+    Read box at resolution res into out from the given IDX blocks, without finding again which blocks hold box
+    Blocks missing from the timestep leave their samples 0, as with db.read.
+    :param list blocks: ids of the blocks holding box at resolution res, as returned by plan_blocks
+    :param np.ndarray out: box_shape array the data is read into
+    """
+    query=begin_query(db, fieldname, timestep, res, box)
+    out[...]=0
+    query.buffer=ov.Array.fromNumPy(out, bShareMem=True)
+    access=db.db.createAccess()
+    field=db.getField(fieldname)
+    access.beginRead()
+    try:
+        for block in blocks:
+            block_query=db.db.createBlockQuery(block, field, timestep, ord('r'), ov.Aborted())
+            db.db.executeBlockQueryAndWait(access, block_query)
+            if block_query.ok():
+                db.db.mergeBoxQueryWithBlockQuery(query, block_query)
+    finally:
+        access.endRead()
+    return out
+
+
+def plan_blocks(db, fieldname, timestep, res, box):
+    """Return the ids of the IDX blocks a query of box at resolution res reads, the same for every timestep"""
+    return list(db.db.createBlockQueriesForBoxQuery(begin_query(db, fieldname, timestep, res, box)))
+
+
+def level_strides(db, res):
+    """
+    Return the (x, y) distance between the samples read at resolution res, in full resolution logic coordinates
+    Every level of the bitmask past res halves the samples along its axis ('0' for x, '1' for y).
+    """
+    bits=db.getBitmask().toString()[1 + res:]
+    return 2 ** bits.count('0'), 2 ** bits.count('1')
+
+
+def box_shape(box, strides):
+    """
+    Return the numpy shape of the data OpenVisus reads for box, the samples on the lattice of strides inside it
+    :param tuple box: (x1, y1, x2, y2) logic box
+    :param tuple strides: (x, y) strides, as returned by level_strides
+    """
+    (x1, y1, x2, y2), (sx, sy) = box, strides
+    # samples at multiples of the stride, -(-a // b) is ceil
+    return (-(-y2 // sy) - -(-y1 // sy), -(-x2 // sx) - -(-x1 // sx))
+
+
+def tile_size(db, res):
+    """
+    Return the (x, y) size of the cached tiles at resolution res, the area one IDX block covers at full resolution
+    Tiles are at least one sample wide, so each tile covers whole samples of the level.
+    """
+    idx=db.db.idxfile
+    bits=db.getBitmask().toString()[-idx.bitsperblock:]
+    sx, sy=level_strides(db, res)
+    return max(2 ** bits.count('0'), sx), max(2 ** bits.count('1'), sy)
+
+
+def covering_tiles(box, tile, size):
+    """
+    Return the boxes of the tiles covering box, aligned on multiples of tile and clipped to the dataset
+    :param tuple box: (x1, y1, x2, y2) logic box
+    :param tuple tile: (x, y) tile size, as returned by tile_size
+    :param list size: (x, y) logic size of the dataset
+    """
+    (x1, y1, x2, y2), (tx, ty) = box, tile
+    return [(x, y, min(x + tx, int(size[0])), min(y + ty, int(size[1])))
+            for y in range(y1 // ty * ty, y2, ty) for x in range(x1 // tx * tx, x2, tx)]
+
+
+def copy_tile(out, box, data, data_box, strides):
+    """
+    Copy the samples of data, read for data_box, that are inside box into out, the array read for box
+    """
+    slices_out, slices_data=[], []
+    # y then x, the numpy order; samples are numbered by their position on the lattice of the level (-(-a // b) is ceil)
+    for a, b, tile_a, tile_b, stride in [(box[1], box[3], data_box[1], data_box[3], strides[1]),
+                                         (box[0], box[2], data_box[0], data_box[2], strides[0])]:
+        first, last=-(-a // stride), -(-b // stride)
+        tile_first, tile_last=-(-tile_a // stride), -(-tile_b // stride)
+        start, stop=max(first, tile_first), min(last, tile_last)
+        slices_out.append(slice(start - first, stop - first))
+        slices_data.append(slice(start - tile_first, stop - tile_first))
+    out[tuple(slices_out)]=data[tuple(slices_data)]
+
+
+def upsample(data, box, strides, fine_strides):
+    """
+    Return data, read for box with strides, repeated to the shape box has with the finer fine_strides
+    Each sample covers the finer samples up to the next one, the ones before the first sample repeat it.
+    """
+    index=[]
+    for a, b, stride, fine_stride in [(box[1], box[3], strides[1], fine_strides[1]),
+                                      (box[0], box[2], strides[0], fine_strides[0])]:
+        fine=np.arange(-(-a // fine_stride), -(-b // fine_stride)) * fine_stride
+        index.append(np.clip(fine // stride - -(-a // stride), 0, None))
+    return data[np.ix_(*index)]
+
+
+def read_progressive(db, fieldname, timestep, box, resolutions, fill=False):
+    """
+    Yield (resolution, data) for box at each of resolutions, coarse to fine, from one OpenVisus progressive query
+    Each level only reads the blocks the coarser ones didn't, so a coarse field comes back in milliseconds and the
+    full resolution one costs about a single read. Closing the generator stops the query.
+    :param PyDataset db: the IDX
+    :param str fieldname: field to read
+    :param int timestep: timestep to read
+    :param tuple box: (x1, y1, x2, y2) logic box to read
+    :param list resolutions: resolutions to read at, levels without any sample in box are skipped
+    :param bool fill: repeat the samples of coarser levels to the shape of the finest one, to refine a plot in place
+    """
+    resolutions=sorted(r for r in set(resolutions) if 0 not in box_shape(box, level_strides(db, r)))
+    if not resolutions:
+        return
+    finest=level_strides(db, resolutions[-1])
+    query=begin_query(db, fieldname, timestep, resolutions, box)
+    access=db.db.createAccess()
+    while query.isRunning():
+        if not db.db.executeBoxQuery(access, query):
+            raise Exception("query error {0}".format(query.errormsg))
+        res=int(query.getCurrentResolution())
+        data=ov.Array.toNumPy(query.buffer, bShareMem=False)
+        if fill and res!=resolutions[-1]:
+            data=upsample(data, box, level_strides(db, res), finest)
+        yield res, data
+        db.db.nextBoxQuery(query)
+
+
+def block_area(db, level):
+    """
+    Return the (x, y) size of the area each IDX block of level covers, the first block holds all the coarser levels
+    The blocks of a level split the dataset along the first level - 1 - bitsperblock bits of the bitmask.
+    """
+    bitmask, bitsperblock=db.getBitmask().toString()[1:], db.db.idxfile.bitsperblock
+    splits=bitmask[:max(0, level - 1 - bitsperblock)]
+    return 2 ** (bitmask.count('0') - splits.count('0')), 2 ** (bitmask.count('1') - splits.count('1'))
+
+
+def blocks_read(db, res, box):
+    """
+    Return the number of IDX blocks a query of box at resolution res reads: the first block, which holds all the
+    coarse levels, and for each finer level with samples in box the blocks of that level whose area intersects it
+    """
+    x1, y1, x2, y2 = box
+    bitsperblock=db.db.idxfile.bitsperblock
+    count=int(0 not in box_shape(box, level_strides(db, min(res, bitsperblock))))
+    for level in range(bitsperblock + 1, res + 1):
+        # the samples of a level are those of its resolution that the previous one doesn't have
+        if np.prod(box_shape(box, level_strides(db, level))) == np.prod(box_shape(box, level_strides(db, level - 1))):
+            continue
+        bx, by=block_area(db, level)
+        count+=((x2 - 1) // bx - x1 // bx + 1) * ((y2 - 1) // by - y1 // by + 1)
+    return count
+
+
+def snap_points(db, res, rows, cols):
+    """
+    Return rows, cols moved to the nearest sample of resolution res inside the dataset, as int arrays
+    :param PyDataset db: the IDX
+    :param int res: resolution the points are read at
+    :param np.ndarray rows: full resolution row (y) indices
+    :param np.ndarray cols: full resolution column (x) indices
+    """
+    (sx, sy), size=level_strides(db, res), db.getLogicSize()
+    rows=np.clip(np.round(np.asarray(rows) / sy).astype(int) * sy, 0, (int(size[1]) - 1) // sy * sy)
+    cols=np.clip(np.round(np.asarray(cols) / sx).astype(int) * sx, 0, (int(size[0]) - 1) // sx * sx)
+    return rows, cols
+
+
+# ////////////////////////////////////////////////////////////
+class BlockCache:
+    """
+    In-memory LRU cache of the tiles read from IDX, keyed by ((url, version), field, timestep, resolution, logic box)
+    Tiles follow the IDX blocks (see tile_size), so overlapping slices share tiles. The least recently used tiles
+    are evicted once the cached tiles take more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        """
+        :param int max_bytes: RAM budget of the cached tiles, 0 disables the cache
+        """
+        self.max_bytes=max_bytes
+        self.lock=threading.Lock()
+        self.entries=OrderedDict()
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def get(self, key):
+        """Return the cached tile of key, None if it isn't cached. Cached tiles must not be modified."""
+        with self.lock:
+            data=self.entries.get(key)
+            if data is None:
+                self.misses+=1
+                return None
+            self.entries.move_to_end(key)
+            self.hits+=1
+            return data
+
+    def put(self, key, data):
+        """Cache the tile of key, evicting the least recently used tiles over the budget"""
+        if data.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old=self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes-=old.nbytes
+            self.entries[key]=data
+            self.nbytes+=data.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old=self.entries.popitem(last=False)
+                self.nbytes-=old.nbytes
+                self.evictions+=1
+
+    def stats(self):
+        """Return a dict of the hit, miss and eviction counters and the size of the cache"""
+        with self.lock:
+            lookups=self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'evictions': self.evictions, 'tiles': len(self.entries), 'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def discard(self, source):
+        """Drop the tiles of source, the (url, version) of an IDX, e.g. once the IDX was rewritten"""
+        with self.lock:
+            for key in [key for key in self.entries if key[0]==source]:
+                self.nbytes-=self.entries.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes=0
+
+
+# ////////////////////////////////////////////////////////////
+class ReadScheduler:
+    """
+    Long lived thread pool all db.read calls of the backend go through
+    Failed reads are retried with jittered exponential backoff. Identical reads in flight at the same time (same
+    dataset, field, timestep, resolution and box) are only issued once, and reads nobody waits for anymore are
+    cancelled, e.g. when a dashboard moves on to another slice before the previous one finished.
+    """
+
+    def __init__(self, max_workers=READ_WORKERS, max_attempts=5, retry_delay=1.0, max_retry_delay=30.0, max_plans=1024):
+        """
+        :param int max_workers: number of reading threads
+        :param int max_attempts: number of times a read is tried before giving up
+        :param float retry_delay: delay before the first retry in seconds, doubled for each following one
+        :param float max_retry_delay: longest delay between two attempts in seconds
+        :param int max_plans: number of (dataset, resolution, box) whose IDX blocks are remembered by read_series
+        """
+        self.max_workers=max_workers
+        self.max_attempts=max_attempts
+        self.retry_delay=retry_delay
+        self.max_retry_delay=max_retry_delay
+        self.max_plans=max_plans
+        self.executor=None
+        self.lock=threading.Lock()
+        # read key -> [future, number of callers waiting for it, event set once nobody does]
+        self.in_flight={}
+        # (source, resolution, box) -> ids of the IDX blocks holding box, least recently used first
+        self.plans=OrderedDict()
+
+    def _read(self, db, key, abandoned, out, blocks=None):
+        fieldname, timestep, res, box = key[1:]
+        for attempt in range(self.max_attempts):
+            if abandoned.is_set():
+                raise concurrent.futures.CancelledError()
+            try:
+                if blocks is not None:
+                    return read_blocks(db, fieldname, timestep, res, box, blocks, out)
+                query=begin_query(db, fieldname, timestep, res, box)
+                # OpenVisus writes the data straight into out
+                buffer=ov.Array.fromNumPy(out, bShareMem=True)
+                query.buffer=buffer
+                if not db.db.executeBoxQuery(db.db.createAccess(), query):
+                    raise Exception("query error {0}".format(query.errormsg))
+                return out
+            except Exception as e:
+                if attempt == self.max_attempts - 1:
+                    print(f"Failed to fetch timestep {timestep} after {self.max_attempts} attempts: {e}")
+                    raise
+                # full jitter, so clients failing together don't retry together
+                # ref: https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+                delay=random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2**attempt))
+                if abandoned.wait(delay):
+                    raise concurrent.futures.CancelledError()
+
+    def submit(self, db, source, fieldname, timestep, res, box, out, blocks=None):
+        """
+        Return (key, future) of the read of one timestep into out, started unless the same read is already in flight
+        The future's result is the array the data was read into, which is another caller's out if the read was
+        already in flight. Every key must be given back with release() once its result is no longer needed.
+        :param list blocks: ids of the IDX blocks holding box (see plan_blocks), None to let OpenVisus find them
+        """
+        key=read_key(source, fieldname, timestep, res, box)
+        with self.lock:
+            if self.executor is None:
+                self.executor=concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="openvisus-read")
+            entry=self.in_flight.get(key)
+            # join the read in flight, unless it was abandoned and is being cancelled
+            if entry is not None and not entry[2].is_set():
+                entry[1]+=1
+                return key, entry[0]
+            abandoned=threading.Event()
+            future=self.executor.submit(self._read, db, key, abandoned, out, blocks)
+            self.in_flight[key]=[future, 1, abandoned]
+        future.add_done_callback(lambda future: self._done(key, future))
+        return key, future
+
+    def _done(self, key, future):
+        # later reads of the same key start over, finished reads are not shared
+        with self.lock:
+            if key in self.in_flight and self.in_flight[key][0] is future:
+                del self.in_flight[key]
+
+    def release(self, keys):
+        """Stop waiting for the given reads, cancelling those nobody else waits for"""
+        abandoned=[]
+        with self.lock:
+            for key in keys:
+                entry=self.in_flight.get(key)
+                if entry is None:
+                    continue
+                entry[1]-=1
+                if entry[1]==0:
+                    entry[2].set()
+                    abandoned.append(entry[0])
+        # cancelling runs the done callbacks, which take the lock
+        for future in abandoned:
+            future.cancel()
+
+    def discard(self, source):
+        """Forget the block plans of source, the (url, version) of an IDX"""
+        with self.lock:
+            for key in [key for key in self.plans if key[0]==source]:
+                del self.plans[key]
+
+    def read_timesteps(self, db, source, fieldname, timesteps, res, box, out, cache=None):
+        """
+        Read the data of box at resolution res for each of timesteps into out[i], in parallel, return out
+        With a cache, box is read as the tiles covering it: cached tiles are copied from RAM, the others are read
+        with one query per timestep, split into tiles and cached. If the caller stops waiting (an exception, KeyboardInterrupt, ...) its pending reads
+        are cancelled.
+        :param PyDataset db: the IDX
+        :param tuple source: (url, version) of the IDX, identifies its data between callers, see dataset_version
+        :param str fieldname: field to read
+        :param list timesteps: timesteps to read
+        :param int res: resolution to read at
+        :param tuple box: (x1, y1, x2, y2) logic box to read
+        :param np.ndarray out: preallocated (len(timesteps),) + box_shape array
+        :param BlockCache cache: cache of tiles, None to read box directly into out
+        """
+        if out.size==0:
+            # OpenVisus fails on boxes without any sample at this resolution
+            return out
+        if cache is None or cache.max_bytes==0:
+            return self._read_direct(db, source, fieldname, timesteps, res, box, out)
+
+        strides=level_strides(db, res)
+        tiles=covering_tiles(box, tile_size(db, res), db.getLogicSize())
+        reads=[]
+        try:
+            for i, t in enumerate(timesteps):
+                missing=[]
+                for tile_box in tiles:
+                    data=cache.get(read_key(source, fieldname, t, res, tile_box))
+                    if data is None:
+                        missing.append(tile_box)
+                    else:
+                        copy_tile(out[i], box, data, tile_box, strides)
+                if missing:
+                    # one query for the box around the missing tiles, tile aligned so it splits into tiles exactly
+                    read_box=(min(b[0] for b in missing), min(b[1] for b in missing), max(b[2] for b in missing), max(b[3] for b in missing))
+                    data=np.empty(box_shape(read_box, strides), dtype=out.dtype)
+                    reads.append((i, t, read_box, missing) + self.submit(db, source, fieldname, t, res, read_box, data))
+            for n, (i, t, read_box, missing, key, future) in enumerate(reads):
+                data=future.result()
+                copy_tile(out[i], box, data, read_box, strides)
+                # tiles are copied, so evicting one frees its memory
+                for tile_box in missing:
+                    tile=np.empty(box_shape(tile_box, strides), dtype=out.dtype)
+                    copy_tile(tile, tile_box, data, read_box, strides)
+                    cache.put(read_key(source, fieldname, t, res, tile_box), tile)
+                # drop the read buffer as soon as it is split
+                reads[n]=(i, t, read_box, missing, key, None)
+                del data
+            return out
+        finally:
+            self.release([read[4] for read in reads])
+
+    def read_points(self, db, source, fieldname, timesteps, res, rows, cols, out):
+        """
+        Read the samples at (rows[i], cols[i]) for each of timesteps into out[i, j], in parallel, return out
+        Each group of points is read as the smallest box around them, so only the blocks holding points are read,
+        however many timesteps. Points are read one by one, grouped by the IDX block of level res they fall in, or
+        all in one box, whichever reads the fewest blocks: a box of several samples also reads the blocks of the
+        coarser levels, so points spread over most of the dataset are cheaper to read at once. Timesteps are read in
+        batches of about CHUNK_BYTES of boxes. Point reads scan time, so they bypass the cache instead of flushing it.
+        :param PyDataset db: the IDX
+        :param tuple source: (url, version) of the IDX, identifies its data between callers, see dataset_version
+        :param str fieldname: field to read
+        :param list timesteps: timesteps to read
+        :param int res: resolution to read at
+        :param np.ndarray rows: row (y) of each point, on the lattice of res (see snap_points)
+        :param np.ndarray cols: column (x) of each point, on the lattice of res
+        :param np.ndarray out: preallocated (len(rows), len(timesteps)) array
+        """
+        if out.size==0:
+            return out
+        strides, (bx, by)=level_strides(db, res), block_area(db, res)
+        # group numbers of the points: by sample, by block (numbered row by row) or all together
+        width=int(db.getLogicSize()[0])
+        groupings=[rows * width + cols, rows // by * (width // bx + 1) + cols // bx, np.zeros_like(rows)]
+        grouping=min(groupings, key=lambda grouping: sum(blocks_read(db, res, points_box(rows[grouping==g], cols[grouping==g]))
+                                                         for g in np.unique(grouping)))
+        groups=[]
+        for g in np.unique(grouping):
+            points=np.nonzero(grouping==g)[0]
+            r, c=rows[points], cols[points]
+            box=points_box(r, c)
+            # position of each point in the data read for box, the box starts on a sample
+            groups.append((points, box, (r - box[1]) // strides[1], (c - box[0]) // strides[0]))
+        frame_bytes=out.dtype.itemsize * sum(int(np.prod(box_shape(box, strides))) for _, box, _, _ in groups)
+        batch=max(1, CHUNK_BYTES // frame_bytes)
+
+        for start in range(0, len(timesteps), batch):
+            batch_timesteps=timesteps[start:start + batch]
+            reads=[]
+            try:
+                for points, box, r, c in groups:
+                    data=np.empty((len(batch_timesteps),) + box_shape(box, strides), dtype=out.dtype)
+                    reads.append((points, r, c, [self.submit(db, source, fieldname, t, res, box, data[i]) for i, t in enumerate(batch_timesteps)]))
+                for points, r, c, group_reads in reads:
+                    for i, (_, future) in enumerate(group_reads):
+                        out[points, start + i]=future.result()[r, c]
+            finally:
+                self.release([key for read in reads for key, _ in read[3]])
+        return out
+
+    def read_series(self, db, source, fieldname, timesteps, res, box, out, time_major=None):
+        """
+        Read the data of box at resolution res for each of timesteps into out[i], for long series of small boxes
+        Full resolution series are read from the time-major sidecar when it has all of timesteps, with one read per
+        chunk of timesteps. Otherwise all timesteps are read in parallel from the IDX blocks holding box, which are
+        found once and remembered for the next series of the same box. Series bypass the cache instead of flushing it.
+        :param PyDataset db: the IDX
+        :param tuple source: (url, version) of the IDX, identifies its data between callers, see dataset_version
+        :param str fieldname: field to read
+        :param list timesteps: timesteps to read
+        :param int res: resolution to read at
+        :param tuple box: (x1, y1, x2, y2) logic box to read
+        :param np.ndarray out: preallocated (len(timesteps),) + box_shape array
+        :param TimeMajorReader time_major: sidecar of the IDX, None to always read the IDX
+        """
+        if out.size==0:
+            return out
+        if time_major is not None and res==db.getMaxResolution() and time_major.read(fieldname, timesteps, box, out):
+            return out
+        key=(source, int(res), tuple(int(v) for v in box))
+        with self.lock:
+            blocks=self.plans.get(key)
+            if blocks is not None:
+                self.plans.move_to_end(key)
+        if blocks is None:
+            blocks=plan_blocks(db, fieldname, timesteps[0], res, box)
+            with self.lock:
+                self.plans[key]=blocks
+                while len(self.plans) > self.max_plans:
+                    self.plans.popitem(last=False)
+        return self._read_direct(db, source, fieldname, timesteps, res, box, out, blocks)
+
+    def _read_direct(self, db, source, fieldname, timesteps, res, box, out, blocks=None):
+        reads=[]
+        try:
+            for i, t in enumerate(timesteps):
+                reads.append(self.submit(db, source, fieldname, t, res, box, out[i], blocks))
+            for i, (_, future) in enumerate(reads):
+                data=future.result()
+                # only reads joined while in flight come back in another caller's buffer
+                if not np.may_share_memory(data, out):
+                    out[i]=data
+            return out
+        finally:
+            self.release([key for key, _ in reads])
+
+
+def points_box(rows, cols):
+    """Return the smallest (x1, y1, x2, y2) logic box holding the points"""
+    return int(cols.min()), int(rows.min()), int(cols.max()) + 1, int(rows.max()) + 1
+
+
+def dataset_version(url):
+    """
+    Return a token that changes whenever the data of the local IDX at url is rewritten, None for a remote IDX
+    The conversion (conversion/idx_job.py, idx_incremental.py, idx_aggregates.py) appends to its journal for every
+    timestep it clears or writes, and rewrites the .idx or the records next to it when it extends or updates the IDX,
+    so their modification times and sizes tell cached reads of the old data apart from the new.
+    """
+    if "://" in url and not url.startswith("file://"):
+        return None
+    path=url[len("file://"):] if url.startswith("file://") else url
+    version=[]
+    for name in [path] + [os.path.join(os.path.dirname(path), name) for name in VERSION_FILES]:
+        try:
+            stat=os.stat(name)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def read_key(source, fieldname, timestep, res, box):
+    """Return the key identifying a read, in flight or cached, source is the (url, version) of the IDX"""
+    return (source, fieldname, int(timestep), int(res), tuple(int(v) for v in box))
+
+
+# ////////////////////////////////////////////////////////////
+class TimeMajorReader:
+    """
+    Reader of the time-major sidecar conversion/idx_time_major.py writes next to the IDX
+    The sidecar holds one (ROW, COL, chunk) array per chunk of consecutive timesteps, so the history of a location
+    is one contiguous read per chunk instead of one IDX query per timestep. Only full resolution is stored.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: directory of the sidecar
+        """
+        self.path=path
+        with open(f"{path}/{TIME_MAJOR_META}") as f:
+            meta=json.load(f)
+        self.fieldname=meta['field']
+        self.chunk=int(meta['chunk'])
+
+    def read(self, fieldname, timesteps, box, out):
+        """
+        Read box for each of timesteps into out[i], return False without reading if the sidecar lacks any of them
+        """
+        # the conversion may have added timesteps since the last read
+        filled=np.load(f"{self.path}/{TIME_MAJOR_FILLED}")
+        timesteps=np.asarray(timesteps, dtype=int)
+        if fieldname!=self.fieldname or timesteps.max() >= len(filled) or not filled[timesteps].all():
+            return False
+        x1, y1, x2, y2 = box
+        chunks=timesteps // self.chunk
+        for chunk in np.unique(chunks):
+            i=np.nonzero(chunks==chunk)[0]
+            data=np.load(f"{self.path}/{chunk:06d}.npy", mmap_mode='r')
+            out[i]=np.moveaxis(data[y1:y2, x1:x2, timesteps[i] % self.chunk], -1, 0)
+        return True
+
+
+# reads and cached tiles of all datasets opened with this backend
+scheduler=ReadScheduler()
+cache=BlockCache()
+
 
 # ////////////////////////////////////////////////////////////
 class OpenVisusBackendArray(xr.backends.common.BackendArray):
@@ -17,8 +634,9 @@ class OpenVisusBackendArray(xr.backends.common.BackendArray):
 #     TODO: adding it for normalized coordinates
 
     # constructor
-    def __init__(self,db, shape, dtype, timesteps,resolution,fieldname):
+    def __init__(self,db, shape, dtype, timesteps,resolution,fieldname,time_major=None):
         self.db    = db
+        self.time_major=time_major
         self.shape = shape
         self.fieldname=fieldname
         self.dtype = dtype
@@ -27,6 +645,32 @@ class OpenVisusBackendArray(xr.backends.common.BackendArray):
         self.resolution=resolution
         self.resFound=True
         self.timeFound=True
+        # OpenVisus datasets can't be pickled, dask workers in other processes load it again from its url
+        self.url=db.getUrl()
+        self.last_source=None
+
+    def source(self):
+        """
+        Return the (url, version) the reads and cached tiles of the IDX are keyed by, see dataset_version
+        Tiles and block plans of an older version are dropped, so a long running process reads timesteps the
+        conversion rewrote since it opened the dataset, without opening it again.
+        """
+        source=(self.url, dataset_version(self.url))
+        if source!=self.last_source:
+            if self.last_source is not None:
+                cache.discard(self.last_source)
+                scheduler.discard(self.last_source)
+            self.last_source=source
+        return source
+
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['db']=None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.db=ov.LoadDataset(self.url)
 
     # _getKeyRange
     def _getXRange(self, value):
@@ -62,66 +706,52 @@ class OpenVisusBackendArray(xr.backends.common.BackendArray):
         return (A,B)
     
     def _getTRange(self, value):
-
+        # a full slice reads every timestep, in parallel; open the dataset with chunks={} to stream
+        # long time ranges chunk by chunk with bounded memory instead
         A =  value.start if isinstance(value, slice) else value    ;
         B =  value.stop  if isinstance(value, slice) else value + 1;
-        if A is None and B is None:
-            print('Getting last timestep only to avoid memory overload! Set start and end timesteps to get the range data.')
-            self.timeFound=False
-        A= int(self.shape[0])-2 if A is None else A;
-        B=int(self.shape[0])-1 if B is None else B;
+        A= int(0) if A is None else A;
+        B= int(self.shape[0]) if B is None else B;
 
         return (A,B)
 
-    def _raw_indexing_method(self, key: tuple) -> np.typing.ArrayLike:
+    def _getRes(self, value):
+        # an integer selects that resolution, 0 being the highest as in the pdim==3 branch and the callers' data_resolution,
+        # a slice (like the chunks of a dask array) reads at its last resolution
+        if not isinstance(value, slice):
+            return self.db.getMaxResolution() if value==0 else value
+        return self.db.getMaxResolution() if value.stop is None else value.stop - 1
 
-        def fetch_data( time, res, x1, y1, x2, y2, fieldname, max_attempts=5, retry_delay=5):
-            attempt = 1
-            while attempt < max_attempts:
-                try:
-                    # if attempt>0:
-                    #     print(f'Attempt: {attempt} out of {max_attempts}')
-                    d=self.db.read(time=time, max_resolution=res, logic_box=[(x1, y1), (x2, y2)], field=fieldname)
-                    return d
-                except Exception as e:  # Consider specifying the exception type if possible
-                    # print(f"Retry {attempt + 1}/{max_attempts} - Error fetching data: {e}")
-                    attempt += 1
-                    time.sleep(retry_delay)
-                    if attempt == max_attempts:
-                        print(f"Failed to fetch data after {max_attempts} attempts")
-                        return None
-
-        def fetch_all_data(t1, t2, res, x1, y1, x2, y2, fieldname, max_workers=8):
-            data = []
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(fetch_data, time, res, x1, y1, x2, y2, fieldname) for time in range(t1, t2)]
-                for future in futures:
-                    data.append(future.result())
-            return data
-        max_workers = 20 
+    def _raw_indexing_method(self, key: tuple) -> np.typing.ArrayLike:
 
         if self.pdim==2:
             t1,t2=self._getTRange(key[0])
             y1,y2=self._getYRange(key[1])
             x1,x2=self._getXRange(key[2])
 
-            data=[]
             if isinstance(self.resolution,int):
                 res=self.resolution
             else:
-                res,res1=self._getResRange(key[3])
-                if res==0:  
-                    res= self.db.getMaxResolution()
-                    print('Using Max Resolution: ',res)
-            if isinstance(self.timesteps,int):
-                data=self.db.read(time=self.timesteps,max_resolution=res, logic_box=[(x1,y1),(x2,y2)],field=self.fieldname)
+                res=self._getRes(key[3])
+            timesteps=[self.timesteps] if isinstance(self.timesteps,int) else range(t1, t2)
+
+            # the output is allocated once, each timestep is read straight into its slice
+            shape=box_shape((x1, y1, x2, y2), level_strides(self.db, res))
+            data=np.empty((len(timesteps),)+shape, dtype=self.dtype)
+            tx,ty=tile_size(self.db, res)
+            if len(timesteps)>1 and x2-x1<=tx and y2-y1<=ty:
+                # history of a small box, e.g. one city
+                scheduler.read_series(self.db, self.source(), self.fieldname, timesteps, res, (x1, y1, x2, y2), data, self.time_major)
             else:
-                if isinstance(t1,int) and isinstance(res,int) and isinstance(t2,int):
-                    data = fetch_all_data(t1, t2, res, x1, y1, x2, y2, self.fieldname, max_workers)
+                scheduler.read_timesteps(self.db, self.source(), self.fieldname, timesteps, res, (x1, y1, x2, y2), data, cache)
+
+            # (time, y, x), minus the dimensions indexed with an integer; dask expects exactly the shape of its chunk
+            # indexing and adding an axis are views, the data is not copied again
+            data=data[tuple(0 if isinstance(k, (int, np.integer)) else slice(None) for k in key[:3])]
+            if isinstance(key[3], slice):
+                data=data[..., np.newaxis]
+            return data
 
-                else:
-                    data=self.db.read(logic_box=[(x1,y1),(x2,y2)],max_resolution=self.db.getMaxResolution(),field=self.fieldname)
-                
         elif self.pdim==3:
             
             t1,t2=self._getTRange(key[0])
@@ -165,6 +795,50 @@ class OpenVisusBackendArray(xr.backends.common.BackendArray):
         if not self.timeFound:
             data=data[np.newaxis,:,:,:]
         return data
+    def read_progressive(self, time, y=slice(None), x=slice(None), num_refinements=3, resolution=None, fill=False, callback=None):
+        """
+        Yield (resolution, data) for one timestep from coarse to fine, see read_progressive
+        :param int time: index of the timestep
+        :param slice y: rows to read
+        :param slice x: columns to read
+        :param int num_refinements: number of levels, each pdim resolutions finer than the previous one, as in db.read
+        :param int resolution: finest resolution, None for the resolution the dataset was opened with or the max
+        :param bool fill: repeat the samples of coarser levels to the shape of the finest one
+        :param callback: called with (resolution, data) of each level before it is yielded, e.g. to update a plot
+        """
+        if self.pdim!=2:
+            raise Exception("progressive reads are only supported for 2D datasets")
+        y1,y2=self._getYRange(y)
+        x1,x2=self._getXRange(x)
+        if resolution is None:
+            resolution=self.resolution if isinstance(self.resolution,int) else self.db.getMaxResolution()
+        resolutions=[resolution - self.pdim*I for I in reversed(range(num_refinements)) if resolution - self.pdim*I >= 0]
+        for res, data in read_progressive(self.db, self.fieldname, int(time), (x1, y1, x2, y2), resolutions, fill):
+            if callback is not None:
+                callback(res, data)
+            yield res, data
+
+    def read_points(self, rows, cols, time=slice(None), resolution=None):
+        """
+        Return the values at (rows[i], cols[i]) for each timestep of time, as a (point, time) array
+        Only the IDX blocks holding points are read, see ReadScheduler.read_points.
+        :param np.ndarray rows: full resolution row indices, moved to the nearest sample of resolution
+        :param np.ndarray cols: full resolution column indices, moved to the nearest sample of resolution
+        :param time: slice or array of timestep indices
+        :param int resolution: resolution to read at, None for the resolution the dataset was opened with or the max
+        """
+        if self.pdim!=2:
+            raise Exception("point reads are only supported for 2D datasets")
+        if resolution is None:
+            resolution=self.resolution if isinstance(self.resolution,int) else self.db.getMaxResolution()
+        rows,cols=snap_points(self.db, resolution, rows, cols)
+        if isinstance(time, slice):
+            timesteps=list(range(*time.indices(int(self.shape[0]))))
+        else:
+            timesteps=[int(t) for t in np.atleast_1d(time)]
+        out=np.empty((len(rows), len(timesteps)), dtype=self.dtype)
+        return scheduler.read_points(self.db, self.source(), self.fieldname, timesteps, resolution, rows, cols, out)
+
     # __getitem__
     def __getitem__(self, key: xr.core.indexing.ExplicitIndexer) -> np.typing.ArrayLike:
         return xr.core.indexing.explicit_indexing_adapter(key,self.shape,
@@ -172,14 +846,73 @@ class OpenVisusBackendArray(xr.backends.common.BackendArray):
                                                           self._raw_indexing_method)
 
 
+def backend_array(data_array):
+    """
+    Return the OpenVisusBackendArray behind a variable opened with this backend, e.g. backend_array(ds['PM25'])
+    It gives access to the whole variable, whatever the data array was indexed with.
+    """
+    data=data_array.variable._data
+    # unwrap xarray's lazy indexing and caching layers
+    while not isinstance(data, OpenVisusBackendArray):
+        if not hasattr(data, 'array'):
+            raise ValueError(f"{data_array.name} is not backed by OpenVisusBackendArray (opened with chunks?)")
+        data=data.array
+    return data
+
+
+def select_points(ds, lats, lons, times=None, fieldname='PM25', resolution=None):
+    """
+    Return fieldname at the grid cells nearest to (lats[i], lons[i]) as a (station, time) DataArray
+    Coordinates are mapped to grid indices once, from the XORIG, YORIG, XCELL and YCELL attributes of the dataset,
+    and only the IDX blocks holding stations are read. Stations outside the grid and times not in the dataset are NaN.
+    :param xr.Dataset ds: dataset opened with OpenVisusBackendEntrypoint
+    :param np.ndarray lats: latitude of each station
+    :param np.ndarray lons: longitude of each station
+    :param list times: values of the time coordinate to read (timestep indices if ds has none), None for all
+    :param str fieldname: variable to read
+    :param int resolution: resolution to read at, None for the max
+    """
+    array=backend_array(ds[fieldname])
+    nrows, ncols=int(array.shape[1]), int(array.shape[2])
+    rows=np.round((np.asarray(lats, dtype=float) - ds.attrs['YORIG']) / ds.attrs['YCELL']).astype(int)
+    cols=np.round((np.asarray(lons, dtype=float) - ds.attrs['XORIG']) / ds.attrs['XCELL']).astype(int)
+    inside=(rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+
+    if times is None:
+        timesteps=np.arange(int(array.shape[0]))
+        times=ds.indexes['time'] if 'time' in ds.indexes else timesteps
+    elif 'time' in ds.indexes:
+        timesteps=ds.indexes['time'].get_indexer(pd.Index(times))
+    else:
+        timesteps=np.asarray(times, dtype=int)
+    found=(timesteps >= 0) & (timesteps < int(array.shape[0]))
+
+    if resolution is None:
+        resolution=array.resolution if isinstance(array.resolution,int) else array.db.getMaxResolution()
+    rows[inside], cols[inside]=snap_points(array.db, resolution, rows[inside], cols[inside])
+    values=np.full((len(rows), len(timesteps)), np.nan, dtype=np.result_type(array.dtype, np.float32))
+    values[np.ix_(inside, found)]=array.read_points(rows[inside], cols[inside], timesteps[found], resolution)
+
+    coords={'lat': ('station', np.where(inside, ds.attrs['YORIG'] + rows * ds.attrs['YCELL'], np.nan)),
+            'lon': ('station', np.where(inside, ds.attrs['XORIG'] + cols * ds.attrs['XCELL'], np.nan)),
+            'time': ('time', np.asarray(times))}
+    return xr.DataArray(values, dims=('station', 'time'), coords=coords, name=fieldname, attrs=ds[fieldname].attrs)
+
+
 # ////////////////////////////////////////////////////////////////////////////////
 class OpenVisusBackendEntrypoint(xr.backends.common.BackendEntrypoint):
 
     # needed bu xarray (list here all arguments specific for the backend)
-    open_dataset_parameters = ["filename_or_obj", "drop_variables", "resolution", "timesteps","coordinates","prefer"]
+    open_dataset_parameters = ["filename_or_obj", "drop_variables", "resolution", "timesteps","coordinates","prefer","time_chunk","time_major","aggregates"]
     
     # open_dataset (needed by the backend)
-    def open_dataset(self,filename_or_obj,*, resolution=None, timesteps=None,drop_variables=None,coords=None,attrs=None,dims=None, prefer=None, **kwargs):
+    # xr.open_dataset(..., chunks={}) gives dask arrays chunked as advertised in preferred_chunks: time_chunk
+    # timesteps (None for about CHUNK_BYTES) of whole frames at one resolution, each read when dask computes it
+    # time_major is the directory of the time-major sidecar of the IDX, None to use the one next to a local IDX if
+    # there is one, False to always read the IDX
+    # aggregates is the directory of the daily and monthly aggregates of the IDX, added as variables such as
+    # PM25_daily_mean; None to use those next to a local IDX if there are some, False to leave them out
+    def open_dataset(self,filename_or_obj,*, resolution=None, timesteps=None,drop_variables=None,coords=None,attrs=None,dims=None, prefer=None, time_chunk=None, time_major=None, aggregates=None, **kwargs):
 
         self.resolution=resolution
         
@@ -204,6 +937,10 @@ class OpenVisusBackendEntrypoint(xr.backends.common.BackendEntrypoint):
             idx_url=ds.attrs['idx_url']
         print(f"ov.LoadDataset({idx_url})")
         db=ov.LoadDataset(idx_url)
+        if time_major is None:
+            time_major=os.path.join(os.path.dirname(idx_url), TIME_MAJOR)
+            time_major=time_major if os.path.isfile(os.path.join(time_major, TIME_MAJOR_META)) else False
+        time_major=TimeMajorReader(time_major) if time_major else None
 
         self.timesteps=timesteps
         dim=db.getPointDim()
@@ -244,18 +981,38 @@ class OpenVisusBackendEntrypoint(xr.backends.common.BackendEntrypoint):
                     shape.insert(0,self.timesteps+1)
                 else:
                     shape.insert(0,len(self.timesteps))
+
+            # whole frames, whole days of timesteps per chunk, and one resolution since each is read separately
+            frame_bytes=dtype.itemsize*int(np.prod(shape[1:-1]))
+            chunk=time_chunk
+            if chunk is None:
+                chunk=max(1, CHUNK_BYTES // frame_bytes)
+                if chunk >= HOURS_PER_DAY:
+                    chunk=chunk // HOURS_PER_DAY * HOURS_PER_DAY
+            preferred_chunks={label: int(size) for label, size in zip(labels, shape)}
+            preferred_chunks.update({labels[0]: int(min(chunk, shape[0])), labels[-1]: 1})
       
             data_vars[fieldname]=xr.Variable(
                 labels,
                 xr.core.indexing.LazilyIndexedArray(OpenVisusBackendArray(db=db, shape=shape,dtype=dtype,
                 fieldname=fieldname,
                                                                           timesteps=self.timesteps,
-                                                                          resolution=self.resolution)),
-                attrs=ds[fieldname].attrs
+                                                                          resolution=self.resolution,
+                                                                          time_major=time_major)),
+                attrs=ds[fieldname].attrs,
+                encoding={'preferred_chunks': preferred_chunks}
             )
             print("Adding field ",fieldname,"shape ",shape,"dtype ",dtype,"labels ",labels,
                  "Max Resolution ", db.getMaxResolution())            
-        ds1 = xr.Dataset(data_vars=data_vars,attrs=ds.attrs)
+        if aggregates is None:
+            aggregates=os.path.dirname(idx_url)
+            aggregates=aggregates if os.path.isfile(os.path.join(aggregates, AGGREGATES_META)) else False
+        aggregate_coords={}
+        if aggregates:
+            aggregate_vars,aggregate_coords=self.aggregate_variables(aggregates, ds)
+            data_vars.update(aggregate_vars)
+
+        ds1 = xr.Dataset(data_vars=data_vars,coords=aggregate_coords,attrs=ds.attrs)
         coord_name=[i for i in ds.coords]
 
         for coord in coord_name:
@@ -270,6 +1027,38 @@ class OpenVisusBackendEntrypoint(xr.backends.common.BackendEntrypoint):
         ds1.set_close(self.close_method)
         return ds1
     
+    # aggregate_variables
+    def aggregate_variables(self, path, ds):
+        """
+        Return the variables and coordinates of the aggregates conversion/idx_aggregates.py writes in path
+        Each field of the daily and monthly aggregate IDX is a (day or month, ROW, COL, resolution) variable named
+        after the aggregated field, e.g. PM25_daily_mean, PM25_daily_max or PM25_monthly_hours_above_35. The day and
+        month coordinates hold the first instant of each period, day_hours and month_hours how many hours it has.
+        """
+        with open(os.path.join(path, AGGREGATES_META)) as f:
+            meta=json.load(f)
+        spatial_dims=list(ds[meta['field']].dims)
+        variables,coords={},{}
+        for period,(dim,unit) in AGGREGATE_DIMS.items():
+            db=ov.LoadDataset(os.path.join(path, AGGREGATE_IDX[period]))
+            n=len(meta[period]['hours'])
+            coords[dim]=(dim, np.datetime64(meta[period]['start'], unit) + np.arange(n))
+            coords[f"{dim}_hours"]=(dim, np.array(meta[period]['hours']))
+            resolution=self.resolution if isinstance(self.resolution,int) else db.getMaxResolution()
+            shape=[n]+list(reversed(db.getLogicSize()))+[resolution+1]
+            for fieldname in db.getFields():
+                dtype=self.toNumPyDType(db.getField(fieldname).dtype.get(0))
+                # whole frames and as many periods as fit in CHUNK_BYTES per chunk, one resolution
+                chunk=max(1, CHUNK_BYTES // (dtype.itemsize*int(np.prod(shape[1:-1]))))
+                preferred_chunks={dim: int(min(chunk, n)), **{label: int(size) for label, size in zip(spatial_dims, shape[1:-1])}, 'resolution': 1}
+                variables[f"{meta['field']}_{period}_{fieldname}"]=xr.Variable(
+                    [dim]+spatial_dims+['resolution'],
+                    xr.core.indexing.LazilyIndexedArray(OpenVisusBackendArray(db=db, shape=shape, dtype=dtype, fieldname=fieldname,
+                                                                              timesteps=db.getTimesteps(),
+                                                                              resolution=self.resolution)),
+                    encoding={'preferred_chunks': preferred_chunks})
+        return variables,coords
+
     # toNumPyDType (always pass the atomic OpenVisus type i.e. uint8[8] should not be accepted)
     def toNumPyDType(self,atomic_dtype):
         """
@@ -315,3 +1104,14 @@ class OpenVisusBackendEntrypoint(xr.backends.common.BackendEntrypoint):
 
 
 
+
+
+def load_firesmoke_ds(path, engine=OpenVisusBackendEntrypoint, **kwargs):
+    """
+    Return the firesmoke metadata NetCDF at path opened with this backend, with lat, lon and time coordinates
+    See data_download/metadata_loader.py, the dataset is cached per version of the file and shared by the callers.
+    :param str path: path of firesmoke_metadata.nc
+    :param engine: xarray backend to open it with
+    :param kwargs: passed on to xr.open_dataset, e.g. chunks={} or resolution
+    """
+    return metadata_loader.load_firesmoke_ds(path, engine, **kwargs)
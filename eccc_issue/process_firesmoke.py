@@ -12,7 +12,6 @@ from openvisuspy.xarray_backend import OpenVisusBackendEntrypoint
 
 # Used for processing netCDF time data
 import time
-import datetime
 
 # Used for indexing via metadata
 import pandas as pd
@@ -23,62 +22,21 @@ import os
 
 from OpenVisus import *
 
-def parse_tflag(tflag):
-    """
-    Return the tflag as a datetime object
-    :param list tflag: a list of two int32, the 1st representing date and 2nd representing time
-    """
-    # obtain year and day of year from tflag[0] (date)
-    date = int(tflag[0])
-    year = date // 1000 # first 4 digits of tflag[0]
-    day_of_year = date % 1000 # last 3 digits of tflag[0]
-
-    # create datetime object representing date
-    final_date = datetime.datetime(year, 1, 1) + datetime.timedelta(days=day_of_year - 1)
-
-    # obtain hour, mins, and secs from tflag[1] (time)
-    time = int(tflag[1])
-    hours = time // 10000 # first 2 digits of tflag[1]
-    minutes = (time % 10000) // 100 # 3rd and 4th digits of tflag[1] 
-    seconds = time % 100  # last 2 digits of tflag[1]
-
-    # create final datetime object
-    full_datetime = datetime.datetime(year, final_date.month, final_date.day, hours, minutes, seconds)
-    return full_datetime
+# shared cached loader of the metadata netcdf, with vectorized TFLAG decoding, in data_download/
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data_download'))
+from metadata_loader import load_firesmoke_ds as shared_load_firesmoke_ds
 
 def load_firesmoke_ds(path, use_chunks=False, chunk_size={'time': 1, 'resolution': 1}):
+    """
+    Return the firesmoke dataset of the tiny netcdf at path, with lat, lon and time coordinates
+    The coordinates are computed once per metadata file by metadata_loader.load_firesmoke_ds, later calls are instant.
+    The returned dataset is a shallow copy of a cached one: its coordinates and attributes can be changed, but its
+    data variables are shared with every other caller, so never modify their values in place (take
+    ds.copy(deep=True) first, or assign new variables).
+    :param str path: path of firesmoke_metadata.nc
+    :param bool use_chunks: whether to open PM25 as a dask array
+    :param dict chunk_size: dask chunks, if use_chunks
+    """
     # open tiny netcdf with xarray and OpenVisus backend
-    ds = xr.open_dataset(path, engine=OpenVisusBackendEntrypoint)
-    
-    # Get metadata to compute lon and lat
-    xorig = ds.XORIG
-    yorig = ds.YORIG
-    xcell = ds.XCELL
-    ycell = ds.YCELL
-    ncols = ds.NCOLS
-    nrows = ds.NROWS
-
-    longitude = np.linspace(xorig, xorig + xcell * (ncols - 1), ncols)
-    latitude = np.linspace(yorig, yorig + ycell * (nrows - 1), nrows)
-    
-    # Create coordinates for lat and lon
-    ds.coords['lat'] = ('ROW', latitude)
-    ds.coords['lon'] = ('COL', longitude)
-
-    # Replace col and row dimensions with newly calculated lon and lat arrays (credit: Aashish Panta)
-    ds = ds.swap_dims({'COL': 'lon', 'ROW': 'lat'})
-    
-    # get all tflags
-    tflag_values = ds['TFLAG'].values
-
-    # to store pandas timestamps
-    timestamps = []
-
-    # convert all tflags to pandas timestamps, store in timestamps list
-    for tflag in tflag_values:
-        timestamps.append(pd.Timestamp(parse_tflag(tflag[0])))
-
-    # set coordinates to each timestep with these pandas timestamps
-    ds.coords['time'] = ('time', timestamps)
-    
-    return ds
\ No newline at end of file
+    return shared_load_firesmoke_ds(path, engine=OpenVisusBackendEntrypoint, chunks=chunk_size if use_chunks else None)
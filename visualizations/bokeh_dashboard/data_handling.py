@@ -19,6 +19,12 @@ import pandas as pd
 
 # local modules
 from util import *
+from grid_geometry import load_mercator_axes, grid_mercator_latlons
+
+# shared cached loader of the metadata netcdf, in data_download/
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../data_download"))
+from metadata_loader import load_firesmoke_ds
 
 os.environ["VISUS_CACHE"] = "./visus_cache_can_be_erased"
 os.environ["CURL_CA_BUNDLE"] = ""
@@ -37,58 +43,21 @@ if download:
     with open(local_netcdf, "wb") as f:
         f.write(response.content)
 
-# open tiny netcdf with xarray and OpenVisus backend
-ds = xr.open_dataset(local_netcdf, engine=OpenVisusBackendEntrypoint)
-
-##### Process all metadata of file #####
-### Lat/Lon ###
-# get metadata to compute lon and lat
-xorig = ds.XORIG
-yorig = ds.YORIG
-xcell = ds.XCELL
-ycell = ds.YCELL
-ncols = ds.NCOLS
-nrows = ds.NROWS
-
-longitude = np.linspace(xorig, xorig + xcell * (ncols - 1), ncols)
-latitude = np.linspace(yorig, yorig + ycell * (nrows - 1), nrows)
-
-# Create coordinates for lat and lon (credit: Aashish Panta)
-ds.coords["lat"] = ("ROW", latitude)
-ds.coords["lon"] = ("COL", longitude)
-
-# Replace col and row dimensions with newly calculated lon and lat arrays (credit: Aashish Panta)
-ds = ds.swap_dims({"COL": "lon", "ROW": "lat"})
-
-### Timestamps ###
-# get all tflags
-tflag_values = ds["TFLAG"].values
-
-# to store pandas timestamps
-timestamps = []
-
-# convert all tflags to pandas timestamps, store in timestamps list
-for tflag in tflag_values:
-    timestamps.append(pd.Timestamp(parse_tflag(tflag[0])))
-
-# set coordinates to each timestep with these pandas timestamps
-ds.coords["time"] = ("time", timestamps)
+# open tiny netcdf with xarray and OpenVisus backend, with lat/lon and time coordinates
+# the TFLAGs are decoded at once and the coordinated dataset is cached per metadata file, see metadata_loader.py
+ds = load_firesmoke_ds(local_netcdf, engine=OpenVisusBackendEntrypoint)
 
 ##### Functions for bokeh to access data #####
 def get_latslons():
     """
     Return a numpy array of all lats and lons used in dataset in mercator coordinates
+    Only the lat and lon axes are projected, no PM25 is read, and they are cached on disk by grid_geometry.
     """
-    # get list of latitudes and longitudes
-    data_stacked_index = ds["PM25"][0].stack(lat_lon=["lat", "lon"])
-
-    # numpy array to return
-    mercator_latlons = np.zeros((np.shape(data_stacked_index)[1], 2))
-    for i, tup in enumerate(latlon_to_mercator_iter(data_stacked_index.lat_lon.data)):
-        mercator_latlons[i][0] = tup[0]
-        mercator_latlons[i][1] = tup[1]
+    # the grid is regular, so mercator x only depends on lon and y only on lat
+    x, y = load_mercator_axes(ds["lat"].values, ds["lon"].values)
 
-    return mercator_latlons
+    # (x, y) of every cell, in the order of ds["PM25"][0].stack(lat_lon=["lat", "lon"])
+    return grid_mercator_latlons(x, y)
 
 def get_pm25(date, hour, res):
     """
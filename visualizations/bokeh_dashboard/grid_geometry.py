@@ -0,0 +1,75 @@
+import hashlib
+import os
+import numpy as np
+from pyproj import CRS, Transformer
+
+### Grid geometry of the firesmoke data in web mercator, for bokeh ###
+# The firesmoke grid is regular in lat/lon, and web mercator x only depends on longitude and y only on latitude,
+# so the ~400k grid cells are projected as two axes of 1081 and 381 values. The axes are saved to disk, keyed by
+# the lat/lon axes, so later dashboard sessions load them without projecting anything.
+
+# directory of the cached axes, can be erased
+GRID_CACHE = os.environ.get("GRID_GEOMETRY_CACHE", "./grid_cache_can_be_erased")
+
+# transformer from the geographic coordinate system (latitude, longitude) to web mercator (the CRS supported by bokeh)
+# creating one is much slower than using it, so it is created once for the process
+# ref: https://pyproj4.github.io/pyproj/stable/advanced_examples.html#optimize-transformations
+transformer = Transformer.from_crs(CRS("EPSG:4326"), CRS("EPSG:3857"))
+
+
+def latlon_to_mercator(lat, lon):
+    """
+    Return the given lat/lon coordinates in mercator projection, as (x, y)
+    Works on floats as well as on arrays, transformed all at once.
+    :param lat: latitude(s) in degrees
+    :param lon: longitude(s) in degrees
+    """
+    return transformer.transform(lat, lon)
+
+
+def mercator_axes(lats, lons):
+    """
+    Return the mercator x of every longitude and y of every latitude of a regular lat/lon grid
+    :param np.ndarray lats: 1D latitudes of the grid rows
+    :param np.ndarray lons: 1D longitudes of the grid columns
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    x, _ = latlon_to_mercator(np.zeros_like(lons), lons)
+    _, y = latlon_to_mercator(lats, np.zeros_like(lats))
+    return np.asarray(x), np.asarray(y)
+
+
+def load_mercator_axes(lats, lons, cache_dir=GRID_CACHE):
+    """
+    Return mercator_axes(lats, lons), read from cache_dir if they were computed before, saved there otherwise
+    :param np.ndarray lats: 1D latitudes of the grid rows
+    :param np.ndarray lons: 1D longitudes of the grid columns
+    :param str cache_dir: directory of the cached axes, None to not cache them
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    if cache_dir is None:
+        return mercator_axes(lats, lons)
+
+    key = hashlib.sha256(lats.tobytes() + b"/" + lons.tobytes()).hexdigest()[:16]
+    path = f"{cache_dir}/mercator_axes_{key}.npz"
+    if os.path.exists(path):
+        with np.load(path) as f:
+            return f["x"], f["y"]
+
+    x, y = mercator_axes(lats, lons)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file and rename it, so concurrent sessions never read a partial file
+    with open(path + ".part", mode="wb") as f:
+        np.savez(f, x=x, y=y)
+    os.replace(path + ".part", path)
+    return x, y
+
+
+def grid_mercator_latlons(x, y):
+    """
+    Return the (x, y) of every grid cell, as an array of shape (len(y) * len(x), 2)
+    Cells are in the order of ds['PM25'][0].stack(lat_lon=['lat', 'lon']): row by row, from the first latitude.
+    :param np.ndarray x: mercator x of the grid columns
+    :param np.ndarray y: mercator y of the grid rows
+    """
+    return np.column_stack([np.tile(x, len(y)), np.repeat(y, len(x))])
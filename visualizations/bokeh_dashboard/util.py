@@ -2,7 +2,9 @@ import time
 import datetime
 import pandas as pd
 import numpy as np
-from pyproj import Proj, CRS, Transformer
+
+# mercator projection, with a single transformer for the process
+import grid_geometry
 
 ### Helper functions ###
 
@@ -13,24 +15,14 @@ def latlon_to_mercator(lat, lon):
     ref: https://pyproj4.github.io/pyproj/stable/gotchas.html#gotchas
     
     Args:
-        lat (float): Latitude in degrees.
-        lon (float): Longitude in degrees.
+        lat (float or np.ndarray): Latitude(s) in degrees.
+        lon (float or np.ndarray): Longitude(s) in degrees.
 
     Returns:
         tuple[float, float]: (x, y) coordinates in mercator projection.
     """
-    # get coordinate reference system for EPSG:4326 (used for GPS lat/lon)
-    # and mercator (the CRS supported by bokeh)
-    source_crs = CRS("EPSG:4326")  # geographic coordinate system (latitude, longitude)
-    dest_crs = CRS("EPSG:3857")  # web mercator projection
-
-    # create transformer from geographic coordinate system to web mercator
-    transformer = Transformer.from_crs(source_crs, dest_crs)
-
-    # transform points and save to iterator
-    mercator_coords = transformer.transform(lat, lon)
-
-    return mercator_coords
+    # uses the transformer created once in grid_geometry, creating one per call is slow
+    return grid_geometry.latlon_to_mercator(lat, lon)
 
 
 def latlon_to_mercator_iter(latlon_tuples):
@@ -41,18 +33,8 @@ def latlon_to_mercator_iter(latlon_tuples):
     Args:
         latlon_tuples (list): a list of tuples, each tuple holding a lat/lon coordinate
     """
-    # get coordinate reference system for EPSG:4326 (used for GPS lat/lon)
-    # and mercator (the CRS supported by bokeh)
-    source_crs = CRS("EPSG:4326")  # geographic coordinate system (latitude, longitude)
-    dest_crs = CRS("EPSG:3857")  # web mercator projection
-
-    # create transformer from geographic coordinate system to web mercator
-    transformer = Transformer.from_crs(source_crs, dest_crs)
-
     # transform points and save to iterator
-    mercator_iter = transformer.itransform(latlon_tuples)
-
-    return mercator_iter
+    return grid_geometry.transformer.itransform(latlon_tuples)
 
 
 def parse_tflag(tflag):
@@ -36,6 +36,11 @@ import cartopy.crs as ccrs
 # for exporting the dictionary of issue files at the end of notebook
 import pickle
 
+# groups consecutive idx_calls from the same file, shared with the IDX conversion in conversion/
+import sys
+sys.path.append(os.path.join(os.path.abspath(''), '..', '..', '..', 'conversion'))
+from idx_schedule import group_by_file
+
 # Accessory, used to generate progress bar for running for loops
 # from tqdm.notebook import tqdm
 # import ipywidgets
@@ -160,14 +165,18 @@ def get_timestamp(year, month, day, hour):
 # In[26]:
 
 
-# Load idx_calls from file
-with open('idx_calls_v5.pkl', 'rb') as f:
-    idx_calls = pickle.load(f)
+# Load idx_calls from file, a structured array of (file, time, tstep) saved by the IDX conversion
+idx_calls = np.load('idx_calls_v5.npy')
 
 print(f"there's {len(idx_calls)} frames to make")
 
-for c in np.arange(len(idx_calls)):
-    idx_calls[c].append(c)
+# consecutive frames mostly come from the same file, group them so each file is opened and read once
+# as [file name, [[timestamp, TSTEP index, frame number], ...]] to hand to the pool
+file_calls = [[str(idx_calls['file'][start]), [[call['time'].item(), int(call['tstep']), c]
+                                              for c, call in zip(range(start, stop), idx_calls[start:stop])]]
+              for start, stop in group_by_file(idx_calls)]
+
+print(f"from {len(file_calls)} runs of the same file")
 
 
 # In[27]:
@@ -199,29 +208,30 @@ issue_files = {}
 # In[ ]:
 
 
-def create_frame_from_call(call):
-    # get instructions from call:
-    # [file name to open, timestamp, TSTEP index to select]
-    file_name = call[0]
-    timestamp = call[1]
-    tstep_index = call[2]
-    frame_num = call[3]
+def create_frames_from_file(file_call):
+    # get instructions from file_call:
+    # [file name to open, [[timestamp, TSTEP index to select, frame number], ...]]
+    file_name, calls = file_call
 
-    # create visualization using matplotlib and cartopy geography lines, 
-    # open the current file with xarray
+    # open the current file with xarray, once for all its frames
     ds = xr.open_dataset(f'{netcdf_dir}/{file_name}')
 
-    # Get the PM25 values, squeeze out empty axis
-    ds_vals = np.squeeze(ds['PM25'].values)
+    # Get the PM25 values of only the TSTEPs we visualize, without the empty LAY axis
+    ds_vals = ds['PM25'][[call[1] for call in calls], 0].values
+
+    # extent is either with the 381x1041 lons/lats or 381x1081 lons/lats
+    curr_extent = my_extent_s if ds['PM25'].shape[3] == 1041 else my_extent_b
+    ds.close()
+
+    return [create_frame(data_at_time, timestamp, frame_num, curr_extent)
+            for (timestamp, tstep_index, frame_num), data_at_time in zip(calls, ds_vals)]
 
-    # get pm25 values at tstep_index and visualize them
-    data_at_time = ds_vals[tstep_index]
 
+def create_frame(data_at_time, timestamp, frame_num, curr_extent):
+    # create visualization of pm25 values data_at_time using matplotlib and cartopy geography lines
     # catch exceptions accordingly
     try:
         my_fig, my_plt = plt.subplots(figsize=(15, 6), subplot_kw=dict(projection=ccrs.PlateCarree()))
-        # extent is either with the 381x1041 lons/lats or 381x1081 lons/lats
-        curr_extent = my_extent_s if ds['PM25'].shape[3] == 1041 else my_extent_b
         plot = my_plt.imshow(data_at_time, norm=my_norm, extent=curr_extent, aspect=my_aspect, origin=my_origin, cmap=my_cmap)
         my_fig.colorbar(plot,location='right', label='ug/m^3')
         my_plt.coastlines()
@@ -252,7 +262,7 @@ with multiprocessing.Pool() as pool:
    # Start a timer to measure how long the conversion takes
    start_time = time.time()
    print('starting')
-   issues = pool.map(create_frame_from_call, idx_calls)
+   issues = [issue for file_issues in pool.map(create_frames_from_file, file_calls) for issue in file_issues]
    print('done!')
    # End the timer and print the elapsed time
    end_time = time.time()